@@ -1,32 +1,61 @@
 from django.contrib import admin
-from vins_search.models import CustomDutyFile, CustomDutyFileUploads
+from vins_search.models import (
+    Brand,
+    ChunkedUpload,
+    CustomDutyFile,
+    CustomDutyFileUploads,
+    CustomsOffice,
+    EngineType,
+    OriginCountry,
+    PaymentStatus,
+    QuarantinedRow,
+    VehicleType,
+)
 
 @admin.register(CustomDutyFile)
 class CustumDutyFilesAdmin(admin.ModelAdmin):
     list_display = (
         "vin",
-        "brand",
+        "brand_ref",
         "model",
         "vehicle_year",
-        "engine_type",
+        "engine_type_ref",
         "vreg",
-        "vehicle_type",
+        "vehicle_type_ref",
         "importer_tin",
         "importer_business_name",
         "importer_address",
-        "origin_country",
+        "origin_country_ref",
         "hscode",
         "sgd_num",
         "sgd_date",
-        "office_cod",
-        "payment_status",
+        "office_cod_ref",
+        "payment_status_ref",
+        "upload",
     )
 
     list_display_links = (
         "vin",
-        "brand",
+        "brand_ref",
         "model",
     )
+    list_select_related = (
+        "brand_ref",
+        "engine_type_ref",
+        "vehicle_type_ref",
+        "origin_country_ref",
+        "office_cod_ref",
+        "payment_status_ref",
+        "upload",
+    )
+
+
+@admin.register(
+    Brand, EngineType, VehicleType, OriginCountry, CustomsOffice, PaymentStatus
+)
+class DictionaryValueAdmin(admin.ModelAdmin):
+    list_display = ("value",)
+    search_fields = ("value",)
 
 @admin.register(CustomDutyFileUploads)
 class CustomDutyUploadsAdmin(admin.ModelAdmin):
@@ -35,9 +64,38 @@ class CustomDutyUploadsAdmin(admin.ModelAdmin):
         "file_name",
         "file",
         "file_type",
+        "mode",
+        "source",
+        "status",
+        "rows_processed",
         "processed_status",
         "uploaded_at",
     )
     list_display_links = ("uploaded_by",)
+    list_filter = ("status", "source")
+
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = (
+        "file_name",
+        "file_size",
+        "offset",
+        "status",
+        "created_at",
+        "updated_at",
+    )
+    list_display_links = ("file_name",)
+    list_filter = ("status",)
 
 
+@admin.register(QuarantinedRow)
+class QuarantinedRowAdmin(admin.ModelAdmin):
+    list_display = (
+        "upload",
+        "row_number",
+        "errors",
+        "created_at",
+    )
+    list_display_links = ("row_number",)
+    list_select_related = ("upload",)
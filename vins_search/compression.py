@@ -0,0 +1,46 @@
+import bz2
+import gzip
+import shutil
+import tempfile
+
+from django.core.files import File
+
+from .storage import STREAM_CHUNK_SIZE
+
+
+# Single-file compression formats, by file name suffix, decompressed as a stream
+STREAM_COMPRESSIONS = {"gz": gzip.open, "bz2": bz2.open}
+
+# Suffixes of compressed uploads; "zip" archives may hold several files
+COMPRESSION_SUFFIXES = (*STREAM_COMPRESSIONS, "zip")
+
+
+def split_compression(file_name):
+    """
+    Split "name.csv.gz" into ("name.csv", "gz"); the compression of an
+    uncompressed name is None.
+    """
+    stem, _, suffix = file_name.rpartition(".")
+    if stem and suffix.lower() in COMPRESSION_SUFFIXES:
+        return stem, suffix.lower()
+    return file_name, None
+
+
+def open_compressed(file, compression):
+    """
+    Return a read-only file object decompressing `file` as it is read.
+    """
+    file.seek(0)
+    return STREAM_COMPRESSIONS[compression](file, "rb")
+
+
+def seekable_copy(stream, name):
+    """
+    Copy a decompressing stream to a temporary file, for readers that need
+    random access (openpyxl reads .xlsx files as ZIP archives, and Parquet
+    files are read from the metadata at their end).
+    """
+    copy = tempfile.TemporaryFile()
+    shutil.copyfileobj(stream, copy, STREAM_CHUNK_SIZE)
+    copy.seek(0)
+    return File(copy, name=name)
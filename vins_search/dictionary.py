@@ -0,0 +1,176 @@
+import threading
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .models import CustomDutyFile, DictionaryValue
+
+
+# Suffix of the encoded columns, named after the text columns they replace
+ENCODED_SUFFIX = "_ref"
+
+# CustomDutyFile columns stored as ids into a lookup table of their values
+ENCODED_FIELDS = [
+    field
+    for field in CustomDutyFile._meta.concrete_fields
+    if field.is_relation and issubclass(field.related_model, DictionaryValue)
+]
+# Name of each encoded column in uploads, exports and API responses
+ENCODED_NAMES = {
+    field: field.name.removesuffix(ENCODED_SUFFIX) for field in ENCODED_FIELDS
+}
+ENCODED_FIELD_NAMES = list(ENCODED_NAMES.values())
+ENCODED_FIELDS_BY_NAME = {name: field for field, name in ENCODED_NAMES.items()}
+
+# Text columns still stored next to the encoded ones, until they are dropped
+TEXT_FIELDS = [
+    field
+    for field in CustomDutyFile._meta.concrete_fields
+    if field.name in ENCODED_FIELDS_BY_NAME
+]
+
+# Upper bound on parameters per `value__in` / `pk__in` lookup
+LOOKUP_CHUNK_SIZE = 10_000
+
+
+class DictionaryCache:
+    """
+    In-memory mapping between the values of the dictionary-encoded columns
+    and their lookup table ids, shared by everything in the process.
+
+    Values missing from a lookup table are added on first use. Entries are
+    only remembered once the transaction that read or created them commits,
+    so a rolled back batch never leaves ids behind that do not exist.
+    Lookup rows are protected from deletion while referenced, which keeps
+    remembered ids valid.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.ids.clear()
+            self.values.clear()
+
+    def remember(self, key, ids):
+        with self.lock:
+            self.ids.setdefault(key, {}).update(ids)
+            self.values.setdefault(key, {}).update(
+                (pk, value) for value, pk in ids.items()
+            )
+
+    def encode(self, field, values, using=DEFAULT_DB_ALIAS):
+        """
+        Return the lookup ids of `values`, with None kept as None.
+        """
+        key = (using, field.name)
+        ids = self.ids.get(key, {})
+        missing = {value for value in values if value is not None and value not in ids}
+        if missing:
+            model = field.related_model.objects.using(using)
+            missing = list(missing)
+            model.bulk_create(
+                [field.related_model(value=value) for value in missing],
+                ignore_conflicts=True,
+            )
+            found = {}
+            for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+                found.update(
+                    model.filter(
+                        value__in=missing[start : start + LOOKUP_CHUNK_SIZE]
+                    ).values_list("value", "pk")
+                )
+            transaction.on_commit(lambda: self.remember(key, found), using=using)
+            ids = {**ids, **found}
+        return [None if value is None else ids[value] for value in values]
+
+    def decode(self, field, ids, using=DEFAULT_DB_ALIAS):
+        """
+        Return the values behind lookup `ids`, with None kept as None.
+        """
+        key = (using, field.name)
+        values = self.values.get(key, {})
+        missing = list({pk for pk in ids if pk is not None and pk not in values})
+        if missing:
+            model = field.related_model.objects.using(using)
+            found = {}
+            for start in range(0, len(missing), LOOKUP_CHUNK_SIZE):
+                found.update(
+                    model.filter(
+                        pk__in=missing[start : start + LOOKUP_CHUNK_SIZE]
+                    ).values_list("value", "pk")
+                )
+            transaction.on_commit(lambda: self.remember(key, found), using=using)
+            values = {**values, **{pk: value for value, pk in found.items()}}
+        return [None if pk is None else values[pk] for pk in ids]
+
+    def value(self, field, pk, using=DEFAULT_DB_ALIAS):
+        return self.decode(field, [pk], using=using)[0]
+
+
+dictionary_cache = DictionaryCache()
+
+
+def stored_names(names):
+    """
+    Map column names as uploads know them to the CustomDutyFile fields
+    holding them, for `.values()`.
+
+    The text columns of encoded names follow, while they exist, so that
+    `decode_rows` can fall back on them for rows not encoded yet.
+    """
+    stored = [
+        ENCODED_FIELDS_BY_NAME[name].name if name in ENCODED_FIELDS_BY_NAME else name
+        for name in names
+    ]
+    return stored + [field.name for field in TEXT_FIELDS if field.name in names]
+
+
+def encode_rows(rows, using=DEFAULT_DB_ALIAS):
+    """
+    Return copies of row dicts with the text of every encoded column
+    replaced by its lookup id, keyed by the column's attname.
+    """
+    rows = [dict(row) for row in rows]
+    for field, name in ENCODED_NAMES.items():
+        if not any(name in row for row in rows):
+            continue
+        ids = dictionary_cache.encode(
+            field, [row.pop(name, None) for row in rows], using=using
+        )
+        for row, pk in zip(rows, ids):
+            row[field.attname] = pk
+    return rows
+
+
+def decode_rows(rows, using=DEFAULT_DB_ALIAS):
+    """
+    Replace the lookup ids of encoded columns in row dicts, as returned by
+    `.values(*stored_names(...))`, with their text under the column's
+    upload name, in place. Rows without an id keep the value of the text
+    column, if it was read.
+    """
+    for field, name in ENCODED_NAMES.items():
+        if not any(field.name in row for row in rows):
+            continue
+        values = dictionary_cache.decode(
+            field, [row.pop(field.name) for row in rows], using=using
+        )
+        for row, value in zip(rows, values):
+            row[name] = value if value is not None else row.get(name)
+    return rows
+
+
+def decoded_value(instance, name):
+    """
+    Text of the encoded column `name` of a CustomDutyFile, from the cache,
+    or from its text column if the row has not been encoded yet.
+    """
+    field = ENCODED_FIELDS_BY_NAME[name]
+    pk = getattr(instance, field.attname)
+    if pk is None:
+        return getattr(instance, name, None)
+    using = instance._state.db or DEFAULT_DB_ALIAS
+    return dictionary_cache.value(field, pk, using=using)
@@ -0,0 +1,75 @@
+import io
+
+from django.conf import settings
+
+from .dictionary import decode_rows, stored_names
+from .ingestion import batched, import_pyarrow
+from .models import CustomDutyFile
+from .validators import UPLOAD_FIELD_NAMES
+
+
+# Rows per row group of a Parquet export, also fetched per cursor round trip
+EXPORT_ROW_GROUP_SIZE = getattr(settings, "CUSTOM_DUTY_EXPORT_ROW_GROUP_SIZE", 50_000)
+
+# Column compression of Parquet exports
+EXPORT_COMPRESSION = getattr(settings, "CUSTOM_DUTY_EXPORT_COMPRESSION", "zstd")
+
+
+class _Sink(io.RawIOBase):
+    """
+    File object keeping what is written to it until it is drained, so a
+    Parquet file can be streamed while it is being written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_parquet_export(
+    queryset=None,
+    row_group_size=EXPORT_ROW_GROUP_SIZE,
+    compression=EXPORT_COMPRESSION,
+):
+    """
+    Yield CustomDutyFile rows as a Parquet file, in chunks for streaming.
+
+    Rows are read in primary key order through `iterator()`, which uses a
+    server-side cursor on PostgreSQL, and written one row group at a time,
+    so neither the result set nor the file is ever held in memory. The
+    columns are the upload fields, so an export can be uploaded again.
+    """
+    pa = import_pyarrow()
+    if queryset is None:
+        queryset = CustomDutyFile.objects.all()
+    schema = pa.schema([(name, pa.string()) for name in UPLOAD_FIELD_NAMES])
+    rows = (
+        queryset.order_by("pk")
+        .values(*stored_names(UPLOAD_FIELD_NAMES))
+        .iterator(chunk_size=row_group_size)
+    )
+
+    sink = _Sink()
+    with pa.parquet.ParquetWriter(sink, schema, compression=compression) as writer:
+        for chunk in batched(rows, row_group_size):
+            decode_rows(chunk, using=queryset.db)
+            writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+            yield sink.drain()
+    # The footer is written when the writer closes
+    yield sink.drain()
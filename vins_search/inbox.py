@@ -0,0 +1,249 @@
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+from .jobs import requeue_failed_job, run_job, worker_name
+from .models import CustomDutyFileUploads
+from .storage import file_sha256, get_upload_storage
+from .utils import get_file_type
+
+
+logger = logging.getLogger(__name__)
+
+# Drop directory polled by `manage.py ingest_watch`, relative to MEDIA_ROOT
+INBOX_DIR = getattr(settings, "CUSTOM_DUTY_INBOX_DIR", "inbox")
+
+# Sub-directories of the inbox a claimed file moves through
+CLAIMED_DIRS = ("processing", "done", "failed")
+
+# Statuses after which an inbox file has nothing left to wait for
+FINISHED_STATUSES = ("completed", "failed", "rolled_back")
+
+
+class Inbox:
+    """
+    A drop directory under MEDIA_ROOT whose files are ingested unattended.
+
+    New files are claimed by renaming them into `processing/`, which only
+    one watcher can do, and are moved with a JSON manifest into `done/` or
+    `failed/` once their CustomDutyFileUploads job finishes. Producers
+    should write files elsewhere and rename them into the inbox; names
+    starting with "." are never picked up.
+    """
+
+    def __init__(self, path=INBOX_DIR, storage=None):
+        self.storage = storage or get_upload_storage()
+        self.path = path
+        self.root = self.storage.path(path)
+        for name in CLAIMED_DIRS:
+            os.makedirs(os.path.join(self.root, name), exist_ok=True)
+
+    def subdir(self, name):
+        return os.path.join(self.root, name)
+
+    def relative(self, path):
+        """
+        Name of an inbox file in upload storage, as stored on the job.
+        """
+        return os.path.relpath(path, self.storage.location).replace(os.sep, "/")
+
+    def new_files(self, min_age=0):
+        """
+        Supported files waiting in the inbox, oldest first. Files modified in
+        the last `min_age` seconds may still be being written and are left.
+        """
+        cutoff = time.time() - min_age
+        files = []
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                if get_file_type(entry.name.lower()) is None:
+                    continue
+                modified = entry.stat().st_mtime
+                if modified <= cutoff:
+                    files.append((modified, entry.name))
+        return [name for _, name in sorted(files)]
+
+    def claim(self, name):
+        """
+        Move an inbox file into `processing/`, returning its new path, or
+        None if another watcher claimed it first.
+        """
+        claimed = f"{uuid.uuid4().hex[:12]}-{name}"
+        path = os.path.join(self.subdir("processing"), claimed)
+        try:
+            os.rename(os.path.join(self.root, name), path)
+        except FileNotFoundError:
+            return None
+        # Date the claim, so recovery can tell abandoned claims from slow ones
+        os.utime(path)
+        return path
+
+    def original_name(self, path):
+        return os.path.basename(path).split("-", 1)[1]
+
+    def finish(self, path, job=None, result=None):
+        """
+        Move a claimed file into `done/` or `failed/` next to a manifest of
+        its outcome, pointing its job at the new location.
+        """
+        result = job.result if job is not None else result
+        failed = job is None or job.status != "completed"
+        folder = os.path.join(self.path, "failed" if failed else "done")
+        name = self.storage.get_available_name(
+            os.path.join(folder, self.original_name(path))
+        )
+        destination = self.storage.path(name)
+        file_move_safe(path, destination)
+
+        manifest = {
+            "file_name": self.original_name(path),
+            "stored_as": name,
+            "status": "failed" if failed else "completed",
+            "result": result,
+        }
+        if job is not None:
+            job.file = name
+            job.save(update_fields=["file"])
+            manifest.update(
+                job_id=job.job_id,
+                content_hash=job.content_hash,
+                file_size=job.file_size,
+                mode=job.mode,
+                started_at=job.started_at,
+                finished_at=job.finished_at,
+            )
+        with open(f"{destination}.manifest.json", "w") as file:
+            json.dump(manifest, file, cls=DjangoJSONEncoder, indent=2)
+
+        logger.info("Inbox file %s moved to %s", manifest["file_name"], name)
+        return manifest
+
+    def ingest(self, path, mode="insert", tolerant=False, uploaded_by="ingest_watch"):
+        """
+        Record a claimed file as an upload, ingest it and file it away.
+        A file whose upload failed before is retried instead.
+        """
+        name = self.original_name(path)
+        content_hash = file_sha256(path)
+        started_at = now()
+        try:
+            with transaction.atomic():
+                job = CustomDutyFileUploads.objects.create(
+                    uploaded_by=uploaded_by,
+                    file_name=name,
+                    file=self.relative(path),
+                    file_type=get_file_type(name.lower()),
+                    file_size=os.path.getsize(path),
+                    content_hash=content_hash,
+                    mode=mode,
+                    tolerant=tolerant,
+                    source="inbox",
+                    status="processing",
+                    worker=worker_name(),
+                    attempts=1,
+                    started_at=started_at,
+                    heartbeat_at=started_at,
+                )
+        except IntegrityError:
+            # Identical content is never ingested twice, whatever its name
+            duplicate = CustomDutyFileUploads.objects.filter(
+                content_hash=content_hash
+            ).first()
+            if duplicate is not None and duplicate.status == "failed":
+                return self.retry(path, duplicate, mode, tolerant)
+            return self.finish(
+                path,
+                result={
+                    "error": "This file already exists.",
+                    "job_id": str(duplicate.job_id) if duplicate else None,
+                },
+            )
+
+        return self.finish(path, run_job(job))
+
+    def retry(self, path, job, mode, tolerant):
+        """
+        Queue a failed upload again as the data-upload API does, take it
+        over in the same transaction and ingest it from the claimed file.
+        It picks up after the last batch it committed.
+        """
+        try:
+            with transaction.atomic():
+                job = requeue_failed_job(job, mode, tolerant)
+                # Read from the claimed file, so recover() finds the job by it
+                job.file = self.relative(path)
+                job.source = "inbox"
+                job.status = "processing"
+                job.worker = worker_name()
+                job.attempts += 1
+                job.started_at = job.heartbeat_at = now()
+                job.save(
+                    update_fields=[
+                        "file",
+                        "source",
+                        "status",
+                        "worker",
+                        "attempts",
+                        "started_at",
+                        "heartbeat_at",
+                    ]
+                )
+        except ValueError as e:
+            return self.finish(path, result={"error": str(e), "job_id": str(job.job_id)})
+
+        return self.finish(path, run_job(job))
+
+    def resume(self, job):
+        """
+        Run a job again whose watcher died, then file it away. It picks
+        up after the last batch the dead watcher committed.
+        """
+        return self.finish(self.storage.path(job.file.name), run_job(job))
+
+    def recover(self, stale_after, skip=()):
+        """
+        Deal with files left in `processing/` by a stopped watcher, other
+        than the paths in `skip` this one is working on.
+
+        Files whose job has finished are filed away, files claimed without
+        a job go back to the inbox, and jobs with no heartbeat for
+        `stale_after` seconds are taken over and returned, to be resumed.
+        """
+        processing = self.subdir("processing")
+        cutoff = now() - timedelta(seconds=stale_after)
+        stale = []
+        for name in os.listdir(processing):
+            path = os.path.join(processing, name)
+            if path in skip:
+                continue
+            job = CustomDutyFileUploads.objects.filter(file=self.relative(path)).first()
+            if job is None:
+                if os.path.getmtime(path) < cutoff.timestamp():
+                    returned = self.storage.get_available_name(
+                        os.path.join(self.path, self.original_name(path))
+                    )
+                    os.rename(path, self.storage.path(returned))
+            elif job.status in FINISHED_STATUSES:
+                self.finish(path, job)
+            elif CustomDutyFileUploads.objects.filter(
+                pk=job.pk, status="processing", heartbeat_at__lt=cutoff
+            ).update(
+                worker=worker_name(),
+                attempts=F("attempts") + 1,
+                heartbeat_at=now(),
+            ):
+                job.refresh_from_db()
+                stale.append(job)
+        return stale
@@ -0,0 +1,752 @@
+import codecs
+import io
+import json
+import logging
+import time
+import xml.etree.ElementTree as ET
+from datetime import date, datetime, time as datetime_time
+from itertools import islice
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+from .dictionary import TEXT_FIELDS, decode_rows, encode_rows, stored_names
+from .models import CustomDutyFile, CustomDutyFileRevision
+from .validators import (
+    TYPED_FIELDS,
+    UPLOAD_FIELD_NAMES,
+    UPLOAD_FIELDS,
+    VIN_LOOKUP_CHUNK_SIZE,
+    SeenVins,
+    check_vins,
+    validate_fields,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Number of rows validated and inserted per transaction
+DEFAULT_BATCH_SIZE = getattr(settings, "CUSTOM_DUTY_INGEST_BATCH_SIZE", 10_000)
+
+# "auto" uses COPY on PostgreSQL and bulk_create everywhere else
+DEFAULT_ENGINE = getattr(settings, "CUSTOM_DUTY_INGEST_ENGINE", "auto")
+ENGINES = ("auto", "copy", "orm")
+
+# Where each CustomDutyFile field is read from in XML uploads. Every
+# `record_tag` element is one row; `fields` maps a child element name (or a
+# "parent/child" path, or "@attribute" of the record) to a model field.
+DEFAULT_XML_MAPPING = getattr(
+    settings,
+    "CUSTOM_DUTY_XML_MAPPING",
+    {"record_tag": "record", "fields": {name: name for name in UPLOAD_FIELD_NAMES}},
+)
+
+# "insert" rejects VINs that already exist, "merge" updates them in place
+MODES = ("insert", "merge", "replace")
+
+# Links every stored row to the upload that last wrote it
+LINEAGE_FIELD = CustomDutyFile._meta.get_field("upload")
+
+# Every column the batch writers fill in
+WRITE_FIELDS = UPLOAD_FIELDS + TYPED_FIELDS + [LINEAGE_FIELD]
+
+
+class IngestionStats:
+    """
+    Running counters for an ingestion, used to report throughput.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.quarantined = 0
+        self.started_at = time.perf_counter()
+
+    def add_batch(self, inserted, updated=0, unchanged=0, quarantined=0):
+        self.rows += inserted + updated + unchanged + quarantined
+        self.inserted += inserted
+        self.updated += updated
+        self.unchanged += unchanged
+        self.quarantined += quarantined
+        self.batches += 1
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "quarantined": self.quarantined,
+            "batches": self.batches,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(self.rows / elapsed) if elapsed else self.rows,
+        }
+
+
+def batched(rows, size):
+    """
+    Yield lists of at most `size` items from any iterable without reading ahead.
+    """
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_csv_frames(file, batch_size=DEFAULT_BATCH_SIZE, encoding="utf-8-sig"):
+    """
+    Yield the CSV upload as DataFrames of at most `batch_size` rows.
+
+    pandas reads the file incrementally, so only the current chunk is held
+    in memory no matter how large the upload is. Every cell is kept as text
+    and empty cells stay empty strings, as with csv.DictReader.
+    """
+    file.seek(0)
+    reader = pd.read_csv(
+        file,
+        dtype=str,
+        keep_default_na=False,
+        encoding=encoding,
+        chunksize=batch_size,
+    )
+    for frame in reader:
+        yield frame.fillna("")
+
+
+# Longest single JSON record accepted before the document is deemed invalid
+MAX_JSON_RECORD_SIZE = 1024 * 1024
+
+
+def iter_json_records(file, encoding="utf-8-sig", chunk_size=64 * 1024):
+    """
+    Yield the objects of a JSON upload one at a time.
+
+    Both a top-level array (`[{...}, {...}]`) and newline-delimited JSON
+    (one object per line) are accepted. The file is decoded chunk by chunk
+    and each record is parsed as soon as it is complete, so the document is
+    never materialized in full.
+    """
+    file.seek(0)
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    chunks = iter(lambda: file.read(chunk_size), b"")
+    buffer = ""
+    position = 0
+    at_eof = False
+
+    def fill():
+        # Drop consumed text and append the next decoded chunk
+        nonlocal buffer, position, at_eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            at_eof = True
+            buffer = buffer[position:] + text_decoder.decode(b"", final=True)
+        else:
+            buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+
+    def skip_whitespace():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer) or at_eof:
+                return
+            fill()
+
+    def next_value():
+        nonlocal position
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if at_eof or len(buffer) - position > MAX_JSON_RECORD_SIZE:
+                    raise
+                fill()
+                continue
+            # A value touching the end of the buffer may be cut short
+            if end == len(buffer) and not at_eof:
+                fill()
+                continue
+            position = end
+            return value
+
+    def record(value):
+        if not isinstance(value, dict):
+            raise json.JSONDecodeError("Expected a JSON object", buffer, position)
+        return value
+
+    skip_whitespace()
+    if position >= len(buffer):
+        return
+
+    if buffer[position] != "[":
+        # Newline-delimited (or simply concatenated) objects
+        while position < len(buffer):
+            yield record(next_value())
+            skip_whitespace()
+        return
+
+    position += 1
+    skip_whitespace()
+    if buffer.startswith("]", position):
+        return
+    while True:
+        yield record(next_value())
+        skip_whitespace()
+        if buffer.startswith("]", position):
+            return
+        if not buffer.startswith(",", position):
+            raise json.JSONDecodeError("Expected ',' or ']'", buffer, position)
+        position += 1
+        skip_whitespace()
+
+
+def _local_name(tag):
+    # Ignore XML namespaces when matching mapped element names
+    return tag.rsplit("}", 1)[-1]
+
+
+def _xml_value(element, path):
+    if path.startswith("@"):
+        return element.get(path[1:])
+    for name in path.split("/"):
+        element = next(
+            (child for child in element if _local_name(child.tag) == name), None
+        )
+        if element is None:
+            return None
+    return element.text
+
+
+def iter_xml_records(file, mapping=None):
+    """
+    Yield one row dict per record element of an XML upload.
+
+    The document is read with iterparse and every record is removed from
+    the tree once it has been mapped, so memory stays bounded by the size of
+    a single record whatever the size of the export.
+    """
+    mapping = mapping or DEFAULT_XML_MAPPING
+    record_tag = mapping["record_tag"]
+    fields = mapping["fields"]
+
+    file.seek(0)
+    open_elements = []
+    for event, element in ET.iterparse(file, events=("start", "end")):
+        if event == "start":
+            open_elements.append(element)
+            continue
+
+        open_elements.pop()
+        if _local_name(element.tag) != record_tag:
+            continue
+
+        yield {field: _xml_value(element, path) for path, field in fields.items()}
+
+        element.clear()
+        if open_elements:
+            open_elements[-1].remove(element)
+
+
+def _excel_value(value):
+    # Dates come back as datetime objects; store them the way they are typed
+    if isinstance(value, datetime):
+        if value.time() == datetime_time(0):
+            return value.date().isoformat()
+        return value.isoformat(sep=" ")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def iter_excel_rows(file, columns=UPLOAD_FIELD_NAMES, required=()):
+    """
+    Yield the rows of the first sheet of an .xlsx upload as dicts.
+
+    The workbook is opened in openpyxl's read-only mode, which streams the
+    sheet XML, and only the span of cells holding `columns` is read. The
+    first row is the header; fully empty rows are skipped.
+    """
+    file.seek(0)
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        header = next(sheet.iter_rows(max_row=1, values_only=True), ())
+        names = [str(name).strip() if name is not None else None for name in header]
+        for name in required:
+            if name not in names:
+                raise ValueError(f"The file must contain a '{name}' column.")
+
+        wanted = [(index, name) for index, name in enumerate(names) if name in columns]
+        if not wanted:
+            return
+        first, last = wanted[0][0], wanted[-1][0]
+
+        for values in sheet.iter_rows(
+            min_row=2, min_col=first + 1, max_col=last + 1, values_only=True
+        ):
+            row = {
+                name: _excel_value(values[index - first])
+                if index - first < len(values)
+                else None
+                for index, name in wanted
+            }
+            if any(value is not None for value in row.values()):
+                yield row
+    finally:
+        workbook.close()
+
+
+def import_pyarrow():
+    """
+    Return the pyarrow package, which Parquet files need.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("Parquet files need the pyarrow package to be installed.")
+    return pyarrow
+
+
+def parquet_columns(parquet_file):
+    """
+    Columns of a Parquet file that are CustomDutyFile upload fields.
+    """
+    names = set(parquet_file.schema_arrow.names)
+    return [name for name in UPLOAD_FIELD_NAMES if name in names]
+
+
+def parquet_frame(batch):
+    """
+    Convert an Arrow record batch of a Parquet upload to a DataFrame holding
+    the values a JSON upload would: integers, decimals and dates become
+    text, timestamps are written as in Excel uploads, and other types are
+    left for validation to reject.
+    """
+    pa = import_pyarrow()
+    columns = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        if pa.types.is_timestamp(column.type):
+            column = pa.array(
+                [_excel_value(value) for value in column.to_pylist()], pa.string()
+            )
+        elif (
+            pa.types.is_integer(column.type)
+            or pa.types.is_decimal(column.type)
+            or pa.types.is_date(column.type)
+        ):
+            column = column.cast(pa.string())
+        columns[name] = column.to_pandas()
+    return pd.DataFrame(columns, index=pd.RangeIndex(batch.num_rows))
+
+
+def iter_parquet_frames(file, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Yield a Parquet upload as DataFrames of at most `batch_size` rows.
+
+    Row groups are read one at a time and only the columns CustomDutyFile
+    stores are decoded, so other columns cost neither memory nor time.
+    """
+    pa = import_pyarrow()
+    file.seek(0)
+    parquet_file = pa.parquet.ParquetFile(file)
+    batches = parquet_file.iter_batches(
+        batch_size=batch_size, columns=parquet_columns(parquet_file)
+    )
+    for batch in batches:
+        yield parquet_frame(batch)
+
+
+def frames_from_rows(rows, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Group an iterable of row dicts into DataFrames for validation.
+
+    Columns are kept as objects: inferring dtypes would turn a column of
+    whole numbers with gaps into floats, storing 2019 as "2019.0".
+    """
+    for batch in batched(rows, batch_size):
+        yield pd.DataFrame(list(batch), dtype=object)
+
+
+def copy_supported(using=DEFAULT_DB_ALIAS):
+    """
+    COPY FROM STDIN is only available on PostgreSQL through psycopg2.
+    """
+    if connections[using].vendor != "postgresql":
+        return False
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+
+    return not is_psycopg3
+
+
+def _copy_value(value):
+    # In COPY's CSV format an unquoted empty field is NULL and a quoted one
+    # is an empty string, so every non-null value is quoted.
+    if value is None:
+        return ""
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def write_batch_orm(rows, using=DEFAULT_DB_ALIAS):
+    CustomDutyFile.objects.using(using).bulk_create(
+        [CustomDutyFile(**row) for row in encode_rows(rows, using=using)]
+    )
+
+
+def write_batch_copy(rows, using=DEFAULT_DB_ALIAS, table=None):
+    """
+    Load validated rows with a single COPY statement, into the live table
+    or the given one.
+    """
+    connection = connections[using]
+    fields = WRITE_FIELDS
+    buffer = io.StringIO()
+    for row in encode_rows(rows, using=using):
+        buffer.write(",".join(_copy_value(row.get(f.attname)) for f in fields))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    table = connection.ops.quote_name(table or CustomDutyFile._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(f.column) for f in fields)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+
+
+def get_batch_writer(engine=DEFAULT_ENGINE, using=DEFAULT_DB_ALIAS):
+    """
+    Return the function used to insert validated batches.
+
+    Asking for "copy" on a database without COPY support falls back to the
+    ORM so the same code path runs against SQLite in development.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown ingestion engine: {engine}")
+    if engine != "orm" and copy_supported(using):
+        return write_batch_copy
+    return write_batch_orm
+
+
+def split_changes(rows, using=DEFAULT_DB_ALIAS):
+    """
+    Compare validated rows with the stored rows sharing their VIN.
+
+    Returns the rows to insert, the rows whose values differ from what is
+    stored, the stored values of those changed rows (with the upload that
+    wrote them) and the number of rows that are already identical.
+    """
+    vins = [row["vin"] for row in rows if row["vin"] is not None]
+    stored = []
+    for start in range(0, len(vins), VIN_LOOKUP_CHUNK_SIZE):
+        chunk = vins[start : start + VIN_LOOKUP_CHUNK_SIZE]
+        stored.extend(
+            CustomDutyFile.objects.using(using)
+            .filter(vin__in=chunk)
+            .values(*stored_names(UPLOAD_FIELD_NAMES), LINEAGE_FIELD.attname)
+        )
+    stored = {existing["vin"]: existing for existing in decode_rows(stored, using=using)}
+
+    new, changed, previous, unchanged = [], [], [], 0
+    for row in rows:
+        existing = stored.get(row["vin"])
+        if existing is None:
+            new.append(row)
+        elif any(existing[name] != row[name] for name in UPLOAD_FIELD_NAMES):
+            changed.append(row)
+            previous.append(existing)
+        else:
+            unchanged += 1
+    return new, changed, previous, unchanged
+
+
+def write_batch_upsert(rows, using=DEFAULT_DB_ALIAS):
+    """
+    Insert rows, updating every column of rows whose VIN already exists.
+
+    Text columns left from before dictionary encoding are cleared, so they
+    cannot be read back in place of a value the upload set to null.
+    """
+    CustomDutyFile.objects.using(using).bulk_create(
+        [CustomDutyFile(**row) for row in encode_rows(rows, using=using)],
+        update_conflicts=True,
+        unique_fields=["vin"],
+        update_fields=[field.name for field in WRITE_FIELDS if field.name != "vin"]
+        + [field.name for field in TEXT_FIELDS],
+    )
+
+
+def write_isolating_failures(rows, write, using=DEFAULT_DB_ALIAS):
+    """
+    Write `rows` with `write`, bisecting the batch whenever the database
+    rejects it so that only the offending rows are left out.
+
+    Each attempt runs in its own savepoint. Returns `(index, reason)` for
+    every row that could not be written on its own.
+    """
+    try:
+        with transaction.atomic(using=using):
+            write(rows, using=using)
+        return []
+    except DatabaseError as e:
+        if len(rows) == 1:
+            return [(0, str(e))]
+
+    middle = len(rows) // 2
+    failed = write_isolating_failures(rows[:middle], write, using=using)
+    failed += [
+        (middle + index, reason)
+        for index, reason in write_isolating_failures(
+            rows[middle:], write, using=using
+        )
+    ]
+    return failed
+
+
+def ingest_validations(
+    validations,
+    label,
+    mode="insert",
+    engine=DEFAULT_ENGINE,
+    using=DEFAULT_DB_ALIAS,
+    on_batch=None,
+    on_invalid=None,
+    upload=None,
+    profile=None,
+    start_row=0,
+    checkpoint=None,
+):
+    """
+    Check VINs of field-validated batches and insert them into CustomDutyFile.
+
+    `validations` yields FrameValidation objects from `validate_fields`, one
+    per batch and in file order. VIN uniqueness is checked here, against the
+    database and the batches already written, and each batch is committed in
+    its own transaction, so only one batch is held in memory. Ingestion stops at the
+    first invalid row; the batches committed before it are kept and reported
+    in the stats.
+
+    In "merge" mode VINs that already exist are not errors: only rows that
+    are new or differ from the stored values are written, through an upsert
+    keyed on VIN, and identical rows are just counted. Rows need a VIN to
+    be merged, and a VIN repeated anywhere in the file is rejected as it is
+    within a batch; a resumed ingestion only compares the rows it reads.
+
+    In "replace" mode the file is a full refresh of the dataset: rows are
+    loaded into a staging table, which replaces the live rows in one short
+    transaction once every batch is in and the row counts check out, so
+    readers see either the old or the new dataset. Nothing changes if the
+    file is rejected.
+
+    Passing `on_invalid` makes ingestion tolerant: invalid rows are handed
+    to it, as dicts with their `row_number`, `data` and `errors`, and the
+    rest of the batch is committed. Batches the database rejects are
+    bisected down to the failing rows, which are reported the same way.
+
+    When `upload` is given every written row is linked to it, and in
+    "merge" mode the values it overwrites are kept as revisions, so the
+    upload can later be rolled back.
+
+    `on_batch`, if given, is called with the stats after every committed
+    batch so callers can report progress. Every batch read, including the
+    one ingestion stops at, is also added to `profile`, a DataProfile.
+
+    To resume an interrupted ingestion, `start_row` skips the rows its
+    committed batches covered; row numbers still count from the start of
+    the file. `checkpoint` is called with the stats inside every batch's
+    transaction, so what it records is committed together with the batch.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown ingestion mode: {mode}")
+    write_batch = get_batch_writer(engine, using)
+    if mode == "merge":
+        write_batch = write_batch_upsert
+    staging = None
+    if mode == "replace":
+        from .refresh import get_staging_table
+
+        staging = get_staging_table(using)
+        staging.create()
+        write_batch = staging.write_batch
+
+    # Merged rows overwrite stored ones, so a VIN repeated in a later batch
+    # has to be caught here rather than by the database
+    seen = SeenVins() if mode == "merge" else None
+    stats = IngestionStats()
+    if start_row:
+        validations = skip_rows(validations, start_row)
+    try:
+        for validation in validations:
+            first_row = start_row + stats.rows
+            if profile is not None:
+                profile.add(validation.frame)
+            validation = check_vins(
+                validation,
+                using=using,
+                check_existing=mode == "insert",
+                seen=seen,
+                require_vin=mode == "merge",
+            )
+            error = validation.first_error()
+            if error and on_invalid is None:
+                position, details = error
+                return {
+                    "error": f"Invalid data in {label}",
+                    "row": first_row + position + 1,
+                    "details": details,
+                    "stats": stats.as_dict(),
+                }
+
+            quarantined = []
+            if error:
+                positions = sorted(validation.errors)
+                invalid_rows = validation.frame.iloc[positions][
+                    UPLOAD_FIELD_NAMES
+                ].to_dict(orient="records")
+                for position, data in zip(positions, invalid_rows):
+                    quarantined.append(
+                        {
+                            "row_number": first_row + position + 1,
+                            "data": data,
+                            "errors": validation.errors[position],
+                        }
+                    )
+
+            custom_duties = validation.valid_records()
+            # Rows are tracked by identity to report the row number of failures
+            row_numbers = {
+                id(row): int(number)
+                for row, number in zip(
+                    custom_duties, np.flatnonzero(~validation.invalid) + first_row + 1
+                )
+            }
+            unchanged = 0
+            previous = []
+            if mode == "merge":
+                new, changed, previous, unchanged = split_changes(
+                    custom_duties, using=using
+                )
+                custom_duties = new + changed
+            else:
+                new, changed = custom_duties, []
+            if upload is not None:
+                for row in custom_duties:
+                    row[LINEAGE_FIELD.attname] = upload.pk
+
+            with transaction.atomic(using=using):
+                failed = []
+                if custom_duties and on_invalid is None:
+                    write_batch(custom_duties, using=using)
+                elif custom_duties:
+                    failed = write_isolating_failures(
+                        custom_duties, write_batch, using=using
+                    )
+
+                for index, reason in failed:
+                    row = custom_duties[index]
+                    quarantined.append(
+                        {
+                            "row_number": row_numbers[id(row)],
+                            "data": {name: row[name] for name in UPLOAD_FIELD_NAMES},
+                            "errors": {"non_field_errors": [reason]},
+                        }
+                    )
+                if quarantined:
+                    quarantined.sort(key=lambda row: row["row_number"])
+                    on_invalid(quarantined)
+
+                if upload is not None and previous:
+                    # Rows this upload already wrote keep their first revision
+                    failed_changed = {index - len(new) for index, _ in failed}
+                    CustomDutyFileRevision.objects.using(using).bulk_create(
+                        [
+                            CustomDutyFileRevision(
+                                upload=upload, vin=values["vin"], data=values
+                            )
+                            for index, values in enumerate(previous)
+                            if index not in failed_changed
+                            and values[LINEAGE_FIELD.attname] != upload.pk
+                        ]
+                    )
+
+                failed_new = sum(index < len(new) for index, _ in failed)
+                stats.add_batch(
+                    len(new) - failed_new,
+                    len(changed) - (len(failed) - failed_new),
+                    unchanged,
+                    len(quarantined),
+                )
+                if checkpoint:
+                    checkpoint(stats)
+
+            if on_batch:
+                on_batch(stats)
+            logger.info(
+                "%s ingestion: %s rows processed (%s rows/s)",
+                label,
+                stats.rows,
+                stats.as_dict()["rows_per_second"],
+            )
+
+        result = {
+            "message": f"{label} file processed successfully.",
+            "stats": stats.as_dict(),
+        }
+        if staging is not None:
+            try:
+                result["replaced_rows"] = staging.refresh(stats.inserted)
+            except ValueError as e:
+                return {
+                    "error": f"Invalid data in {label}",
+                    "details": str(e),
+                    "stats": stats.as_dict(),
+                }
+        return result
+    finally:
+        if staging is not None:
+            staging.drop()
+
+
+def skip_rows(validations, count):
+    """
+    Drop the first `count` rows from a stream of FrameValidations.
+    """
+    for validation in validations:
+        size = len(validation.frame)
+        if count >= size:
+            count -= size
+            continue
+        if count:
+            validation = validation.slice(count, size)
+            count = 0
+        yield validation
+
+
+def ingest_frames(frames, label, **options):
+    """
+    Validate and insert DataFrames of rows into CustomDutyFile.
+    """
+    validations = (validate_fields(frame) for frame in frames)
+    return ingest_validations(validations, label, **options)
+
+
+def ingest_rows(rows, label, batch_size=DEFAULT_BATCH_SIZE, **options):
+    """
+    Validate and insert an iterable of row dicts in bounded batches.
+    """
+    return ingest_frames(frames_from_rows(rows, batch_size), label, **options)
@@ -0,0 +1,312 @@
+import logging
+import os
+import socket
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from .models import CustomDutyFileUploads
+from .profiling import DataProfile
+from .quarantine import quarantine_writer
+from .rollback import rollback_upload
+from .utils import get_processor
+
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Status a job is queued with, and the status it has while a worker runs it
+QUEUED_STATUSES = {"pending": "processing", "rollback_pending": "rolling_back"}
+
+# Job counters carried over when an interrupted ingestion is resumed
+COUNTERS = {
+    "rows": "rows_processed",
+    "inserted": "rows_inserted",
+    "updated": "rows_updated",
+    "unchanged": "rows_unchanged",
+    "quarantined": "rows_quarantined",
+}
+
+
+def claim_next_job(worker=None):
+    """
+    Atomically take the oldest queued upload, to ingest or to roll back,
+    and mark it as running.
+
+    The row is locked with SELECT ... FOR UPDATE SKIP LOCKED, so any number
+    of workers can poll at once without two of them claiming the same job.
+    Returns None when there is nothing to do.
+    """
+    with transaction.atomic():
+        job = (
+            CustomDutyFileUploads.objects.select_for_update(skip_locked=True)
+            .filter(status__in=QUEUED_STATUSES)
+            .order_by("uploaded_at", "pk")
+            .first()
+        )
+        if job is None:
+            return None
+
+        job.status = QUEUED_STATUSES[job.status]
+        job.worker = worker or worker_name()
+        job.attempts += 1
+        job.started_at = job.heartbeat_at = now()
+        job.save(update_fields=["status", "worker", "attempts", "started_at", "heartbeat_at"])
+    return job
+
+
+def requeue_failed_job(job, mode, tolerant, file=None):
+    """
+    Queue a failed upload again because its file was sent again, with the
+    `mode` and `tolerant` options of the new upload. `file`, the name of
+    the newly stored copy, is kept only if the job has no file of its own.
+
+    The job picks up after the last batch it committed. Raises ValueError
+    if it is no longer failed, or if it wrote rows in another mode; such an
+    upload has to be rolled back before it is sent in a different mode.
+    """
+    with transaction.atomic():
+        job = CustomDutyFileUploads.objects.select_for_update().get(pk=job.pk)
+        if job.status != "failed":
+            raise ValueError(f"An upload that is {job.status} cannot be retried.")
+        if job.mode == "replace":
+            # A failed full refresh left the live rows as they were
+            for field in COUNTERS.values():
+                setattr(job, field, 0)
+        elif mode != job.mode and job.rows_processed:
+            raise ValueError(
+                f"This file failed in {job.mode} mode after writing rows; roll "
+                "the upload back to send it in another mode."
+            )
+        if not job.file:
+            job.file = file
+        job.mode = mode
+        job.tolerant = tolerant
+        job.status = "pending"
+        job.source = "api"
+        job.worker = None
+        job.save(
+            update_fields=[
+                *COUNTERS.values(),
+                "file",
+                "mode",
+                "tolerant",
+                "status",
+                "source",
+                "worker",
+            ]
+        )
+    return job
+
+
+def requeue_stale_jobs(stale_after):
+    """
+    Put back jobs whose worker stopped sending heartbeats, e.g. after a crash.
+
+    Ingestions started by import_duty_data or ingest_watch are left to
+    those commands, which resume their own jobs.
+    """
+    cutoff = now() - timedelta(seconds=stale_after)
+    requeued = 0
+    for queued, running in QUEUED_STATUSES.items():
+        stale = CustomDutyFileUploads.objects.filter(
+            status=running, heartbeat_at__lt=cutoff
+        )
+        if queued == "pending":
+            stale = stale.filter(source="api")
+        requeued += stale.update(status=queued, worker=None)
+    return requeued
+
+
+def resume_row(job):
+    """
+    Return the row after which a retried job picks up, or 0 to start over.
+
+    Every batch commits the job's counters in its own transaction, so the
+    rows counted are exactly the rows written. A full refresh loads into a
+    staging table that did not survive the interruption, and ZIP members
+    are ingested concurrently, so both start over.
+    """
+    if job.mode == "replace" or job.file_type == "zip":
+        return 0
+    return job.rows_processed
+
+
+def ingest_job(job, file, processor, **options):
+    """
+    Ingest `file` for a claimed job, recording progress and the outcome on
+    the job, and return the finished job.
+
+    A retried job resumes after the last batch an earlier attempt committed,
+    or, when it has to start over, first rolls back the rows that attempt
+    wrote. `options` are passed on to the processor.
+    """
+    start_row = resume_row(job)
+    if not start_row and job.attempts > 1 and job.mode != "replace":
+        rollback_upload(job)
+    base = {
+        key: getattr(job, field) if start_row else 0 for key, field in COUNTERS.items()
+    }
+
+    options.update(mode=job.mode, upload=job)
+    if job.tolerant:
+        # Rows quarantined by the batches being read again are quarantined again
+        job.quarantined_rows.filter(row_number__gt=start_row).delete()
+        options["on_invalid"] = quarantine_writer(job)
+    # A resumed job keeps the profile of the rows read before it stopped
+    profile = None if start_row else DataProfile()
+    if profile is not None:
+        options["profile"] = profile
+
+    def save_progress(stats):
+        # Archives track how much of the file their members have read
+        bytes_read = getattr(stats, "bytes_read", None)
+        progress = {
+            field: base[key] + getattr(stats, key) for key, field in COUNTERS.items()
+        }
+        if profile is not None:
+            progress["profile"] = profile.as_dict()
+        CustomDutyFileUploads.objects.filter(pk=job.pk).update(
+            bytes_processed=file.tell() if bytes_read is None else bytes_read,
+            heartbeat_at=now(),
+            **progress,
+        )
+
+    if job.file_type == "zip":
+        options["on_batch"] = save_progress
+    else:
+        options.update(start_row=start_row, checkpoint=save_progress)
+
+    try:
+        result = processor(file, **options)
+    except Exception as e:
+        logger.exception("Upload job %s failed", job.job_id)
+        result = {"error": f"An unexpected error occurred: {str(e)}"}
+
+    if start_row:
+        stats = result.get("stats")
+        if stats is not None:
+            for key in COUNTERS:
+                stats[key] = stats.get(key, 0) + base[key]
+        result["resumed_from_row"] = start_row
+    # Results without stats leave the counters as the last checkpoint saved them
+    job.refresh_from_db(fields=[*COUNTERS.values(), "bytes_processed"])
+    return finish_job(job, result, profile.as_dict() if profile else None)
+
+
+def run_job(job):
+    """
+    Ingest a claimed upload and record its progress and outcome on the row.
+    """
+    if job.status == "rolling_back":
+        return run_rollback(job)
+
+    processor = get_processor(job.file_type)
+    if processor is None:
+        return finish_job(job, {"error": f"Unsupported file type: {job.file_type}"})
+    if not job.file:
+        # Files imported with `manage.py import_duty_data` are not kept in storage
+        return finish_job(job, {"error": "The upload has no stored file to ingest."})
+
+    with job.file.open("rb") as file:
+        return ingest_job(job, file, processor)
+
+
+# Uploads whose rows can be rolled back
+ROLLBACK_STATUSES = ("completed", "failed")
+
+
+def check_rollback(job, statuses=ROLLBACK_STATUSES):
+    """
+    Raise ValueError if the rows of `job` cannot be rolled back.
+    """
+    if job.mode == "replace":
+        raise ValueError("A full refresh cannot be rolled back.")
+    if job.status not in statuses:
+        raise ValueError(f"An upload that is {job.status} cannot be rolled back.")
+
+
+def request_rollback(job_id):
+    """
+    Queue the rollback of an upload for the process_uploads workers.
+
+    Raises ValueError if it is not in a state that can be rolled back
+    (still queued or running, already rolled back, or a full refresh).
+    """
+    with transaction.atomic():
+        job = CustomDutyFileUploads.objects.select_for_update().get(job_id=job_id)
+        check_rollback(job)
+        job.status = "rollback_pending"
+        job.save(update_fields=["status"])
+    return job
+
+
+def run_rollback(job, **options):
+    """
+    Roll back a claimed upload, sending heartbeats after every chunk.
+
+    A failed rollback keeps its status and is picked up again once its
+    heartbeat goes stale; rollbacks resume where they stopped.
+    """
+
+    def heartbeat(counts):
+        CustomDutyFileUploads.objects.filter(pk=job.pk).update(heartbeat_at=now())
+
+    try:
+        counts = rollback_upload(job, on_chunk=heartbeat, **options)
+    except Exception as e:
+        logger.exception("Rollback of upload job %s failed", job.job_id)
+        job.result = {"error": f"Rollback failed: {str(e)}"}
+        job.save(update_fields=["result"])
+        return job
+
+    # The same file may be uploaded again once its rows are gone
+    job.status = "rolled_back"
+    job.processed_status = False
+    job.content_hash = None
+    job.result = {"message": "Upload rolled back.", **counts}
+    job.finished_at = now()
+    job.save(
+        update_fields=["status", "processed_status", "content_hash", "result", "finished_at"]
+    )
+    logger.info("Upload job %s rolled back", job.job_id)
+    return job
+
+
+def finish_job(job, result, profile=None):
+    stats = result.get("stats", {})
+    job.status = "failed" if "error" in result else "completed"
+    job.processed_status = job.status == "completed"
+    job.result = result
+    job.rows_processed = stats.get("rows", job.rows_processed)
+    job.rows_inserted = stats.get("inserted", job.rows_inserted)
+    job.rows_updated = stats.get("updated", job.rows_updated)
+    job.rows_unchanged = stats.get("unchanged", job.rows_unchanged)
+    job.rows_quarantined = stats.get("quarantined", job.rows_quarantined)
+    job.finished_at = now()
+    update_fields = [
+        "status",
+        "processed_status",
+        "result",
+        "rows_processed",
+        "rows_inserted",
+        "rows_updated",
+        "rows_unchanged",
+        "rows_quarantined",
+        "finished_at",
+    ]
+    if job.status == "completed":
+        job.bytes_processed = job.file_size
+        update_fields.append("bytes_processed")
+    if profile is not None:
+        job.profile = profile
+        update_fields.append("profile")
+    job.save(update_fields=update_fields)
+
+    logger.info("Upload job %s %s", job.job_id, job.status)
+    return job
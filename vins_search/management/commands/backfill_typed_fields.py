@@ -0,0 +1,82 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from vins_search.dictionary import decode_rows, stored_names
+from vins_search.models import CustomDutyFile
+from vins_search.validators import TYPED_FIELD_SOURCES
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill vehicle_year_value, sgd_date_value and is_unpaid from the "
+        "columns they are derived from, for rows stored before they existed. "
+        "Rows are walked in primary key order and updated in short "
+        "transactions, so it can run on a live database and be restarted "
+        "with --start-after."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Rows updated per transaction.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between chunks.",
+        )
+        parser.add_argument(
+            "--start-after",
+            type=int,
+            default=0,
+            help="Only process rows with a primary key above this one.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Re-parse every row, e.g. after changing CUSTOM_DUTY_SGD_DATE_FORMATS, "
+            "instead of only rows whose typed values are missing.",
+        )
+
+    def handle(self, *args, **options):
+        sources = [source for source, _ in TYPED_FIELD_SOURCES.values()]
+        queryset = CustomDutyFile.objects.all()
+        if not options["all"]:
+            missing = Q()
+            for name, source in zip(TYPED_FIELD_SOURCES, stored_names(sources)):
+                missing |= Q(**{f"{name}__isnull": True, f"{source}__isnull": False})
+            queryset = queryset.filter(missing)
+
+        last_pk = options["start_after"]
+        updated = 0
+        while True:
+            chunk = decode_rows(
+                list(
+                    queryset.filter(pk__gt=last_pk)
+                    .order_by("pk")
+                    .values("pk", *stored_names(sources))[: options["chunk_size"]]
+                )
+            )
+            if not chunk:
+                break
+
+            rows = [CustomDutyFile(pk=values["pk"]) for values in chunk]
+            for name, (source, parse) in TYPED_FIELD_SOURCES.items():
+                parsed = parse([values[source] for values in chunk])
+                for row, value in zip(rows, parsed):
+                    setattr(row, name, value)
+            with transaction.atomic():
+                CustomDutyFile.objects.bulk_update(rows, list(TYPED_FIELD_SOURCES))
+
+            last_pk = chunk[-1]["pk"]
+            updated += len(rows)
+            self.stdout.write(f"{updated} rows backfilled (last id {last_pk})")
+            time.sleep(options["pause"])
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {updated} rows."))
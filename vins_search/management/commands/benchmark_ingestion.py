@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from vins_search.ingestion import (
+    batched,
+    copy_supported,
+    write_batch_copy,
+    write_batch_orm,
+)
+from vins_search.synthetic import synthetic_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare insert throughput of the bulk_create and COPY ingestion "
+        "writers on synthetic CustomDutyFile rows. Every run is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        writers = [("bulk_create", write_batch_orm)]
+        if copy_supported():
+            writers.append(("copy", write_batch_copy))
+        else:
+            self.stdout.write(
+                self.style.WARNING("COPY is not available on this database, skipping it.")
+            )
+
+        for name, write_batch in writers:
+            rows = synthetic_rows(options["rows"], seed=options["seed"])
+            with transaction.atomic():
+                started_at = time.perf_counter()
+                for batch in batched(rows, options["batch_size"]):
+                    write_batch(batch)
+                elapsed = time.perf_counter() - started_at
+                transaction.set_rollback(True)
+
+            self.stdout.write(
+                f"{name:<12} {options['rows']:>10} rows  {elapsed:8.2f}s  "
+                f"{options['rows'] / elapsed:>10.0f} rows/s"
+            )
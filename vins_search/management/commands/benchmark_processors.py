@@ -0,0 +1,269 @@
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.timezone import now
+
+from vins_search.ingestion import DEFAULT_BATCH_SIZE, ENGINES
+from vins_search.models import CustomDutyFile, CustomDutyFileUploads
+from vins_search.parallel import DEFAULT_WORKERS
+from vins_search.synthetic import FILE_WRITERS, synthetic_rows
+from vins_search.utils import FILE_PROCESSORS, PARALLEL_FILE_TYPES, get_file_type
+
+
+DEFAULT_SIZES = "10k,100k,1M"
+DEFAULT_FORMATS = "csv,xlsx,json,xml"
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+MAXRSS_PER_MB = 1024 * 1024 if sys.platform == "darwin" else 1024
+
+
+def parse_size(value):
+    """
+    Read a row count such as "10000", "100k" or "1M".
+    """
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1:], 1)
+    if multiplier > 1:
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    return round(resource.getrusage(who).ru_maxrss / MAXRSS_PER_MB, 1)
+
+
+def generate_file(directory, extension, rows, seed):
+    """
+    Write a synthetic upload file, or reuse the one an earlier run wrote.
+    """
+    path = os.path.join(directory, f"custom-duty-{rows}-{seed}.{extension}")
+    if not os.path.exists(path):
+        partial = f"{path}.partial"
+        with open(partial, "wb") as file:
+            FILE_WRITERS[extension](synthetic_rows(rows, seed=seed), file)
+        os.replace(partial, path)
+    return path
+
+
+def run_case(path, options, pipe):
+    """
+    Ingest one file and send its measurements through `pipe`.
+
+    Runs in a forked process, so its peak RSS is its own. The rows are
+    linked to a throwaway upload and deleted afterwards.
+    """
+    using = options["database"]
+    try:
+        baseline = peak_rss_mb()
+        file_type = get_file_type(path)
+        processor_options = {
+            "batch_size": options["batch_size"],
+            "engine": options["engine"],
+            "using": using,
+        }
+        if file_type in PARALLEL_FILE_TYPES:
+            processor_options["workers"] = options["workers"]
+
+        job = CustomDutyFileUploads.objects.using(using).create(
+            uploaded_by="benchmark_processors",
+            file_name=os.path.basename(path),
+            file_type=file_type,
+            file_size=os.path.getsize(path),
+            status="processing",
+        )
+        try:
+            started = time.perf_counter()
+            with open(path, "rb") as file:
+                result = FILE_PROCESSORS[file_type](
+                    file, upload=job, **processor_options
+                )
+            seconds = time.perf_counter() - started
+            peak = peak_rss_mb()
+            children_peak = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        finally:
+            connection = connections[using]
+            quote = connection.ops.quote_name
+            field = CustomDutyFile._meta.get_field("upload")
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {quote(CustomDutyFile._meta.db_table)} "
+                    f"WHERE {quote(field.column)} = %s",
+                    [job.pk],
+                )
+            job.delete()
+
+        rows = result.get("stats", {}).get("rows", 0)
+        pipe.send(
+            {
+                "seconds": round(seconds, 3),
+                "rows_ingested": rows,
+                "rows_per_second": round(rows / seconds) if seconds else rows,
+                "mb_per_second": round(os.path.getsize(path) / seconds / 1e6, 2),
+                "peak_rss_mb": peak,
+                "rss_growth_mb": round(peak - baseline, 1),
+                "workers_peak_rss_mb": children_peak or None,
+                "error": result.get("error"),
+                "details": result.get("details"),
+            }
+        )
+    except Exception as e:
+        pipe.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the upload processors end to end on seeded synthetic "
+        "custom duty files in each format and size, reporting rows/s and "
+        "peak RSS and writing the results to JSON. Each file is ingested in "
+        "a fresh process against the configured database (run once per "
+        "DATABASE_URL to compare SQLite and PostgreSQL) and its rows are "
+        "deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default=DEFAULT_SIZES,
+            help="Comma-separated row counts, e.g. 10k,100k,1M.",
+        )
+        parser.add_argument(
+            "--formats",
+            default=DEFAULT_FORMATS,
+            help=f"Comma-separated file formats out of {', '.join(FILE_WRITERS)}.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help="Parsing processes for CSV, Excel and Parquet files.",
+        )
+        parser.add_argument("--engine", choices=ENGINES, default="auto")
+        parser.add_argument("--database", default=DEFAULT_DB_ALIAS)
+        parser.add_argument(
+            "--data-dir",
+            default=os.path.join(tempfile.gettempdir(), "cvms_benchmark"),
+            help="Where generated files are kept and reused between runs.",
+        )
+        parser.add_argument(
+            "--output",
+            help="JSON file for the results; by default "
+            "ingestion-benchmark-<vendor>-<timestamp>.json.",
+        )
+        parser.add_argument(
+            "--compare",
+            help="Results JSON of an earlier run to print the change against.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [parse_size(size) for size in options["sizes"].split(",")]
+        except ValueError:
+            raise CommandError(f"Invalid --sizes: {options['sizes']}")
+        formats = [name.strip() for name in options["formats"].split(",")]
+        unknown = set(formats) - set(FILE_WRITERS)
+        if unknown:
+            raise CommandError(f"Unknown formats: {', '.join(sorted(unknown))}")
+        previous = {}
+        if options["compare"]:
+            with open(options["compare"]) as file:
+                previous = {
+                    (result["format"], result["rows"]): result
+                    for result in json.load(file)["results"]
+                }
+
+        os.makedirs(options["data_dir"], exist_ok=True)
+        connection = connections[options["database"]]
+        started_at = now()
+        results = []
+        self.stdout.write(
+            f"{'format':<9}{'rows':>11}{'MB':>9}{'seconds':>10}{'rows/s':>10}"
+            f"{'MB/s':>8}{'peak RSS MB':>13}{'change':>9}"
+        )
+        for rows in sizes:
+            for extension in formats:
+                path = generate_file(
+                    options["data_dir"], extension, rows, options["seed"]
+                )
+                # The forked process must not share this one's connections
+                connections.close_all()
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.get_context("fork").Process(
+                    target=run_case, args=(path, options, sender)
+                )
+                process.start()
+                sender.close()
+                try:
+                    measurements = receiver.recv()
+                except EOFError:
+                    measurements = {"error": f"exited with code {process.exitcode}"}
+                process.join()
+
+                result = {
+                    "format": extension,
+                    "rows": rows,
+                    "file_bytes": os.path.getsize(path),
+                    **measurements,
+                }
+                results.append(result)
+                self.report(result, previous.get((extension, rows)))
+
+        output = options["output"] or (
+            f"ingestion-benchmark-{connection.vendor}-"
+            f"{started_at.strftime('%Y%m%d-%H%M%S')}.json"
+        )
+        with open(output, "w") as file:
+            json.dump(
+                {
+                    "started_at": started_at.isoformat(),
+                    "database": {
+                        "alias": options["database"],
+                        "vendor": connection.vendor,
+                    },
+                    "batch_size": options["batch_size"],
+                    "workers": options["workers"],
+                    "engine": options["engine"],
+                    "seed": options["seed"],
+                    "python": platform.python_version(),
+                    "django": django.get_version(),
+                    "platform": platform.platform(),
+                    "cpus": os.cpu_count(),
+                    "results": results,
+                },
+                file,
+                indent=2,
+            )
+        self.stdout.write(self.style.SUCCESS(f"Results written to {output}"))
+
+    def report(self, result, previous=None):
+        if "seconds" not in result or result.get("error"):
+            self.stdout.write(
+                self.style.ERROR(
+                    f"{result['format']:<9}{result['rows']:>11,}  "
+                    f"{result.get('error')} {result.get('details') or ''}"
+                )
+            )
+            return
+        change = ""
+        if previous and previous.get("rows_per_second"):
+            change = (
+                f"{(result['rows_per_second'] / previous['rows_per_second'] - 1) * 100:+.1f}%"
+            )
+        self.stdout.write(
+            f"{result['format']:<9}{result['rows']:>11,}"
+            f"{result['file_bytes'] / 1e6:>9.1f}{result['seconds']:>10.2f}"
+            f"{result['rows_per_second']:>10,}{result['mb_per_second']:>8.2f}"
+            f"{result['peak_rss_mb']:>13.1f}{change:>9}"
+        )
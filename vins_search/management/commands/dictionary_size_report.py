@@ -0,0 +1,170 @@
+from django.apps.registry import Apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+
+from vins_search.dictionary import ENCODED_FIELDS, ENCODED_NAMES, TEXT_FIELDS
+from vins_search.ingestion import ingest_rows
+from vins_search.models import CustomDutyFile
+from vins_search.synthetic import synthetic_rows
+
+
+def plain_model():
+    """
+    Build an unmanaged copy of CustomDutyFile that stores the encoded
+    columns as text, with the same indexes, to measure against. Text
+    columns not dropped yet are left out of it.
+    """
+    attrs = {"__module__": __name__}
+    for field in CustomDutyFile._meta.concrete_fields:
+        if field.primary_key or field in TEXT_FIELDS:
+            continue
+        if field in ENCODED_FIELDS:
+            max_length = field.related_model._meta.get_field("value").max_length
+            attrs[ENCODED_NAMES[field]] = models.CharField(
+                max_length=max_length, blank=True, null=True
+            )
+        elif field.is_relation:
+            attrs[field.attname] = models.BigIntegerField(
+                db_index=field.db_index, blank=True, null=True
+            )
+        else:
+            attrs[field.name] = field.clone()
+
+    text_names = {field.name: name for field, name in ENCODED_NAMES.items()}
+    indexes = []
+    for index in CustomDutyFile._meta.indexes:
+        _, args, kwargs = index.deconstruct()
+        kwargs["name"] = f"plain_{index.name}"[:30]
+        if "fields" in kwargs:
+            kwargs["fields"] = [text_names.get(name, name) for name in kwargs["fields"]]
+        indexes.append(type(index)(*args, **kwargs))
+    attrs["Meta"] = type(
+        "Meta",
+        (),
+        {
+            "app_label": "vins_search",
+            "apps": Apps(),
+            "db_table": f"{CustomDutyFile._meta.db_table}_plain",
+            "indexes": indexes,
+        },
+    )
+    return type("PlainCustomDutyFile", (models.Model,), attrs)
+
+
+def relation_sizes(table):
+    """
+    Return the bytes used by `table` and by its indexes.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT pg_table_size(%s::regclass), pg_indexes_size(%s::regclass)",
+                [table, table],
+            )
+            return cursor.fetchone()
+        cursor.execute(
+            "SELECT name = %s, SUM(pgsize) FROM dbstat WHERE name IN "
+            "(SELECT name FROM sqlite_master WHERE tbl_name = %s) GROUP BY name = %s",
+            [table, table, table],
+        )
+        sizes = dict(cursor.fetchall())
+        return sizes.get(1, 0), sizes.get(0, 0)
+
+
+class Command(BaseCommand):
+    help = (
+        "Report how much smaller the custom duty table and its indexes are "
+        "with dictionary-encoded columns than with the same values stored as "
+        "text. Synthetic rows are loaded for the comparison and everything is "
+        "rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            default=100_000,
+            help="Synthetic rows added for the comparison; 0 measures the "
+            "stored rows only.",
+        )
+        parser.add_argument("--batch-size", type=int, default=10_000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ("postgresql", "sqlite"):
+            raise CommandError(
+                "Table sizes can only be measured on PostgreSQL or SQLite."
+            )
+
+        live = CustomDutyFile._meta.db_table
+        plain = plain_model()
+        plain_table_name = plain._meta.db_table
+        quote = connection.ops.quote_name
+
+        # Copy every row, joining the encoded columns back to their text
+        columns, values, joins = [], [], []
+        for field in CustomDutyFile._meta.concrete_fields:
+            if field.primary_key or field in TEXT_FIELDS:
+                continue
+            if field in ENCODED_FIELDS:
+                alias = quote(f"lookup_{field.name}")
+                columns.append(quote(ENCODED_NAMES[field]))
+                values.append(f"{alias}.{quote('value')}")
+                joins.append(
+                    f"LEFT JOIN {quote(field.related_model._meta.db_table)} {alias} "
+                    f"ON {alias}.{quote('id')} = live.{quote(field.column)}"
+                )
+            else:
+                columns.append(quote(field.column))
+                values.append(f"live.{quote(field.column)}")
+
+        # SQLite cannot change its schema inside a transaction
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(plain)
+        try:
+            with transaction.atomic():
+                if options["rows"]:
+                    result = ingest_rows(
+                        synthetic_rows(options["rows"], seed=options["seed"]),
+                        "Synthetic",
+                        batch_size=options["batch_size"],
+                    )
+                    if "error" in result:
+                        raise CommandError(result["details"])
+
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"INSERT INTO {quote(plain_table_name)} ({', '.join(columns)}) "
+                        f"SELECT {', '.join(values)} FROM {quote(live)} live "
+                        + " ".join(joins)
+                    )
+                    row_count = cursor.rowcount
+                    if connection.vendor == "postgresql":
+                        cursor.execute(f"ANALYZE {quote(live)}")
+                        cursor.execute(f"ANALYZE {quote(plain_table_name)}")
+
+                encoded_table, encoded_indexes = relation_sizes(live)
+                plain_table, plain_indexes = relation_sizes(plain_table_name)
+                lookups = sum(
+                    sum(relation_sizes(field.related_model._meta.db_table))
+                    for field in ENCODED_FIELDS
+                )
+                transaction.set_rollback(True)
+        finally:
+            with connection.schema_editor() as schema_editor:
+                schema_editor.delete_model(plain)
+
+        self.stdout.write(f"{row_count} rows")
+        self.stdout.write(f"{'':<16}{'text':>14}{'encoded':>14}{'saved':>9}")
+        for name, before, after in (
+            ("table", plain_table, encoded_table),
+            ("indexes", plain_indexes, encoded_indexes),
+            ("lookup tables", 0, lookups),
+            (
+                "total",
+                plain_table + plain_indexes,
+                encoded_table + encoded_indexes + lookups,
+            ),
+        ):
+            saved = f"{(before - after) * 100 / before:.1f}%" if before else ""
+            self.stdout.write(f"{name:<16}{before:>14,}{after:>14,}{saved:>9}")
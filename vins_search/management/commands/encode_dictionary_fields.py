@@ -0,0 +1,109 @@
+"""
+Move CustomDutyFile from text columns to dictionary-encoded ones without
+altering a column in place, which would fail or lose data:
+
+1. Deploy, then run makemigrations and migrate. This only adds the lookup
+   tables and the nullable *_ref columns next to the text columns. From
+   then on uploads write lookup ids, and rows stored before are read from
+   their text columns until step 2 has reached them.
+2. Run this command, then backfill_typed_fields so is_unpaid is derived
+   from the encoded payment_status. Both can run on a live database.
+3. Once this command reports every row encoded, delete the text fields at
+   the end of CustomDutyFile, then run makemigrations and migrate to drop
+   their columns.
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from vins_search.dictionary import ENCODED_FIELDS_BY_NAME, TEXT_FIELDS, dictionary_cache
+from vins_search.models import CustomDutyFile
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the lookup tables and the *_ref ids of brand, engine_type, "
+        "vehicle_type, origin_country, office_cod and payment_status from "
+        "the text columns they replace, for rows stored before the encoded "
+        "columns existed. Ids already set are kept. Rows are walked in "
+        "primary key order and updated in short transactions, so it can run "
+        "on a live database and be restarted with --start-after."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=5000,
+            help="Rows updated per transaction.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between chunks.",
+        )
+        parser.add_argument(
+            "--start-after",
+            type=int,
+            default=0,
+            help="Only process rows with a primary key above this one.",
+        )
+
+    def handle(self, *args, **options):
+        if not TEXT_FIELDS:
+            raise CommandError("The text columns have already been dropped.")
+        pairs = [(field, ENCODED_FIELDS_BY_NAME[field.name]) for field in TEXT_FIELDS]
+        missing = Q()
+        for text, encoded in pairs:
+            missing |= Q(**{f"{encoded.name}__isnull": True, f"{text.name}__isnull": False})
+        queryset = CustomDutyFile.objects.filter(missing).only(
+            *[field.name for pair in pairs for field in pair]
+        )
+
+        last_pk = options["start_after"]
+        encoded_rows = 0
+        while True:
+            with transaction.atomic():
+                # Locked so an upload cannot write ids between read and update
+                chunk = list(
+                    queryset.select_for_update()
+                    .filter(pk__gt=last_pk)
+                    .order_by("pk")[: options["chunk_size"]]
+                )
+                if not chunk:
+                    break
+                for text, encoded in pairs:
+                    rows = [
+                        row
+                        for row in chunk
+                        if getattr(row, encoded.attname) is None
+                        and getattr(row, text.attname) is not None
+                    ]
+                    ids = dictionary_cache.encode(
+                        encoded, [getattr(row, text.attname) for row in rows]
+                    )
+                    for row, pk in zip(rows, ids):
+                        setattr(row, encoded.attname, pk)
+                CustomDutyFile.objects.bulk_update(
+                    chunk, [encoded.name for _, encoded in pairs]
+                )
+
+            last_pk = chunk[-1].pk
+            encoded_rows += len(chunk)
+            self.stdout.write(f"{encoded_rows} rows encoded (last id {last_pk})")
+            time.sleep(options["pause"])
+
+        self.stdout.write(self.style.SUCCESS(f"Encoded {encoded_rows} rows."))
+        if queryset.exists():
+            self.stdout.write(
+                self.style.WARNING(
+                    "Rows at or below --start-after are still not encoded."
+                )
+            )
+        else:
+            self.stdout.write(
+                "Every row is encoded; the text columns can now be dropped."
+            )
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from vins_search.export import (
+    EXPORT_COMPRESSION,
+    EXPORT_ROW_GROUP_SIZE,
+    iter_parquet_export,
+)
+from vins_search.ingestion import import_pyarrow
+
+
+class Command(BaseCommand):
+    help = (
+        "Export the custom duty table to a Parquet file with the upload "
+        "columns, reading it through a server-side cursor one row group at a "
+        "time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Parquet file to write.")
+        parser.add_argument(
+            "--row-group-size",
+            type=int,
+            default=EXPORT_ROW_GROUP_SIZE,
+            help="Rows per row group.",
+        )
+        parser.add_argument(
+            "--compression",
+            default=EXPORT_COMPRESSION,
+            help="Parquet column compression, e.g. zstd, snappy or none.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            import_pyarrow()
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        size = 0
+        with open(options["path"], "wb") as file:
+            for chunk in iter_parquet_export(
+                row_group_size=options["row_group_size"],
+                compression=options["compression"],
+            ):
+                file.write(chunk)
+                size += len(chunk)
+        self.stdout.write(
+            self.style.SUCCESS(f"Wrote {size:,} bytes to {options['path']}.")
+        )
@@ -0,0 +1,205 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from vins_search.ingestion import DEFAULT_BATCH_SIZE, MODES
+from vins_search.jobs import COUNTERS, ingest_job, resume_row, worker_name
+from vins_search.models import CustomDutyFileUploads
+from vins_search.parallel import DEFAULT_WORKERS
+from vins_search.storage import file_sha256
+from vins_search.utils import PARALLEL_FILE_TYPES, get_file_type, get_processor
+
+
+class Command(BaseCommand):
+    help = (
+        "Import CSV, Excel, JSON, XML or Parquet files (optionally .gz, .bz2 or "
+        ".zip compressed) straight from disk with the upload ingestion engine. "
+        "Each file is recorded as a CustomDutyFileUploads job, identified by "
+        "its SHA-256, whose row counters are committed with every batch: "
+        "running the command again skips imported files and resumes an "
+        "interrupted one after its last committed batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="+", help="Files to import, in order.")
+        parser.add_argument(
+            "--mode",
+            choices=MODES,
+            default="insert",
+            help="Ingestion mode; replace takes a single file.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=DEFAULT_WORKERS,
+            help="Processes parsing and validating each CSV, Excel or Parquet "
+            "file, or members of a ZIP archive ingested at once.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help="Rows validated and committed per transaction.",
+        )
+        parser.add_argument(
+            "--tolerant",
+            action="store_true",
+            help="Quarantine invalid rows instead of stopping at them.",
+        )
+        parser.add_argument(
+            "--uploaded-by",
+            default="import_duty_data",
+            help="Recorded as uploaded_by on the jobs.",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=600,
+            help="Resume a processing job only once it has sent no heartbeat "
+            "for this many seconds, in case another import is running it.",
+        )
+
+    def handle(self, *args, **options):
+        if options["mode"] == "replace" and len(options["paths"]) > 1:
+            raise CommandError("A full refresh (--mode replace) takes a single file.")
+        for path in options["paths"]:
+            if not os.path.isfile(path):
+                raise CommandError(f"{path} does not exist.")
+            if get_file_type(os.path.basename(path).lower()) is None:
+                raise CommandError(f"{path} is not a supported file type.")
+
+        summary = []
+        try:
+            for path in options["paths"]:
+                job, line = self.import_file(path, options)
+                if line is not None:
+                    summary.append(line)
+                if job.status != "completed":
+                    raise CommandError(
+                        f"{path}: {job.result.get('error')} "
+                        f"{job.result.get('details', '')}".strip()
+                    )
+        finally:
+            self.report(summary)
+
+    def get_job(self, path, options):
+        """
+        Return the job recording `path`, creating it, and whether the file
+        was fully imported before.
+        """
+        content_hash = file_sha256(path)
+        job = CustomDutyFileUploads.objects.filter(content_hash=content_hash).first()
+        if job is None:
+            started_at = now()
+            job = CustomDutyFileUploads.objects.create(
+                uploaded_by=options["uploaded_by"],
+                file_name=os.path.basename(path),
+                file_type=get_file_type(os.path.basename(path).lower()),
+                file_size=os.path.getsize(path),
+                content_hash=content_hash,
+                mode=options["mode"],
+                tolerant=options["tolerant"],
+                source="import",
+                status="processing",
+                worker=worker_name(),
+                attempts=1,
+                started_at=started_at,
+                heartbeat_at=started_at,
+            )
+            return job, False
+
+        if job.status == "completed":
+            return job, True
+        if job.status not in ("processing", "failed"):
+            raise CommandError(
+                f"{path} is upload {job.job_id}, which is {job.status}."
+            )
+        if job.mode != options["mode"] or job.tolerant != options["tolerant"]:
+            raise CommandError(
+                f"{path} was started as upload {job.job_id} in {job.mode} mode"
+                f"{', tolerant' if job.tolerant else ''}; resume it with the "
+                "same options."
+            )
+        cutoff = now() - timedelta(seconds=options["stale_after"])
+        claimed = CustomDutyFileUploads.objects.filter(pk=job.pk).exclude(
+            status="processing", heartbeat_at__gte=cutoff
+        ).update(
+            # A failed upload or inbox job is now this command's to resume
+            source="import",
+            status="processing",
+            worker=worker_name(),
+            attempts=job.attempts + 1,
+            heartbeat_at=now(),
+        )
+        if not claimed:
+            raise CommandError(
+                f"{path} is being imported by {job.worker} (upload {job.job_id})."
+            )
+        job.refresh_from_db()
+        return job, False
+
+    def import_file(self, path, options):
+        job, imported = self.get_job(path, options)
+        if imported:
+            self.stdout.write(f"{path}: already imported as upload {job.job_id}")
+            return job, None
+
+        start_row = resume_row(job)
+        if start_row:
+            self.stdout.write(f"{path}: resuming after row {start_row:,}")
+        before = {
+            key: getattr(job, field) if start_row else 0
+            for key, field in COUNTERS.items()
+        }
+
+        processor_options = {"batch_size": options["batch_size"]}
+        if job.file_type in PARALLEL_FILE_TYPES:
+            processor_options["workers"] = options["workers"]
+
+        started = time.perf_counter()
+        with open(path, "rb") as file:
+            job = ingest_job(
+                job, file, get_processor(job.file_type), **processor_options
+            )
+        elapsed = time.perf_counter() - started
+
+        line = {
+            "path": path,
+            "status": job.status,
+            **{
+                key: getattr(job, field) - before[key]
+                for key, field in COUNTERS.items()
+            },
+            "bytes": job.file_size,
+            "seconds": elapsed,
+        }
+        self.stdout.write(
+            f"{path}: {job.status}, {line['rows']:,} rows in {elapsed:.1f}s "
+            f"({line['rows'] / elapsed if elapsed else line['rows']:,.0f} rows/s)"
+        )
+        return job, line
+
+    def report(self, summary):
+        if not summary:
+            return
+        total = {
+            key: sum(line[key] for line in summary)
+            for key in (*COUNTERS, "bytes", "seconds")
+        }
+        self.stdout.write("")
+        self.stdout.write(
+            f"{'file':<40}{'rows':>14}{'inserted':>14}{'updated':>12}"
+            f"{'unchanged':>12}{'quarantined':>13}{'rows/s':>10}{'MB/s':>8}"
+        )
+        for line in summary + [dict(total, path="total")]:
+            seconds = line["seconds"] or 1e-9
+            self.stdout.write(
+                f"{os.path.basename(line['path'])[-40:]:<40}{line['rows']:>14,}"
+                f"{line['inserted']:>14,}{line['updated']:>12,}"
+                f"{line['unchanged']:>12,}{line['quarantined']:>13,}"
+                f"{line['rows'] / seconds:>10,.0f}"
+                f"{line['bytes'] / seconds / 1e6:>8.1f}"
+            )
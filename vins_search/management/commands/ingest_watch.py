@@ -0,0 +1,159 @@
+import logging
+import signal
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections
+
+from vins_search.inbox import INBOX_DIR, Inbox
+from vins_search.ingestion import MODES
+
+
+logger = logging.getLogger(__name__)
+
+
+def in_thread(function, *args, **kwargs):
+    # Every pool thread has its own connection, closed when its file is done
+    try:
+        return function(*args, **kwargs)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        "Watch a drop directory under MEDIA_ROOT and ingest the CSV, Excel, "
+        "JSON, XML and Parquet files placed in it, plain or .gz, .bz2 or .zip "
+        "compressed. Each file is claimed by renaming it into processing/, "
+        "recorded as a CustomDutyFileUploads job, and moved with a result "
+        "manifest into done/ or failed/. Several watchers may share one inbox."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--inbox",
+            default=INBOX_DIR,
+            help="Inbox directory, relative to MEDIA_ROOT.",
+        )
+        parser.add_argument(
+            "--mode",
+            choices=MODES,
+            default="insert",
+            help="Ingestion mode for every file.",
+        )
+        parser.add_argument(
+            "--tolerant",
+            action="store_true",
+            help="Quarantine invalid rows instead of failing the file.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=2,
+            help="Files ingested at the same time.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5,
+            help="Seconds between looks at the inbox.",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=float,
+            default=5,
+            help="Leave files modified in the last this many seconds, as they "
+            "may still be being written.",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=600,
+            help="Take over files whose job has sent no heartbeat for this "
+            "many seconds.",
+        )
+        parser.add_argument(
+            "--uploaded-by",
+            default="ingest_watch",
+            help="Recorded as uploaded_by on the jobs.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the inbox is empty instead of polling.",
+        )
+
+    def handle(self, *args, **options):
+        inbox = Inbox(options["inbox"])
+        stop = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *args: stop.set())
+
+        self.stdout.write(f"Watching {inbox.root}")
+        running = {}
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            while True:
+                for future in [future for future in running if future.done()]:
+                    self.report(running.pop(future), future)
+                if stop.is_set():
+                    break
+
+                try:
+                    for job in inbox.recover(
+                        options["stale_after"], skip=set(running.values())
+                    ):
+                        path = inbox.storage.path(job.file.name)
+                        running[pool.submit(in_thread, inbox.resume, job)] = path
+
+                    free = options["concurrency"] - len(running)
+                    for name in inbox.new_files(options["min_age"]):
+                        if free <= 0:
+                            break
+                        path = inbox.claim(name)
+                        if path is None:
+                            continue
+                        future = pool.submit(
+                            in_thread,
+                            inbox.ingest,
+                            path,
+                            mode=options["mode"],
+                            tolerant=options["tolerant"],
+                            uploaded_by=options["uploaded_by"],
+                        )
+                        running[future] = path
+                        free -= 1
+                except DatabaseError:
+                    # A lost connection should not stop the watcher
+                    logger.exception("Could not check the inbox")
+                    connections.close_all()
+
+                if options["once"] and not running:
+                    break
+                if running:
+                    wait(
+                        running,
+                        timeout=options["poll_interval"],
+                        return_when=FIRST_COMPLETED,
+                    )
+                else:
+                    stop.wait(options["poll_interval"])
+
+            # Let the files being ingested finish before exiting
+            for future in list(running):
+                future.exception()
+                self.report(running.pop(future), future)
+
+    def report(self, path, future):
+        error = future.exception()
+        if error is not None:
+            logger.error("Ingesting inbox file %s failed", path, exc_info=error)
+            self.stderr.write(f"{path}: {error}")
+            return
+        manifest = future.result()
+        stats = (manifest["result"] or {}).get("stats", {})
+        self.stdout.write(
+            f"{manifest['file_name']}: {manifest['status']}, "
+            f"{stats.get('rows', 0)} rows -> {manifest['stored_as']}"
+        )
@@ -0,0 +1,96 @@
+import logging
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connections
+
+from vins_search.jobs import claim_next_job, requeue_stale_jobs, run_job
+from vins_search.storage import expire_chunked_uploads
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps for abandoned chunked uploads
+EXPIRE_INTERVAL = 15 * 60
+
+
+def work(once, poll_interval, stale_after):
+    """
+    Claim and run upload jobs until the queue is empty (with `once`) or forever.
+    """
+    next_expiry = 0
+    while True:
+        try:
+            if time.monotonic() >= next_expiry:
+                expire_chunked_uploads()
+                next_expiry = time.monotonic() + EXPIRE_INTERVAL
+            requeue_stale_jobs(stale_after)
+            job = claim_next_job()
+        except DatabaseError:
+            # A lost connection or lock timeout should not kill the worker
+            logger.exception("Could not claim an upload job")
+            connections.close_all()
+            time.sleep(poll_interval)
+            continue
+        if job is not None:
+            run_job(job)
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = (
+        "Run background workers that ingest, or roll back, queued "
+        "CustomDutyFileUploads. "
+        "Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so the "
+        "command can be started on several hosts or with --processes N. "
+        "Chunked uploads left unfinished for CHUNKED_UPLOAD_EXPIRE_AFTER "
+        "seconds are deleted along with their temporary files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=1,
+            help="Number of worker processes to start.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once there are no pending jobs instead of polling.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5,
+            help="Seconds to wait between polls when the queue is empty.",
+        )
+        parser.add_argument(
+            "--stale-after",
+            type=int,
+            default=600,
+            help="Requeue processing jobs without a heartbeat for this many seconds.",
+        )
+
+    def handle(self, *args, **options):
+        worker_args = (options["once"], options["poll_interval"], options["stale_after"])
+
+        if options["processes"] <= 1:
+            work(*worker_args)
+            return
+
+        # Forked children must not share the parent's database connection
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=work, args=worker_args)
+            for _ in range(options["processes"])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} upload workers.")
+        for worker in workers:
+            worker.join()
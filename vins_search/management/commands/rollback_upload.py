@@ -0,0 +1,69 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.timezone import now
+
+from vins_search.jobs import (
+    ROLLBACK_STATUSES,
+    check_rollback,
+    run_rollback,
+    worker_name,
+)
+from vins_search.models import CustomDutyFileUploads
+from vins_search.rollback import DEFAULT_ROLLBACK_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Roll back the rows written by one upload: values overwritten in merge "
+        "mode are restored and inserted rows are deleted, in short chunked "
+        "transactions so search traffic is not blocked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("job_id", help="job_id of the upload to roll back.")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_ROLLBACK_CHUNK_SIZE,
+            help="Rows restored or deleted per transaction.",
+        )
+        parser.add_argument(
+            "--pause",
+            type=float,
+            default=0,
+            help="Seconds to sleep between chunks.",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            try:
+                job = (
+                    CustomDutyFileUploads.objects.select_for_update()
+                    .filter(job_id=options["job_id"])
+                    .first()
+                )
+            except ValidationError:
+                job = None
+            if job is None:
+                raise CommandError(f"Upload {options['job_id']} does not exist.")
+            try:
+                check_rollback(job, ROLLBACK_STATUSES + ("rollback_pending",))
+            except ValueError as e:
+                raise CommandError(str(e))
+            job.status = "rolling_back"
+            job.worker = worker_name()
+            job.heartbeat_at = now()
+            job.save(update_fields=["status", "worker", "heartbeat_at"])
+
+        job = run_rollback(
+            job, chunk_size=options["chunk_size"], pause=options["pause"]
+        )
+        if job.status != "rolled_back":
+            raise CommandError(job.result["error"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rolled back upload {job.job_id}: {job.result['restored']} rows "
+                f"restored, {job.result['deleted']} deleted."
+            )
+        )
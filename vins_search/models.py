@@ -7,51 +7,203 @@ import qrcode
 import base64
 from io import BytesIO
 from qrcode.image.pil import PilImage
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Upper
 from django.utils.timezone import now
+import os
+import tempfile
 
 from accounts.models import CustomUser
 
 
+class DictionaryValue(models.Model):
+    """
+    One distinct value of a low-cardinality CustomDutyFile column, which
+    rows reference by id instead of repeating the text.
+    """
+
+    # Small keys keep the referencing columns narrow
+    id = models.SmallAutoField(primary_key=True)
+    value = models.CharField(max_length=50, unique=True, blank=True)
+
+    def __str__(self):
+        return self.value
+
+    class Meta:
+        abstract = True
+        ordering = ["value"]
+
+
+class Brand(DictionaryValue):
+    pass
+
+
+class EngineType(DictionaryValue):
+    pass
+
+
+class VehicleType(DictionaryValue):
+    pass
+
+
+class OriginCountry(DictionaryValue):
+    class Meta(DictionaryValue.Meta):
+        verbose_name_plural = "origin countries"
+
+
+class CustomsOffice(DictionaryValue):
+    pass
+
+
+class PaymentStatus(DictionaryValue):
+    class Meta(DictionaryValue.Meta):
+        verbose_name_plural = "payment statuses"
+
+
+def dictionary_field(model, verbose_name):
+    # Not indexed on its own; indexes that need the column list it explicitly
+    return models.ForeignKey(
+        model,
+        related_name="+",
+        on_delete=models.PROTECT,
+        db_index=False,
+        blank=True,
+        null=True,
+        verbose_name=verbose_name,
+    )
+
+
 class CustomDutyFile(models.Model):
     vin = models.CharField(max_length=50, unique=True, blank=True, null=True)
-    brand = models.CharField(max_length=50, blank=True, null=True)
+    brand_ref = dictionary_field(Brand, "brand")
     model = models.CharField(max_length=50, blank=True, null=True)
     vehicle_year = models.CharField(max_length=50, blank=True, null=True)
-    engine_type = models.CharField(max_length=50, blank=True, null=True)
+    engine_type_ref = dictionary_field(EngineType, "engine type")
     vreg = models.CharField(max_length=50, blank=True, null=True)
-    vehicle_type = models.CharField(max_length=50, blank=True, null=True)
+    vehicle_type_ref = dictionary_field(VehicleType, "vehicle type")
     importer_tin = models.CharField(max_length=50, blank=True, null=True)
     importer_business_name = models.CharField(max_length=500, blank=True, null=True)
     importer_address = models.CharField(max_length=500, blank=True, null=True)
-    origin_country = models.CharField(max_length=50, blank=True, null=True)
+    origin_country_ref = dictionary_field(OriginCountry, "origin country")
     hscode = models.CharField(max_length=50, blank=True, null=True)
     sgd_num = models.CharField(max_length=50, blank=True, null=True)
     sgd_date = models.CharField(max_length=50, blank=True, null=True)
+    office_cod_ref = dictionary_field(CustomsOffice, "office cod")
+    payment_status_ref = dictionary_field(PaymentStatus, "payment status")
+    # Typed copies of vehicle_year, sgd_date and payment_status, derived on ingestion
+    vehicle_year_value = models.SmallIntegerField(blank=True, null=True)
+    sgd_date_value = models.DateField(blank=True, null=True)
+    is_unpaid = models.BooleanField(blank=True, null=True)
+    upload = models.ForeignKey(
+        "CustomDutyFileUploads",
+        related_name="custom_duties",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+    )
+    # Text columns replaced by the *_ref ones above. They are kept until the
+    # encode_dictionary_fields command has copied them into the lookup tables
+    # and are then dropped; see that command for the order of the steps.
+    brand = models.CharField(max_length=50, blank=True, null=True)
+    engine_type = models.CharField(max_length=50, blank=True, null=True)
+    vehicle_type = models.CharField(max_length=50, blank=True, null=True)
+    origin_country = models.CharField(max_length=50, blank=True, null=True)
     office_cod = models.CharField(max_length=50, blank=True, null=True)
     payment_status = models.CharField(max_length=50, blank=True, null=True)
 
     def __str__(self):
-        return f"{self.brand} with vin number: {self.vin}"
+        return f"{self.brand_ref} with vin number: {self.vin}"
 
     class Meta:
         verbose_name = "vin"
         verbose_name_plural = "vins"
         ordering = ["-vin"]
+        indexes = [
+            # Multi-VIN searches match VINs case-insensitively
+            models.Index(Upper("vin"), name="customduty_vin_upper_idx"),
+            models.Index(fields=["vehicle_year_value"], name="customduty_vehicle_year_idx"),
+            models.Index(fields=["sgd_date_value"], name="customduty_sgd_date_idx"),
+            models.Index(
+                fields=["office_cod_ref", "sgd_date_value"],
+                name="customduty_office_sgd_date_idx",
+            ),
+            models.Index(
+                fields=["office_cod_ref", "sgd_date_value"],
+                condition=models.Q(is_unpaid=True),
+                name="customduty_unpaid_idx",
+            ),
+        ]
 
 
 class CustomDutyFileUploads(models.Model):
+    STATUS_CHOICES = (
+        ("pending", "Pending"),
+        ("processing", "Processing"),
+        ("completed", "Completed"),
+        ("failed", "Failed"),
+        ("rollback_pending", "Rollback pending"),
+        ("rolling_back", "Rolling back"),
+        ("rolled_back", "Rolled back"),
+    )
+    MODE_CHOICES = (
+        ("insert", "Insert"),
+        ("merge", "Merge"),
+        ("replace", "Full refresh"),
+    )
+    # What runs the job: process_uploads workers run "api" jobs, the
+    # commands that created the other jobs run and resume them
+    SOURCE_CHOICES = (
+        ("api", "Upload API"),
+        ("import", "import_duty_data"),
+        ("inbox", "ingest_watch inbox"),
+    )
+
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     uploaded_by = models.CharField(max_length=250)
     file_name = models.CharField(max_length=255)
     file = models.FileField(upload_to="uploads/")
-    file_type = models.CharField(max_length=10)
+    file_type = models.CharField(max_length=20)
+    file_size = models.BigIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, unique=True, blank=True, null=True)
+    mode = models.CharField(max_length=10, choices=MODE_CHOICES, default="insert")
+    tolerant = models.BooleanField(default=False)
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default="api")
     processed_status = models.BooleanField(default=False)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default="pending", db_index=True
+    )
+    bytes_processed = models.BigIntegerField(default=0)
+    rows_processed = models.BigIntegerField(default=0)
+    rows_inserted = models.BigIntegerField(default=0)
+    rows_updated = models.BigIntegerField(default=0)
+    rows_unchanged = models.BigIntegerField(default=0)
+    rows_quarantined = models.BigIntegerField(default=0)
+    result = models.JSONField(blank=True, null=True)
+    # Null rates, distinct counts and value mixes of the rows read so far
+    profile = models.JSONField(blank=True, null=True)
+    worker = models.CharField(max_length=255, blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
     slug = models.CharField(max_length=400, blank=True, null=True, unique=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return f"{self.file_type} was uploaded recently  - {self.uploaded_at}"
 
+    @property
+    def progress(self):
+        """
+        Percentage of the stored file read by the ingestion job.
+        """
+        if self.status == "completed":
+            return 100
+        if not self.file_size:
+            return 0
+        return min(99, round(self.bytes_processed * 100 / self.file_size))
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.file.name) + str(uuid.uuid4())
@@ -64,6 +216,96 @@ class CustomDutyFileUploads(models.Model):
         ordering = ["-uploaded_by"]
 
 
+class CustomDutyFileRevision(models.Model):
+    """
+    The values a merge upload overwrote on an existing row, kept so the
+    upload can be rolled back.
+    """
+
+    upload = models.ForeignKey(
+        CustomDutyFileUploads,
+        related_name="revisions",
+        on_delete=models.CASCADE,
+    )
+    vin = models.CharField(max_length=50)
+    data = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.vin} before {self.upload.file_name}"
+
+
+class QuarantinedRow(models.Model):
+    """
+    A row of a tolerant upload that could not be stored, kept with the
+    reason so it can be downloaded, corrected and re-submitted.
+    """
+
+    upload = models.ForeignKey(
+        CustomDutyFileUploads,
+        related_name="quarantined_rows",
+        on_delete=models.CASCADE,
+    )
+    row_number = models.BigIntegerField()
+    data = models.JSONField()
+    errors = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Row {self.row_number} of {self.upload.file_name}"
+
+    class Meta:
+        ordering = ["row_number"]
+        unique_together = ("upload", "row_number")
+
+
+# Directory the bytes of chunked uploads are assembled in
+CHUNKED_UPLOAD_TEMP_DIR = getattr(
+    settings,
+    "CHUNKED_UPLOAD_TEMP_DIR",
+    os.path.join(tempfile.gettempdir(), "cvms_chunked_uploads"),
+)
+
+
+class ChunkedUpload(models.Model):
+    """
+    A file being sent in pieces; bytes are appended to a temporary file
+    until the client completes the upload and it is queued for ingestion.
+    """
+
+    STATUS_CHOICES = (
+        ("uploading", "Uploading"),
+        ("completed", "Completed"),
+    )
+
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    file_name = models.CharField(max_length=255)
+    file_size = models.BigIntegerField()
+    checksum = models.CharField(max_length=64)
+    mode = models.CharField(
+        max_length=10, choices=CustomDutyFileUploads.MODE_CHOICES, default="insert"
+    )
+    tolerant = models.BooleanField(default=False)
+    offset = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="uploading")
+    job = models.ForeignKey(
+        CustomDutyFileUploads,
+        related_name="chunked_uploads",
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.file_name} - {self.offset}/{self.file_size} bytes"
+
+    @property
+    def temp_path(self):
+        return os.path.join(CHUNKED_UPLOAD_TEMP_DIR, f"{self.upload_id}.part")
+
+
 class VINUpload(models.Model):
     uploaded_by = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     vins = models.FileField(upload_to="vins/")
@@ -85,7 +327,10 @@ class VinSearchHistory(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def generate_qr_code(self):
-        qr_data = f"VIN: {self.vin.vin}, payment_status: {self.vin.payment_status}, date_cretaed: {self.created_at}"
+        from .dictionary import decoded_value
+
+        payment_status = decoded_value(self.vin, "payment_status")
+        qr_data = f"VIN: {self.vin.vin}, payment_status: {payment_status}, date_cretaed: {self.created_at}"
         img = qrcode.make(qr_data, image_factory=PilImage)
 
         qr_image = BytesIO()
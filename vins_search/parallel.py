@@ -0,0 +1,280 @@
+import io
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+import pandas as pd
+from django.conf import settings
+
+from .ingestion import (
+    DEFAULT_BATCH_SIZE,
+    batched,
+    import_pyarrow,
+    parquet_columns,
+    parquet_frame,
+)
+from .validators import FrameValidation, validate_fields
+
+
+# Processes used to parse and validate one file; 1 keeps ingestion serial
+DEFAULT_WORKERS = getattr(settings, "CUSTOM_DUTY_INGEST_WORKERS", 1)
+
+# Approximate size of the byte ranges a CSV file is split into
+DEFAULT_RANGE_SIZE = getattr(settings, "CUSTOM_DUTY_INGEST_RANGE_SIZE", 16 * 1024 * 1024)
+
+
+class _RangeReader(io.RawIOBase):
+    """
+    Read-only view of `raw` that stops at byte offset `end`.
+    """
+
+    def __init__(self, raw, end):
+        self.raw = raw
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        remaining = self.end - self.raw.tell()
+        if remaining <= 0:
+            return 0
+        view = memoryview(buffer)[:remaining]
+        return self.raw.readinto(view)
+
+
+def file_path(file):
+    """
+    Local filesystem path of an uploaded or stored file, or None.
+    """
+    if hasattr(file, "temporary_file_path"):
+        return file.temporary_file_path()
+    if isinstance(file, io.BufferedReader) and isinstance(file.name, str):
+        # A file opened from disk, as by `manage.py import_duty_data`
+        return file.name
+    try:
+        return file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+
+# Size of the reads used to count quotes while splitting a CSV file
+QUOTE_SCAN_SIZE = 1024 * 1024
+
+
+def _count_quotes(raw, end):
+    """
+    Count the double quotes from the position of `raw` up to offset `end`.
+    """
+    count = 0
+    while raw.tell() < end:
+        block = raw.read(min(QUOTE_SCAN_SIZE, end - raw.tell()))
+        if not block:
+            break
+        count += block.count(b'"')
+    return count
+
+
+def csv_ranges(path, range_size=DEFAULT_RANGE_SIZE, encoding="utf-8-sig"):
+    """
+    Split a CSV file into byte ranges that start and end on line boundaries.
+
+    Returns the header's column names and a list of `(start, end)` offsets
+    covering every data line once. Ranges are cut at newlines; the quotes
+    before each cut are counted, and if an odd number shows the cut falls
+    inside a quoted value with a line break, the list is None and the file
+    has to be read serially.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as raw:
+        # Parse the header as iter_csv_frames would, so column names match
+        header = raw.readline()
+        columns = list(
+            pd.read_csv(io.BytesIO(header), encoding=encoding, nrows=0).columns
+        )
+
+        quotes = header.count(b'"')
+        ranges = []
+        start = raw.tell()
+        while start < size:
+            raw.seek(min(start + range_size, size))
+            if raw.tell() < size:
+                raw.readline()
+            end = raw.tell()
+            raw.seek(start)
+            quotes += _count_quotes(raw, end)
+            if quotes % 2:
+                return columns, None
+            ranges.append((start, end))
+            start = end
+    return columns, ranges
+
+
+def _validate_csv_range(path, start, end, columns, batch_size, encoding):
+    """
+    Parse and validate one byte range of a CSV file (runs in a worker).
+    """
+    with open(path, "rb") as raw:
+        raw.seek(start)
+        stream = io.BufferedReader(_RangeReader(raw, end))
+        try:
+            frames = pd.read_csv(
+                stream,
+                names=columns,
+                header=None,
+                index_col=False,
+                dtype=str,
+                keep_default_na=False,
+                encoding=encoding,
+                chunksize=batch_size,
+            )
+            return [validate_fields(frame.fillna("")) for frame in frames]
+        except pd.errors.EmptyDataError:
+            return []
+
+
+def _validate_row_group(path, index, columns, batch_size):
+    """
+    Read and validate one row group of a Parquet file (runs in a worker).
+    """
+    pa = import_pyarrow()
+    table = pa.parquet.ParquetFile(path).read_row_group(index, columns=columns)
+    return [
+        validate_fields(parquet_frame(batch))
+        for batch in table.to_batches(max_chunksize=batch_size)
+    ]
+
+
+def _validate_rows(rows):
+    """
+    Validate one range of row dicts (runs in a worker).
+    """
+    return [validate_fields(pd.DataFrame(rows, dtype=object))]
+
+
+def rebatch(validations, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Regroup consecutive validations into batches of exactly `batch_size`
+    rows (the last may be smaller), so batch boundaries match a serial run.
+    """
+    pending = []
+    pending_rows = 0
+    for validation in validations:
+        if not len(validation.frame):
+            continue
+        pending.append(validation)
+        pending_rows += len(validation.frame)
+        if pending_rows < batch_size:
+            continue
+
+        merged = FrameValidation.concat(pending)
+        start = 0
+        while pending_rows - start >= batch_size:
+            yield merged.slice(start, start + batch_size)
+            start += batch_size
+        pending = [merged.slice(start, pending_rows)] if start < pending_rows else []
+        pending_rows -= start
+
+    if pending:
+        yield FrameValidation.concat(pending)
+
+
+def _worker_context():
+    """
+    Start workers from a fresh interpreter rather than forking.
+
+    Ingestion runs in request threads, the ingest_watch pool and ZIP member
+    threads; a fork there would copy locks held by other threads and the
+    parent's database connections into every worker.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _ordered_results(function, tasks, workers):
+    """
+    Run `function(*task)` for each task in a process pool and yield every
+    returned validation in task order.
+
+    At most two tasks per worker are in flight, so a slow consumer (the
+    database writer) holds back parsing instead of letting results pile up
+    in memory.
+    """
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=_worker_context(), initializer=django.setup
+    ) as pool:
+        tasks = iter(tasks)
+        in_flight = deque(
+            pool.submit(function, *task) for task in islice(tasks, workers * 2)
+        )
+        try:
+            while in_flight:
+                results = in_flight.popleft().result()
+                task = next(tasks, None)
+                if task is not None:
+                    in_flight.append(pool.submit(function, *task))
+                yield from results
+        finally:
+            # Stop early, e.g. at the first invalid row, without parsing on
+            for future in in_flight:
+                future.cancel()
+
+
+def parallel_csv_validations(
+    path,
+    batch_size=DEFAULT_BATCH_SIZE,
+    workers=DEFAULT_WORKERS,
+    range_size=DEFAULT_RANGE_SIZE,
+    encoding="utf-8-sig",
+):
+    """
+    Parse and validate a CSV file's byte ranges in `workers` processes.
+
+    Returns an iterator of field-validated batches in file order, ready for
+    `ingest_validations`, which checks VINs and writes them, or None if a
+    quoted value spans two ranges and the file has to be read serially.
+    """
+    columns, ranges = csv_ranges(path, range_size, encoding)
+    if ranges is None:
+        return None
+    if not ranges:
+        # A header-only file is one empty batch, as pandas reads it serially
+        return iter([validate_fields(pd.DataFrame(columns=columns))])
+    # The header, and any byte order mark with it, is already consumed
+    encoding = "utf-8" if encoding == "utf-8-sig" else encoding
+    tasks = (
+        (path, start, end, columns, batch_size, encoding) for start, end in ranges
+    )
+    return rebatch(_ordered_results(_validate_csv_range, tasks, workers), batch_size)
+
+
+def parallel_parquet_validations(
+    path, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS
+):
+    """
+    Read and validate a Parquet file's row groups in `workers` processes,
+    yielding field-validated batches in file order.
+    """
+    pa = import_pyarrow()
+    parquet_file = pa.parquet.ParquetFile(path)
+    columns = parquet_columns(parquet_file)
+    tasks = (
+        (path, index, columns, batch_size)
+        for index in range(parquet_file.num_row_groups)
+    )
+    return rebatch(_ordered_results(_validate_row_group, tasks, workers), batch_size)
+
+
+def parallel_row_validations(
+    rows, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS
+):
+    """
+    Validate ranges of row dicts in `workers` processes while the parent
+    keeps reading `rows`, yielding field-validated batches in order.
+    """
+    tasks = ((batch,) for batch in batched(rows, batch_size))
+    return rebatch(_ordered_results(_validate_rows, tasks, workers), batch_size)
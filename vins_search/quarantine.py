@@ -0,0 +1,125 @@
+import csv
+import json
+
+import pandas as pd
+from django.db import transaction
+
+from .ingestion import DEFAULT_BATCH_SIZE, ingest_frames
+from .models import QuarantinedRow
+from .validators import UPLOAD_FIELD_NAMES, VIN_LOOKUP_CHUNK_SIZE
+
+
+# Columns of a quarantine download, which is also the re-submission format
+QUARANTINE_COLUMNS = ["row_number", "errors", *UPLOAD_FIELD_NAMES]
+
+
+def quarantine_writer(upload):
+    """
+    Return an `on_invalid` callback that stores rejected rows for `upload`.
+    """
+
+    def write(rows):
+        QuarantinedRow.objects.bulk_create(
+            [
+                QuarantinedRow(
+                    upload=upload,
+                    row_number=row["row_number"],
+                    data=row["data"],
+                    errors=row["errors"],
+                )
+                for row in rows
+            ]
+        )
+
+    return write
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def iter_quarantine_csv(upload):
+    """
+    Yield the quarantined rows of `upload` as CSV lines, for streaming.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(QUARANTINE_COLUMNS)
+    rows = upload.quarantined_rows.order_by("row_number").iterator(chunk_size=2000)
+    for row in rows:
+        yield writer.writerow(
+            [row.row_number, json.dumps(row.errors)]
+            + [row.data.get(name) for name in UPLOAD_FIELD_NAMES]
+        )
+
+
+def resubmit_quarantined(upload, file, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Ingest corrected quarantined rows of `upload` from a CSV file in the
+    download format.
+
+    Rows are matched to the quarantine by `row_number` and go through the
+    upload's mode again, except that rows of a full refresh are merged into
+    the dataset it produced. Rows that are stored leave the quarantine; rows
+    that still fail replace their entry with the new reasons.
+    """
+    file.seek(0)
+    frame = pd.read_csv(
+        file, dtype=str, keep_default_na=False, encoding="utf-8-sig"
+    ).fillna("")
+    if "row_number" not in frame.columns:
+        raise ValueError("The file must contain a 'row_number' column.")
+
+    numbers = pd.to_numeric(frame.pop("row_number"), errors="coerce")
+    if numbers.isna().any() or (numbers % 1).any():
+        raise ValueError("Every row must have a whole row_number.")
+    row_numbers = numbers.astype("int64").tolist()
+    if len(set(row_numbers)) != len(row_numbers):
+        raise ValueError("Each row_number may only appear once.")
+
+    quarantined = set(upload.quarantined_rows.values_list("row_number", flat=True))
+    unknown = [number for number in row_numbers if number not in quarantined]
+    if unknown:
+        raise ValueError(
+            f"Rows not in quarantine: {', '.join(map(str, unknown[:10]))}"
+        )
+
+    frame = frame.drop(columns=["errors"], errors="ignore")
+    still_failing = []
+
+    def collect(rows):
+        # Map positions in the re-submitted file back to the original rows
+        for row in rows:
+            row["row_number"] = row_numbers[row["row_number"] - 1]
+        still_failing.extend(rows)
+
+    frames = (
+        frame.iloc[start : start + batch_size]
+        for start in range(0, len(frame), batch_size)
+    )
+    mode = "merge" if upload.mode == "replace" else upload.mode
+    result = ingest_frames(
+        frames, "CSV", mode=mode, on_invalid=collect, upload=upload
+    )
+
+    with transaction.atomic():
+        for start in range(0, len(row_numbers), VIN_LOOKUP_CHUNK_SIZE):
+            upload.quarantined_rows.filter(
+                row_number__in=row_numbers[start : start + VIN_LOOKUP_CHUNK_SIZE]
+            ).delete()
+        quarantine_writer(upload)(still_failing)
+
+        stats = result["stats"]
+        upload.rows_inserted += stats["inserted"]
+        upload.rows_updated += stats["updated"]
+        upload.rows_unchanged += stats["unchanged"]
+        upload.rows_quarantined = upload.quarantined_rows.count()
+        upload.save(
+            update_fields=[
+                "rows_inserted",
+                "rows_updated",
+                "rows_unchanged",
+                "rows_quarantined",
+            ]
+        )
+    return result
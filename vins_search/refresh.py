@@ -0,0 +1,323 @@
+import hashlib
+import logging
+import re
+import uuid
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.db.models.expressions import RawSQL
+
+from .dictionary import encode_rows
+from .ingestion import WRITE_FIELDS, copy_supported, write_batch_copy
+from .models import CustomDutyFile
+
+
+logger = logging.getLogger(__name__)
+
+# A refresh may not shrink the dataset below this share of its current size
+MIN_REFRESH_RATIO = getattr(settings, "CUSTOM_DUTY_REFRESH_MIN_RATIO", 0.5)
+
+# How long the swap waits for running queries before giving up (PostgreSQL)
+REFRESH_LOCK_TIMEOUT = getattr(settings, "CUSTOM_DUTY_REFRESH_LOCK_TIMEOUT", "5s")
+
+INDEX_DEFINITION = re.compile(r"^(CREATE (?:UNIQUE )?INDEX )\S+ ON (ONLY )?\S+ ")
+
+
+def apply_on_delete(kept_ids_sql, using=DEFAULT_DB_ALIAS):
+    """
+    Treat rows referencing a CustomDutyFile id missing from `kept_ids_sql`
+    as Django would if that row were deleted: cascade, set null or refuse.
+    """
+    for relation in CustomDutyFile._meta.related_objects:
+        attname = relation.field.attname
+        orphans = (
+            relation.related_model._base_manager.using(using)
+            .exclude(**{f"{attname}__in": RawSQL(kept_ids_sql, [])})
+            .exclude(**{f"{attname}__isnull": True})
+        )
+        if relation.on_delete is models.CASCADE:
+            orphans.delete()
+        elif relation.on_delete is models.SET_NULL:
+            orphans.update(**{attname: None})
+        elif relation.on_delete is not models.DO_NOTHING and orphans.exists():
+            raise ValueError(
+                f"{relation.related_model._meta.verbose_name_plural} still "
+                "reference rows missing from the new dataset."
+            )
+
+
+class StagingTable:
+    """
+    A table with the CustomDutyFile columns that a full refresh is loaded
+    into, then checked and swapped in for the live rows in one transaction.
+
+    VINs present in both datasets keep their ids, so search history stays
+    attached to them. This generic version copies the staged rows into the
+    live table inside the swap transaction; PostgresStagingTable renames
+    the tables instead.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.connection = connections[using]
+        self.live = CustomDutyFile._meta.db_table
+        self.suffix = uuid.uuid4().hex[:8]
+        self.name = f"{self.live}_staging_{self.suffix}"
+        self.pk = CustomDutyFile._meta.pk.column
+        self.columns = [field.column for field in WRITE_FIELDS]
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def column_list(self, columns):
+        return ", ".join(self.quote(column) for column in columns)
+
+    def execute(self, sql, params=None):
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if cursor.description:
+                return cursor.fetchall()
+
+    def create(self):
+        self.execute(
+            f"CREATE TABLE {self.quote(self.name)} AS "
+            f"SELECT * FROM {self.quote(self.live)} WHERE 1 = 0"
+        )
+
+    def write_batch(self, rows, using=None):
+        placeholders = ", ".join(["%s"] * len(WRITE_FIELDS))
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {self.quote(self.name)} ({self.column_list(self.columns)}) "
+                f"VALUES ({placeholders})",
+                [
+                    [row.get(field.attname) for field in WRITE_FIELDS]
+                    for row in encode_rows(rows, using=self.using)
+                ],
+            )
+
+    def drop(self):
+        self.execute(f"DROP TABLE IF EXISTS {self.quote(self.name)}")
+
+    def count(self, table):
+        return self.execute(f"SELECT COUNT(*) FROM {self.quote(table)}")[0][0]
+
+    def check(self, expected_rows, min_ratio=MIN_REFRESH_RATIO):
+        """
+        Make sure the staged dataset is complete and plausible before it
+        replaces the live one. Returns the number of live rows.
+        """
+        staged = self.count(self.name)
+        if staged != expected_rows:
+            raise ValueError(
+                f"The staging table holds {staged} rows, expected {expected_rows}."
+            )
+
+        vin = self.quote("vin")
+        duplicate = self.execute(
+            f"SELECT {vin} FROM {self.quote(self.name)} WHERE {vin} IS NOT NULL "
+            f"GROUP BY {vin} HAVING COUNT(*) > 1 LIMIT 1"
+        )
+        if duplicate:
+            raise ValueError(f"VIN {duplicate[0][0]} appears more than once in the file.")
+
+        current = self.count(self.live)
+        if staged < current * min_ratio:
+            raise ValueError(
+                f"Refusing to replace {current} rows with only {staged}; "
+                "the file looks incomplete."
+            )
+        return current
+
+    def prepare(self):
+        """
+        Get the staged rows ready to go live, outside the swap transaction.
+        """
+
+    def swap(self):
+        staging, live, pk = self.quote(self.name), self.quote(self.live), self.quote(self.pk)
+        vin = self.quote("vin")
+        columns = self.column_list(self.columns)
+        with transaction.atomic(using=self.using):
+            self.execute(
+                f"UPDATE {staging} SET {pk} = (SELECT l.{pk} FROM {live} l "
+                f"WHERE l.{vin} = {staging}.{vin})"
+            )
+            apply_on_delete(
+                f"SELECT {pk} FROM {staging} WHERE {pk} IS NOT NULL", self.using
+            )
+            self.execute(f"DELETE FROM {live}")
+            # Rows keeping their id go in first so new ids cannot take them
+            self.execute(
+                f"INSERT INTO {live} ({pk}, {columns}) "
+                f"SELECT {pk}, {columns} FROM {staging} WHERE {pk} IS NOT NULL"
+            )
+            self.execute(
+                f"INSERT INTO {live} ({columns}) "
+                f"SELECT {columns} FROM {staging} WHERE {pk} IS NULL"
+            )
+            self.execute(f"DROP TABLE {staging}")
+
+    def refresh(self, expected_rows, min_ratio=MIN_REFRESH_RATIO):
+        """
+        Check, prepare and swap in the staged dataset. Returns the number of
+        rows it replaced.
+        """
+        previous = self.check(expected_rows, min_ratio)
+        self.prepare()
+        self.swap()
+        logger.info(
+            "Replaced %s custom duty rows with %s from %s",
+            previous,
+            expected_rows,
+            self.name,
+        )
+        return previous
+
+
+class PostgresStagingTable(StagingTable):
+    """
+    Staging table that is indexed like the live table while it is still
+    private, then renamed into place in a short ACCESS EXCLUSIVE transaction.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        super().__init__(using)
+        self.backup = f"{self.live}_previous_{self.suffix}"
+        self.renames = []
+
+    def temp_name(self, prefix, name):
+        return f"{prefix}{self.suffix}_{hashlib.md5(name.encode()).hexdigest()[:16]}"
+
+    def create(self):
+        staging, live = self.quote(self.name), self.quote(self.live)
+        self.execute(
+            f"CREATE TABLE {staging} "
+            f"(LIKE {live} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+        )
+        # New rows draw ids from the live sequence, so an id never means
+        # two different VINs while both tables exist
+        self.sequence = self.execute(
+            "SELECT pg_get_serial_sequence(%s, %s)", [live, self.pk]
+        )[0][0]
+        sequence = self.sequence.replace("'", "''")
+        self.execute(
+            f"ALTER TABLE {staging} ALTER COLUMN {self.quote(self.pk)} "
+            f"SET DEFAULT nextval('{sequence}'::regclass)"
+        )
+
+    def write_batch(self, rows, using=None):
+        if copy_supported(self.using):
+            write_batch_copy(rows, using=self.using, table=self.name)
+        else:
+            super().write_batch(rows)
+
+    def prepare(self):
+        staging, live, pk = self.quote(self.name), self.quote(self.live), self.quote(self.pk)
+        vin = self.quote("vin")
+        self.execute(
+            f"UPDATE {staging} s SET {pk} = l.{pk} FROM {live} l WHERE s.{vin} = l.{vin}"
+        )
+
+        # Rebuild the live table's indexes and constraints on the staged rows
+        indexes = self.execute(
+            "SELECT ic.relname, pg_get_indexdef(i.indexrelid), c.contype "
+            "FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid "
+            "LEFT JOIN pg_constraint c "
+            "ON c.conindid = i.indexrelid AND c.conrelid = i.indrelid "
+            "WHERE i.indrelid = %s::regclass",
+            [live],
+        )
+        for name, definition, kind in indexes:
+            temp = self.quote(self.temp_name("stg", name))
+            self.execute(
+                INDEX_DEFINITION.sub(
+                    lambda match: f"{match.group(1)}{temp} ON {match.group(2) or ''}{staging} ",
+                    definition,
+                    count=1,
+                )
+            )
+            is_constraint = kind in ("p", "u")
+            if is_constraint:
+                keyword = "PRIMARY KEY" if kind == "p" else "UNIQUE"
+                self.execute(
+                    f"ALTER TABLE {staging} ADD CONSTRAINT {temp} {keyword} USING INDEX {temp}"
+                )
+            self.renames.append((name, is_constraint))
+
+        foreign_keys = self.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype = 'f'",
+            [live],
+        )
+        for name, definition in foreign_keys:
+            self.execute(f"ALTER TABLE {staging} ADD CONSTRAINT {self.quote(name)} {definition}")
+
+        self.execute(f"ANALYZE {staging}")
+
+    def swap(self):
+        staging, live, backup = (
+            self.quote(self.name),
+            self.quote(self.live),
+            self.quote(self.backup),
+        )
+        pk = self.quote(self.pk)
+        with transaction.atomic(using=self.using):
+            self.execute(
+                "SELECT set_config('lock_timeout', %s, true)", [REFRESH_LOCK_TIMEOUT]
+            )
+            self.execute(f"LOCK TABLE {live} IN ACCESS EXCLUSIVE MODE")
+            referencing = self.execute(
+                "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+                "FROM pg_constraint WHERE confrelid = %s::regclass "
+                "AND conrelid <> confrelid AND contype = 'f'",
+                [live],
+            )
+
+            self.execute(f"ALTER TABLE {live} RENAME TO {backup}")
+            self.execute(f"ALTER TABLE {staging} RENAME TO {live}")
+            for name, is_constraint in self.renames:
+                old = self.quote(self.temp_name("old", name))
+                temp = self.quote(self.temp_name("stg", name))
+                if is_constraint:
+                    self.execute(
+                        f"ALTER TABLE {backup} RENAME CONSTRAINT {self.quote(name)} TO {old}"
+                    )
+                    self.execute(
+                        f"ALTER TABLE {live} RENAME CONSTRAINT {temp} TO {self.quote(name)}"
+                    )
+                else:
+                    self.execute(f"ALTER INDEX {self.quote(name)} RENAME TO {old}")
+                    self.execute(f"ALTER INDEX {temp} RENAME TO {self.quote(name)}")
+
+            # The new table owns its own id sequence, continuing the old one
+            self.execute(f"ALTER TABLE {live} ALTER COLUMN {pk} DROP DEFAULT")
+            self.execute(
+                f"ALTER TABLE {live} ALTER COLUMN {pk} ADD GENERATED BY DEFAULT AS IDENTITY"
+            )
+            self.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, %s), "
+                f"(SELECT last_value FROM {self.sequence}))",
+                [live, self.pk],
+            )
+
+            # Point referencing tables at the new rows; existing references
+            # are checked after the swap so it does not scan them here
+            for table, name, definition in referencing:
+                self.execute(f"ALTER TABLE {table} DROP CONSTRAINT {self.quote(name)}")
+            apply_on_delete(f"SELECT {pk} FROM {live}", self.using)
+            for table, name, definition in referencing:
+                self.execute(
+                    f"ALTER TABLE {table} ADD CONSTRAINT {self.quote(name)} "
+                    f"{definition} NOT VALID"
+                )
+
+        for table, name, definition in referencing:
+            self.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {self.quote(name)}")
+        self.execute(f"DROP TABLE {backup}")
+
+
+def get_staging_table(using=DEFAULT_DB_ALIAS):
+    if connections[using].vendor == "postgresql":
+        return PostgresStagingTable(using)
+    return StagingTable(using)
@@ -0,0 +1,109 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .dictionary import encode_rows
+from .ingestion import LINEAGE_FIELD, WRITE_FIELDS
+from .models import CustomDutyFile, CustomDutyFileRevision, CustomDutyFileUploads
+from .validators import TYPED_FIELD_SOURCES, UPLOAD_FIELD_NAMES
+
+
+logger = logging.getLogger(__name__)
+
+# Rows restored or deleted per transaction while rolling back an upload
+DEFAULT_ROLLBACK_CHUNK_SIZE = getattr(settings, "CUSTOM_DUTY_ROLLBACK_CHUNK_SIZE", 5000)
+
+
+def rollback_upload(upload, chunk_size=DEFAULT_ROLLBACK_CHUNK_SIZE, pause=0, on_chunk=None):
+    """
+    Undo the rows written by `upload`, a chunk at a time.
+
+    Rows the upload overwrote in "merge" mode get their previous values
+    back from its revisions, then the rows it inserted are deleted by
+    primary key. Each chunk is its own short transaction, so searches keep
+    running and an interrupted rollback can simply be started again. Rows a
+    later upload has written since are left to that upload.
+
+    `pause` seconds are slept between chunks to leave the database some
+    headroom, and `on_chunk`, if given, is called with the running counts.
+    """
+    counts = {"restored": 0, "deleted": 0}
+    fields = [field.name for field in WRITE_FIELDS]
+
+    def report():
+        if on_chunk:
+            on_chunk(counts)
+        logger.info(
+            "Rollback of upload %s: %s rows restored, %s deleted",
+            upload.job_id,
+            counts["restored"],
+            counts["deleted"],
+        )
+        time.sleep(pause)
+
+    while True:
+        with transaction.atomic():
+            revisions = list(
+                CustomDutyFileRevision.objects.filter(upload=upload).order_by("pk")[
+                    :chunk_size
+                ]
+            )
+            if not revisions:
+                break
+            rows = CustomDutyFile.objects.select_for_update().in_bulk(
+                [revision.vin for revision in revisions], field_name="vin"
+            )
+            # The upload that wrote a revision may have been deleted since
+            known_uploads = set(
+                CustomDutyFileUploads.objects.filter(
+                    pk__in={
+                        revision.data.get(LINEAGE_FIELD.attname)
+                        for revision in revisions
+                    }
+                ).values_list("pk", flat=True)
+            )
+            restored, values = [], []
+            for revision in revisions:
+                row = rows.get(revision.vin)
+                if row is None or row.upload_id != upload.pk:
+                    continue
+                values.append(
+                    {name: revision.data.get(name) for name in UPLOAD_FIELD_NAMES}
+                )
+                previous_upload = revision.data.get(LINEAGE_FIELD.attname)
+                row.upload_id = previous_upload if previous_upload in known_uploads else None
+                restored.append(row)
+            for name, (source, parse) in TYPED_FIELD_SOURCES.items():
+                parsed = parse([data[source] for data in values])
+                for data, value in zip(values, parsed):
+                    data[name] = value
+            for row, data in zip(restored, encode_rows(values)):
+                for attname, value in data.items():
+                    setattr(row, attname, value)
+            CustomDutyFile.objects.bulk_update(restored, fields)
+            CustomDutyFileRevision.objects.filter(
+                pk__in=[revision.pk for revision in revisions]
+            ).delete()
+
+        counts["restored"] += len(restored)
+        report()
+
+    while True:
+        pks = list(
+            CustomDutyFile.objects.filter(upload=upload)
+            .order_by("pk")
+            .values_list("pk", flat=True)[:chunk_size]
+        )
+        if not pks:
+            break
+        with transaction.atomic():
+            _, deleted = CustomDutyFile.objects.filter(
+                pk__in=pks, upload=upload
+            ).delete()
+
+        counts["deleted"] += deleted.get(CustomDutyFile._meta.label, 0)
+        report()
+
+    return counts
@@ -1,16 +1,47 @@
 from rest_framework import serializers
-from .models import CustomDutyFile, CustomDutyFileUploads, VINUpload, VinSearchHistory
+from .models import (
+    ChunkedUpload,
+    CustomDutyFile,
+    CustomDutyFileUploads,
+    VINUpload,
+    VinSearchHistory,
+)
+from .dictionary import ENCODED_FIELDS, decoded_value
 import os
 import qrcode
 import base64
 import uuid
 
 
+class DictionaryValueField(serializers.Field):
+    """
+    Read-only text of a dictionary-encoded CustomDutyFile column, taken
+    from the lookup cache instead of joining its table.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        return decoded_value(instance, self.source)
+
+    def to_representation(self, value):
+        return value
+
+
 
 class CustomDutyUploadSerializer(serializers.ModelSerializer):
+    brand = DictionaryValueField()
+    engine_type = DictionaryValueField()
+    vehicle_type = DictionaryValueField()
+    origin_country = DictionaryValueField()
+    office_cod = DictionaryValueField()
+    payment_status = DictionaryValueField()
+
     class Meta:
         model = CustomDutyFile
-        fields = "__all__"
+        exclude = [field.name for field in ENCODED_FIELDS]
 
 
 class CustomDutyFileUploadsSerializer(serializers.ModelSerializer):
@@ -27,8 +58,73 @@ class CustomDutyFileUploadsSerializer(serializers.ModelSerializer):
         )
 
 
+class UploadJobStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomDutyFileUploads
+        fields = (
+            "job_id",
+            "file_name",
+            "file_type",
+            "file_size",
+            "content_hash",
+            "mode",
+            "tolerant",
+            "status",
+            "progress",
+            "bytes_processed",
+            "rows_processed",
+            "rows_inserted",
+            "rows_updated",
+            "rows_unchanged",
+            "rows_quarantined",
+            "result",
+            "profile",
+            "attempts",
+            "uploaded_at",
+            "started_at",
+            "finished_at",
+        )
+
+
+class ChunkedUploadInitSerializer(serializers.Serializer):
+    file_name = serializers.CharField(max_length=255)
+    file_size = serializers.IntegerField(min_value=1)
+    checksum = serializers.RegexField(
+        r"^[0-9a-fA-F]{64}$",
+        error_messages={"invalid": "checksum must be a SHA-256 hex digest."},
+    )
+    mode = serializers.ChoiceField(
+        choices=CustomDutyFileUploads.MODE_CHOICES, default="insert"
+    )
+    tolerant = serializers.BooleanField(default=False)
+
+    def validate_checksum(self, value):
+        return value.lower()
+
+
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChunkedUpload
+        fields = (
+            "upload_id",
+            "file_name",
+            "file_size",
+            "checksum",
+            "mode",
+            "tolerant",
+            "offset",
+            "status",
+            "created_at",
+            "updated_at",
+        )
+
+
 class VinSerializer(serializers.ModelSerializer):
     # vin = serializers.CharField(required=True)
+    brand = DictionaryValueField()
+    engine_type = DictionaryValueField()
+    vehicle_type = DictionaryValueField()
+    payment_status = DictionaryValueField()
 
     class Meta:
         model = CustomDutyFile
@@ -80,9 +176,9 @@ class VinSearchHistorySerializer(serializers.ModelSerializer):
     def get_vin(self, obj):
         return {
             "vin": obj.vin.vin,
-            "brand": obj.vin.brand,
+            "brand": decoded_value(obj.vin, "brand"),
             "vehicle_year": obj.vin.vehicle_year,
-            "vehicle_type": obj.vin.vehicle_type,
-            "payment_status": obj.vin.payment_status,
-            "origin_country": obj.vin.origin_country,
+            "vehicle_type": decoded_value(obj.vin, "vehicle_type"),
+            "payment_status": decoded_value(obj.vin, "payment_status"),
+            "origin_country": decoded_value(obj.vin, "origin_country"),
         }
@@ -0,0 +1,227 @@
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import (
+    MemoryFileUploadHandler,
+    TemporaryFileUploadHandler,
+)
+from django.db import transaction
+from django.utils.timezone import now
+
+from .models import CHUNKED_UPLOAD_TEMP_DIR, ChunkedUpload
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the reads used when streaming request bodies and hashing files
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Directory of upload storage that uploads too large for memory are
+# streamed into while the request is read
+UPLOAD_TEMP_DIR = getattr(settings, "CUSTOM_DUTY_UPLOAD_TEMP_DIR", ".incoming")
+
+# Seconds a chunked upload may go without receiving a chunk before it is
+# abandoned and its temporary file deleted
+CHUNKED_UPLOAD_EXPIRE_AFTER = getattr(
+    settings, "CHUNKED_UPLOAD_EXPIRE_AFTER", 24 * 60 * 60
+)
+
+
+class HashingFile(File):
+    """
+    Wraps an upload so that the chunks read by a storage backend are also
+    fed into a SHA-256 digest, hashing the file in the same pass that
+    writes it.
+    """
+
+    def __init__(self, file, name=None):
+        super().__init__(file, name or file.name)
+        self.sha256 = hashlib.sha256()
+
+    def chunks(self, chunk_size=None):
+        for chunk in super().chunks(chunk_size):
+            self.sha256.update(chunk)
+            yield chunk
+
+    @property
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def get_upload_storage():
+    storage_location = getattr(settings, "MEDIA_ROOT", "uploads/")
+    return FileSystemStorage(location=storage_location)
+
+
+class HashedTemporaryUploadedFile(TemporaryUploadedFile):
+    """
+    A temporary upload kept inside upload storage and hashed as it is
+    received, so saving it is a rename rather than another copy.
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        directory = get_upload_storage().path(UPLOAD_TEMP_DIR)
+        os.makedirs(directory, exist_ok=True)
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(suffix=".upload" + ext, dir=directory)
+        # TemporaryUploadedFile would create the file in FILE_UPLOAD_TEMP_DIR
+        UploadedFile.__init__(
+            self, file, name, content_type, size, charset, content_type_extra
+        )
+        self.sha256 = hashlib.sha256()
+
+    @property
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+class HashingUploadHandler(TemporaryFileUploadHandler):
+    """
+    Streams uploads too large for memory into upload storage, hashing each
+    chunk of the request body on its way to disk.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(TemporaryFileUploadHandler, self).new_file(*args, **kwargs)
+        self.file = HashedTemporaryUploadedFile(
+            self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.file.sha256.update(raw_data)
+
+
+def upload_handlers(request):
+    """
+    Upload handlers for views that store uploads with `save_upload`.
+    """
+    return [MemoryFileUploadHandler(request), HashingUploadHandler(request)]
+
+
+def save_upload(file, storage=None):
+    """
+    Save an upload and return its stored name with its SHA-256 hex digest.
+
+    Uploads received by HashingUploadHandler are already on the storage's
+    disk and hashed, so they are just renamed into place. Others go through
+    HashingFile, which makes the storage copy temporary uploads chunk by
+    chunk instead of renaming them, so the hash needs no extra read.
+    """
+    storage = storage or get_upload_storage()
+    if isinstance(file, HashedTemporaryUploadedFile):
+        return storage.save(file.name, file), file.hexdigest
+    hashing_file = HashingFile(file)
+    filename = storage.save(file.name, hashing_file)
+    return filename, hashing_file.hexdigest
+
+
+def append_chunk(path, offset, stream, max_bytes):
+    """
+    Write the bytes read from `stream` to `path` starting at `offset`.
+
+    At most `max_bytes` are written. Returns the new end offset, which
+    reflects whatever reached the disk even if the stream is cut short, so
+    a client can resume from it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = "r+b" if os.path.exists(path) else "wb"
+    with open(path, mode) as part:
+        part.seek(offset)
+        part.truncate()
+        try:
+            remaining = max_bytes
+            while remaining > 0:
+                chunk = stream.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                part.write(chunk)
+                remaining -= len(chunk)
+        finally:
+            part.flush()
+            end = part.tell()
+    return end
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(STREAM_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def move_into_storage(path, name, storage=None):
+    """
+    Move an assembled file into upload storage without copying its bytes.
+    """
+    storage = storage or get_upload_storage()
+    filename = storage.get_available_name(name)
+    destination = storage.path(filename)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    file_move_safe(path, destination)
+    return filename
+
+
+def expire_chunked_uploads(expire_after=CHUNKED_UPLOAD_EXPIRE_AFTER):
+    """
+    Delete chunked uploads that have received no chunk for `expire_after`
+    seconds without being completed, and their temporary files, along with
+    `.part` files no upload owns any more. Returns the number of uploads
+    deleted.
+    """
+    cutoff = now() - timedelta(seconds=expire_after)
+    with transaction.atomic():
+        # Uploads receiving a chunk at this moment are locked and left alone
+        expired = list(
+            ChunkedUpload.objects.select_for_update(skip_locked=True).filter(
+                status="uploading", updated_at__lt=cutoff
+            )
+        )
+        ChunkedUpload.objects.filter(
+            pk__in=[chunked.pk for chunked in expired]
+        ).delete()
+
+    paths = {chunked.temp_path for chunked in expired}
+    if os.path.isdir(CHUNKED_UPLOAD_TEMP_DIR):
+        # Files whose upload was deleted some other way
+        orphans = {}
+        with os.scandir(CHUNKED_UPLOAD_TEMP_DIR) as entries:
+            for entry in entries:
+                name, extension = os.path.splitext(entry.name)
+                if extension != ".part":
+                    continue
+                if entry.stat().st_mtime >= cutoff.timestamp():
+                    continue
+                try:
+                    orphans[uuid.UUID(name)] = entry.path
+                except ValueError:
+                    continue
+        owned = ChunkedUpload.objects.filter(
+            upload_id__in=list(orphans), status="uploading"
+        ).values_list("upload_id", flat=True)
+        for upload_id in owned:
+            del orphans[upload_id]
+        paths.update(orphans.values())
+
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    if expired or paths:
+        logger.info(
+            "Expired %s chunked uploads and deleted %s temporary files",
+            len(expired),
+            len(paths),
+        )
+    return len(expired)
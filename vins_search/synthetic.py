@@ -0,0 +1,172 @@
+import csv
+import io
+import json
+import random
+from xml.sax.saxutils import escape
+
+import openpyxl
+
+from .ingestion import batched, import_pyarrow
+from .validators import UPLOAD_FIELD_NAMES
+
+
+# World manufacturer identifiers (the first three VIN characters) per brand
+BRANDS = {
+    "Toyota": ["JTD", "JTE", "4T1"],
+    "Honda": ["1HG", "JHM", "2HG"],
+    "Lexus": ["JTH", "2T2"],
+    "Mercedes-Benz": ["WDD", "WDC", "4JG"],
+    "Ford": ["1FA", "1FM", "WF0"],
+    "Hyundai": ["KMH", "5NP"],
+    "Kia": ["KNA", "KND"],
+}
+VEHICLE_TYPES = {
+    "Car": ["8703.22.00", "8703.23.00", "8703.40.00"],
+    "SUV": ["8703.23.00", "8703.24.00", "8703.33.00"],
+    "Truck": ["8704.21.00", "8704.31.00"],
+    "Bus": ["8702.10.00", "8702.90.00"],
+}
+ENGINE_TYPES = ["Petrol", "Diesel", "Hybrid", "Electric"]
+ORIGIN_COUNTRIES = ["USA", "Japan", "Germany", "Belgium", "Canada", "South Korea"]
+# Customs commands clearing vehicles
+OFFICE_CODES = ["APP", "TCIP", "PTML", "KLT", "ONNE", "MMIA", "SEME", "IDIRO", "KANO"]
+PAYMENT_STATUSES = ["PAID", "UNPAID"]
+PAYMENT_STATUS_WEIGHTS = [8, 2]
+
+# Characters allowed in a VIN and their ISO 3779 check digit values
+VIN_CHARACTERS = "0123456789ABCDEFGHJKLMNPRSTUVWXYZ"
+VIN_VALUES = {
+    **{str(digit): digit for digit in range(10)},
+    **dict(zip("ABCDEFGH", range(1, 9))),
+    **dict(zip("JKLMN", range(1, 6))),
+    "P": 7,
+    "R": 9,
+    **dict(zip("STUVWXYZ", range(2, 10))),
+}
+VIN_WEIGHTS = [8, 7, 6, 5, 4, 3, 2, 10, 0, 9, 8, 7, 6, 5, 4, 3, 2]
+# Model year codes repeat every 30 years from 1980
+VIN_YEAR_CODES = "ABCDEFGHJKLMNPRSTVWXY123456789"
+VIN_PLANT_CODES = "ABCDEFGHJKLMNPRSTUVWXYZ"
+
+
+def vin_check_digit(vin):
+    total = sum(VIN_VALUES[char] * weight for char, weight in zip(vin, VIN_WEIGHTS))
+    remainder = total % 11
+    return "X" if remainder == 10 else str(remainder)
+
+
+def synthetic_vin(rng, wmi, year, index):
+    """
+    A VIN with a valid check digit, unique for each `index` below 23 million.
+    """
+    descriptor = "".join(rng.choice(VIN_CHARACTERS) for _ in range(5))
+    plant = VIN_PLANT_CODES[index // 1_000_000 % len(VIN_PLANT_CODES)]
+    vin = (
+        f"{wmi}{descriptor}0{VIN_YEAR_CODES[(year - 1980) % 30]}"
+        f"{plant}{index % 1_000_000:06d}"
+    )
+    return vin[:8] + vin_check_digit(vin) + vin[9:]
+
+
+def synthetic_rows(count, seed=0):
+    """
+    Yield realistic CustomDutyFile upload rows, as text, with unique VINs.
+
+    The same `count` and `seed` always give the same rows.
+    """
+    rng = random.Random(seed)
+    importers = [
+        (
+            f"{rng.randint(10000000, 99999999)}-0001",
+            f"{rng.choice(['Bright', 'Royal', 'Prime', 'Delta', 'Unity'])} "
+            f"{rng.choice(['Motors', 'Autos', 'Ventures', 'Imports'])} "
+            f"{rng.randint(1, 999)} Ltd",
+            f"{rng.randint(1, 300)} "
+            f"{rng.choice(['Marina', 'Creek', 'Wharf', 'Ikorodu'])} Road, Lagos",
+        )
+        for _ in range(5000)
+    ]
+    brands = list(BRANDS)
+    vehicle_types = list(VEHICLE_TYPES)
+    for index in range(count):
+        brand = rng.choice(brands)
+        vehicle_type = rng.choice(vehicle_types)
+        year = rng.randint(1995, 2024)
+        tin, business_name, address = rng.choice(importers)
+        yield {
+            "vin": synthetic_vin(rng, rng.choice(BRANDS[brand]), year, index),
+            "brand": brand,
+            "model": f"Model {rng.randint(1, 40)}",
+            "vehicle_year": str(year),
+            "engine_type": rng.choice(ENGINE_TYPES),
+            "vreg": (
+                f"LAG-{rng.randint(100, 999)}-{rng.choice('ABCDEFGH')}"
+                f"{rng.choice('ABCDEFGH')}"
+                if rng.random() < 0.3
+                else ""
+            ),
+            "vehicle_type": vehicle_type,
+            "importer_tin": tin,
+            "importer_business_name": business_name,
+            "importer_address": address,
+            "origin_country": rng.choice(ORIGIN_COUNTRIES),
+            "hscode": rng.choice(VEHICLE_TYPES[vehicle_type]),
+            "sgd_num": str(rng.randint(100000, 999999)),
+            "sgd_date": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "office_cod": rng.choice(OFFICE_CODES),
+            "payment_status": rng.choices(PAYMENT_STATUSES, PAYMENT_STATUS_WEIGHTS)[0],
+        }
+
+
+def write_csv(rows, file):
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    writer = csv.DictWriter(text, UPLOAD_FIELD_NAMES)
+    writer.writeheader()
+    writer.writerows(rows)
+    text.detach()
+
+
+def write_excel(rows, file):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(UPLOAD_FIELD_NAMES)
+    for row in rows:
+        sheet.append([row[name] for name in UPLOAD_FIELD_NAMES])
+    workbook.save(file)
+
+
+def write_json(rows, file):
+    file.write(b"[")
+    for index, row in enumerate(rows):
+        file.write(b",\n" if index else b"\n")
+        file.write(json.dumps(row).encode())
+    file.write(b"\n]\n")
+
+
+def write_xml(rows, file):
+    # Matches the default CUSTOM_DUTY_XML_MAPPING
+    file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<records>\n')
+    for row in rows:
+        fields = "".join(
+            f"<{name}>{escape(row[name])}</{name}>" for name in UPLOAD_FIELD_NAMES
+        )
+        file.write(f"<record>{fields}</record>\n".encode())
+    file.write(b"</records>\n")
+
+
+def write_parquet(rows, file, row_group_size=100_000):
+    pa = import_pyarrow()
+    schema = pa.schema([(name, pa.string()) for name in UPLOAD_FIELD_NAMES])
+    with pa.parquet.ParquetWriter(file, schema) as writer:
+        for batch in batched(rows, row_group_size):
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+
+# Writers of synthetic upload files, by file name extension
+FILE_WRITERS = {
+    "csv": write_csv,
+    "xlsx": write_excel,
+    "json": write_json,
+    "xml": write_xml,
+    "parquet": write_parquet,
+}
@@ -1,3 +1,1284 @@
-from django.test import TestCase
-
-# Create your tests here.
+import bz2
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import date, timedelta
+from functools import partial
+from unittest import mock, skipIf
+
+import openpyxl
+import pandas as pd
+import qrcode
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import now
+from rest_framework.test import APIClient
+
+from accounts.models import CustomUser
+
+from .dictionary import decode_rows, stored_names
+from .inbox import Inbox
+from .ingestion import (
+    copy_supported,
+    get_batch_writer,
+    ingest_rows,
+    ingest_validations,
+    iter_json_records,
+    iter_xml_records,
+    write_isolating_failures,
+    write_batch_copy,
+    write_batch_orm,
+)
+from .jobs import claim_next_job, requeue_stale_jobs, run_job
+from .models import (
+    Brand,
+    ChunkedUpload,
+    CustomDutyFile,
+    CustomDutyFileUploads,
+    VinSearchHistory,
+)
+from .parallel import parallel_csv_validations
+from .profiling import HyperLogLog
+from .quarantine import quarantine_writer
+from .rollback import rollback_upload
+from .serializers import CustomDutyUploadSerializer, VinSerializer
+from .storage import HashingUploadHandler
+from .utils import get_vin_statuses, process_csv, process_json, process_xml
+from .validators import UPLOAD_FIELD_NAMES, validate_frame
+from .views import multi_vin_results
+
+
+def duty_row(vin, **values):
+    row = dict.fromkeys(UPLOAD_FIELD_NAMES)
+    row.update(vin=vin, brand="Toyota", model="Corolla", payment_status="PAID")
+    row.update(values)
+    return row
+
+
+def csv_bytes(rows, encoding="utf-8"):
+    text = io.StringIO()
+    writer = csv.DictWriter(text, UPLOAD_FIELD_NAMES)
+    writer.writeheader()
+    writer.writerows(rows)
+    return text.getvalue().encode(encoding)
+
+
+def duty_rows(count, start=0):
+    return [duty_row(f"VIN{number:05d}") for number in range(start, start + count)]
+
+
+def create_upload(mode="insert"):
+    return CustomDutyFileUploads.objects.create(
+        uploaded_by="tests",
+        file_name="duties.csv",
+        file_type="csv",
+        file_size=0,
+        mode=mode,
+        status="processing",
+    )
+
+
+def stored_rows():
+    rows = CustomDutyFile.objects.order_by("vin").values(
+        *stored_names(UPLOAD_FIELD_NAMES), "upload"
+    )
+    return decode_rows(list(rows))
+
+
+def row_counts(result):
+    return {
+        name: value
+        for name, value in result["stats"].items()
+        if name not in ("elapsed_seconds", "rows_per_second")
+    }
+
+
+class Crash(BaseException):
+    """
+    Stands in for a worker process dying in the middle of an ingestion.
+    """
+
+
+class UploadStorageMixin:
+    """
+    Keeps files stored by a test in a temporary MEDIA_ROOT.
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def upload(self, content, name="duties.csv", **data):
+        return self.client.post(
+            reverse("upload-vin"),
+            {"file": SimpleUploadedFile(name, content), **data},
+        )
+
+    def stored_files(self):
+        return sorted(
+            name
+            for name in os.listdir(settings.MEDIA_ROOT)
+            if os.path.isfile(os.path.join(settings.MEDIA_ROOT, name))
+        )
+
+
+class AuthenticatedClientMixin:
+    """
+    Sends the test client's requests as a signed-in user.
+    """
+
+    client_class = APIClient
+
+    def setUp(self):
+        super().setUp()
+        user = CustomUser.objects.create(email="uploads@example.com", slug="uploads")
+        self.client.force_authenticate(user)
+
+
+def small_batch_processor(crash_at_batch=None):
+    """
+    A CSV processor that ingests in batches of 3 rows, optionally dying
+    when batch `crash_at_batch` is about to commit.
+    """
+
+    def process(file, checkpoint=None, **options):
+        def save(stats):
+            if stats.batches == crash_at_batch:
+                raise Crash()
+            checkpoint(stats)
+
+        options.setdefault("batch_size", 3)
+        return process_csv(file, checkpoint=save, **options)
+
+    return lambda file_type: process
+
+
+class ValidationParityTests(TestCase):
+    """
+    The column-wise validators reject exactly what saving the rows one by
+    one through CustomDutyUploadSerializer would.
+    """
+
+    def serializer_errors(self, rows):
+        errors = {}
+        with transaction.atomic():
+            for position, row in enumerate(rows):
+                serializer = CustomDutyUploadSerializer(data=row)
+                if serializer.is_valid():
+                    serializer.save()
+                else:
+                    errors[position] = {
+                        field: [str(message) for message in messages]
+                        for field, messages in serializer.errors.items()
+                    }
+            transaction.set_rollback(True)
+        return errors
+
+    def assertParity(self, rows):
+        expected = self.serializer_errors(rows)
+        validation = validate_frame(pd.DataFrame(rows))
+        self.assertEqual(validation.errors, expected)
+        self.assertEqual(
+            validation.invalid.tolist(),
+            [position in expected for position in range(len(rows))],
+        )
+
+    def test_max_length(self):
+        self.assertParity(
+            [
+                duty_row("VIN1", model="M" * 50),
+                duty_row("VIN2", model="M" * 51),
+                duty_row("VIN3", importer_business_name="B" * 501),
+                duty_row("V" * 51),
+            ]
+        )
+
+    def test_non_string_values(self):
+        self.assertParity(
+            [
+                duty_row("VIN1", vehicle_year=2019, hscode=8703.1),
+                duty_row("VIN2", vehicle_year=True),
+                duty_row("VIN3", model={"name": "Corolla"}),
+                duty_row("VIN4", sgd_num=["1", "2"]),
+            ]
+        )
+
+    def test_duplicate_vins_in_batch(self):
+        self.assertParity(
+            [duty_row("VIN1"), duty_row("VIN2"), duty_row("VIN1"), duty_row(None)]
+        )
+
+    def test_duplicate_vins_in_database(self):
+        ingest_rows([duty_row("VIN1")], "Test")
+        self.assertParity([duty_row("VIN1"), duty_row("VIN2")])
+
+    def test_rows_failing_another_rule_do_not_claim_a_vin(self):
+        self.assertParity([duty_row("VIN1", model="M" * 51), duty_row("VIN1")])
+
+
+class CsvIngestionTests(TestCase):
+    def test_batches(self):
+        rows = [duty_row(f"VIN{number}") for number in range(7)]
+        result = process_csv(io.BytesIO(csv_bytes(rows, "utf-8-sig")), batch_size=3)
+        self.assertEqual(result["stats"]["inserted"], 7)
+        self.assertEqual(result["stats"]["batches"], 3)
+        self.assertEqual(
+            sorted(CustomDutyFile.objects.values_list("vin", flat=True)),
+            [row["vin"] for row in rows],
+        )
+
+    def test_invalid_row_keeps_earlier_batches(self):
+        rows = [duty_row(f"VIN{number}") for number in range(7)]
+        rows[4]["model"] = "M" * 51
+        result = process_csv(io.BytesIO(csv_bytes(rows)), batch_size=3)
+        self.assertEqual(result["row"], 5)
+        self.assertEqual(
+            result["details"],
+            {"model": ["Ensure this field has no more than 50 characters."]},
+        )
+        self.assertEqual(result["stats"]["inserted"], 3)
+        self.assertEqual(CustomDutyFile.objects.count(), 3)
+
+
+class CopyWriterTests(TestCase):
+    def test_falls_back_to_the_orm_without_copy(self):
+        expected = write_batch_copy if copy_supported() else write_batch_orm
+        self.assertIs(get_batch_writer("copy"), expected)
+        self.assertIs(get_batch_writer("orm"), write_batch_orm)
+        with self.assertRaises(ValueError):
+            get_batch_writer("bulk")
+
+    def test_copy_keeps_nulls_quotes_and_line_breaks(self):
+        if not copy_supported():
+            self.skipTest("COPY needs PostgreSQL with psycopg2.")
+        rows = [
+            duty_row("VIN1", model='Land "Cruiser", V8', importer_address="Line 1\nLine 2"),
+            duty_row("VIN2", model="", importer_address=None),
+        ]
+        result = ingest_rows(rows, "Test", engine="copy")
+        self.assertEqual(result["stats"]["inserted"], 2)
+        self.assertEqual(
+            list(
+                CustomDutyFile.objects.order_by("vin").values_list(
+                    "model", "importer_address"
+                )
+            ),
+            [('Land "Cruiser", V8', "Line 1\nLine 2"), ("", None)],
+        )
+
+
+class MergeTests(TestCase):
+    def setUp(self):
+        ingest_rows([duty_row("VIN1"), duty_row("VIN2"), duty_row("VIN3")], "Test")
+
+    def test_counts(self):
+        result = ingest_rows(
+            [
+                duty_row("VIN1"),
+                duty_row("VIN2", model="Camry"),
+                duty_row("VIN3", brand="Honda"),
+                duty_row("VIN4"),
+            ],
+            "Test",
+            mode="merge",
+        )
+        stats = result["stats"]
+        self.assertEqual(
+            (stats["inserted"], stats["updated"], stats["unchanged"]), (1, 2, 1)
+        )
+        rows = {row["vin"]: row for row in stored_rows()}
+        self.assertEqual(rows["VIN2"]["model"], "Camry")
+        self.assertEqual(rows["VIN3"]["brand"], "Honda")
+        self.assertEqual(len(rows), 4)
+
+    def test_rows_without_vin_are_rejected(self):
+        result = ingest_rows([duty_row("VIN4"), duty_row("")], "Test", mode="merge")
+        self.assertEqual(result["row"], 2)
+        self.assertEqual(
+            result["details"], {"vin": ["This field is required to merge rows."]}
+        )
+
+    def test_vin_repeated_in_later_batch_is_rejected(self):
+        result = ingest_rows(
+            [duty_row("VIN5"), duty_row("VIN6"), duty_row("VIN5", model="Camry")],
+            "Test",
+            batch_size=2,
+            mode="merge",
+        )
+        self.assertEqual(result["row"], 3)
+        self.assertEqual(result["details"], {"vin": ["vin with this vin already exists."]})
+        self.assertEqual(
+            CustomDutyFile.objects.get(vin="VIN5").model, "Corolla"
+        )
+
+
+class UploadJobTests(UploadStorageMixin, TestCase):
+    def test_upload_is_queued_for_a_worker(self):
+        response = self.upload(csv_bytes(duty_rows(5)))
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "pending")
+        self.assertEqual(CustomDutyFile.objects.count(), 0)
+
+        job = claim_next_job("worker-1")
+        self.assertEqual((job.status, job.worker, job.attempts), ("processing", "worker-1", 1))
+        self.assertIsNone(claim_next_job("worker-2"))
+
+        run_job(job)
+        data = self.client.get(response.json()["status_url"]).json()["data"]
+        self.assertEqual(data["status"], "completed")
+        self.assertEqual(data["rows_inserted"], 5)
+        self.assertEqual(CustomDutyFile.objects.count(), 5)
+
+    def test_stale_job_resumes_after_its_last_committed_batch(self):
+        self.upload(csv_bytes(duty_rows(10)))
+        job = claim_next_job()
+        with mock.patch("vins_search.jobs.get_processor", small_batch_processor(3)):
+            with self.assertRaises(Crash):
+                run_job(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.rows_processed), ("processing", 6))
+        self.assertEqual(CustomDutyFile.objects.count(), 6)
+
+        # Fresh jobs are left alone, stale ones are queued again
+        self.assertEqual(requeue_stale_jobs(60), 0)
+        CustomDutyFileUploads.objects.filter(pk=job.pk).update(
+            heartbeat_at=now() - timedelta(minutes=5)
+        )
+        self.assertEqual(requeue_stale_jobs(60), 1)
+
+        job = claim_next_job()
+        self.assertEqual(job.attempts, 2)
+        with mock.patch("vins_search.jobs.get_processor", small_batch_processor()):
+            job = run_job(job)
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(job.result["resumed_from_row"], 6)
+        self.assertEqual((job.rows_processed, job.rows_inserted), (10, 10))
+        self.assertEqual(
+            sorted(CustomDutyFile.objects.values_list("vin", flat=True)),
+            [row["vin"] for row in duty_rows(10)],
+        )
+
+
+class DuplicateUploadTests(UploadStorageMixin, TestCase):
+    def test_same_content_is_rejected_whatever_its_name(self):
+        content = csv_bytes(duty_rows(3))
+        first = self.upload(content)
+        self.assertEqual(first.status_code, 202)
+
+        second = self.upload(content, name="renamed.csv")
+        self.assertEqual(second.status_code, 400)
+        self.assertEqual(second.json()["message"], "This file already exists.")
+        self.assertEqual(second.json()["job_id"], first.json()["job_id"])
+        self.assertEqual(self.stored_files(), ["duties.csv"])
+
+    def test_failed_upload_is_retried_when_sent_again(self):
+        rows = duty_rows(6)
+        rows[4]["model"] = "M" * 51
+        content = csv_bytes(rows)
+        job_id = self.upload(content).json()["job_id"]
+        with mock.patch("vins_search.jobs.get_processor", small_batch_processor()):
+            job = run_job(claim_next_job())
+        self.assertEqual((job.status, job.rows_processed), ("failed", 3))
+
+        # Rows were written in insert mode, so another mode is refused
+        response = self.upload(content, mode="merge")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("roll the upload back", response.json()["message"])
+
+        response = self.upload(content, name="again.csv")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(
+            response.json()["message"],
+            "This file failed before; its upload was queued again.",
+        )
+        self.assertEqual(response.json()["job_id"], job_id)
+        self.assertEqual(response.json()["status"], "pending")
+        self.assertEqual(CustomDutyFileUploads.objects.count(), 1)
+        self.assertEqual(self.stored_files(), ["duties.csv"])
+
+
+class ChunkedUploadTests(AuthenticatedClientMixin, UploadStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        temp_dir_setting = mock.patch("vins_search.models.CHUNKED_UPLOAD_TEMP_DIR", temp_dir)
+        temp_dir_setting.start()
+        self.addCleanup(temp_dir_setting.stop)
+
+    def start(self, content, checksum=None):
+        response = self.client.post(
+            reverse("chunked-upload-init"),
+            {
+                "file_name": "duties.csv",
+                "file_size": len(content),
+                "checksum": checksum or hashlib.sha256(content).hexdigest(),
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.json()["data"]["upload_id"]
+
+    def send(self, upload_id, chunk, offset):
+        return self.client.put(
+            f"{reverse('chunked-upload', args=[upload_id])}?offset={offset}",
+            chunk,
+            content_type="application/octet-stream",
+        )
+
+    def complete(self, upload_id):
+        return self.client.post(reverse("chunked-upload-complete", args=[upload_id]))
+
+    def test_requires_authentication(self):
+        self.client.force_authenticate(None)
+        response = self.client.post(reverse("chunked-upload-init"), {}, format="json")
+        self.assertEqual(response.status_code, 401)
+
+    def test_chunks_are_appended_at_the_expected_offset(self):
+        content = csv_bytes(duty_rows(20))
+        middle = len(content) // 2
+        upload_id = self.start(content)
+
+        response = self.send(upload_id, content[:middle], 0)
+        self.assertEqual(response.json(), {"offset": middle, "complete": False})
+
+        # A chunk sent twice is refused with the offset to resume from
+        response = self.send(upload_id, content[:middle], 0)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], middle)
+        response = self.client.get(reverse("chunked-upload", args=[upload_id]))
+        self.assertEqual(response.json()["data"]["offset"], middle)
+        self.assertEqual(self.complete(upload_id).status_code, 400)
+
+        response = self.send(upload_id, content[middle:], middle)
+        self.assertEqual(response.json(), {"offset": len(content), "complete": True})
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 202)
+        job = CustomDutyFileUploads.objects.get(job_id=response.json()["job_id"])
+        self.assertEqual(job.content_hash, hashlib.sha256(content).hexdigest())
+        self.assertEqual(job.file.read(), content)
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["job_id"], str(job.job_id))
+
+    def test_checksum_mismatch_discards_the_bytes(self):
+        content = csv_bytes(duty_rows(3))
+        upload_id = self.start(content, checksum="0" * 64)
+        self.send(upload_id, content, 0)
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["offset"], 0)
+        chunked = ChunkedUpload.objects.get(upload_id=upload_id)
+        self.assertEqual((chunked.offset, chunked.status), (0, "uploading"))
+        self.assertFalse(os.path.exists(chunked.temp_path))
+        self.assertFalse(CustomDutyFileUploads.objects.exists())
+
+    def test_change_while_hashing_is_not_completed(self):
+        content = csv_bytes(duty_rows(3))
+        upload_id = self.start(content)
+        self.send(upload_id, content, 0)
+
+        def touch_then_hash(path):
+            # Another request saves the upload while its file is being read
+            ChunkedUpload.objects.filter(upload_id=upload_id).update(updated_at=now())
+            return hashlib.sha256(content).hexdigest()
+
+        with mock.patch("vins_search.views.file_sha256", touch_then_hash):
+            response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(CustomDutyFileUploads.objects.exists())
+
+        self.assertEqual(self.complete(upload_id).status_code, 202)
+
+
+class JsonIngestionTests(TestCase):
+    rows = [duty_row(f"VIN{number}", model=f"Model {number}") for number in range(20)]
+
+    def test_array_is_read_in_chunks(self):
+        file = io.BytesIO(json.dumps(self.rows).encode())
+        records = iter_json_records(file, chunk_size=64)
+        self.assertEqual(next(records), self.rows[0])
+        self.assertLess(file.tell(), len(file.getvalue()) // 4)
+        self.assertEqual([self.rows[0], *records], self.rows)
+
+    def test_json_lines(self):
+        data = "\n".join(json.dumps(row) for row in self.rows).encode()
+        self.assertEqual(list(iter_json_records(io.BytesIO(data), chunk_size=7)), self.rows)
+
+    def test_multibyte_characters_across_chunks(self):
+        rows = [duty_row("VIN1", importer_address="Rue de l'Église, Lomé")]
+        data = json.dumps(rows, ensure_ascii=False).encode()
+        self.assertEqual(list(iter_json_records(io.BytesIO(data), chunk_size=3)), rows)
+
+    def test_rejects_values_that_are_not_objects(self):
+        with self.assertRaises(json.JSONDecodeError):
+            list(iter_json_records(io.BytesIO(b'[{"vin": "VIN1"}, 3]')))
+
+    def test_rows_are_inserted_in_batches(self):
+        result = process_json(io.BytesIO(json.dumps(self.rows[:10]).encode()), batch_size=3)
+        self.assertEqual(result["stats"]["inserted"], 10)
+        self.assertEqual(result["stats"]["batches"], 4)
+        self.assertEqual(stored_rows()[0]["model"], "Model 0")
+
+
+class XmlIngestionTests(TestCase):
+    rows = [duty_row(f"VIN{number}", model=f"Model {number}") for number in range(10)]
+
+    def test_records(self):
+        data = "<records>{}</records>".format(
+            "".join(
+                "<record>{}</record>".format(
+                    "".join(
+                        f"<{name}>{value}</{name}>"
+                        for name, value in row.items()
+                        if value is not None
+                    )
+                )
+                for row in self.rows
+            )
+        ).encode()
+        self.assertEqual(list(iter_xml_records(io.BytesIO(data))), self.rows)
+
+    def test_configured_mapping(self):
+        data = b"""
+            <Export xmlns="urn:customs">
+                <Declaration vin="VIN1"><Vehicle><Make>Toyota</Make></Vehicle></Declaration>
+                <Declaration vin="VIN2"><Vehicle /></Declaration>
+            </Export>
+        """
+        mapping = {
+            "record_tag": "Declaration",
+            "fields": {"@vin": "vin", "Vehicle/Make": "brand"},
+        }
+        self.assertEqual(
+            list(iter_xml_records(io.BytesIO(data), mapping)),
+            [{"vin": "VIN1", "brand": "Toyota"}, {"vin": "VIN2", "brand": None}],
+        )
+
+    def test_rows_are_inserted_in_batches(self):
+        xml = (
+            '<records xmlns="urn:duties">'
+            + "".join(
+                f"<record><vin>{row['vin']}</vin><brand>{row['brand']}</brand></record>"
+                for row in self.rows
+            )
+            + "</records>"
+        ).encode()
+        result = process_xml(io.BytesIO(xml), batch_size=4)
+        self.assertEqual(result["stats"]["inserted"], 10)
+        self.assertEqual(result["stats"]["batches"], 3)
+        self.assertEqual(CustomDutyFile.objects.count(), 10)
+
+
+class ExcelIngestionTests(UploadStorageMixin, TestCase):
+    def workbook_bytes(self, rows):
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for row in rows:
+            sheet.append(row)
+        content = io.BytesIO()
+        workbook.save(content)
+        return content.getvalue()
+
+    def test_xlsx_upload_is_streamed_into_the_table(self):
+        content = self.workbook_bytes(
+            [
+                ["notes", "vin", "brand", "vehicle_year", "sgd_date"],
+                ["ignored", "VIN1", "Toyota", 2019, date(2024, 3, 1)],
+                [None, None, None, None, None],
+                ["ignored", "VIN2", "Honda", None, None],
+            ]
+        )
+        response = self.upload(content, name="duties.xlsx")
+        self.assertEqual(response.status_code, 202)
+
+        job = run_job(claim_next_job())
+        self.assertEqual((job.file_type, job.status), ("excel", "completed"))
+        self.assertEqual(job.rows_inserted, 2)
+        rows = stored_rows()
+        self.assertEqual(
+            [(row["vin"], row["brand"], row["vehicle_year"], row["sgd_date"]) for row in rows],
+            [("VIN1", "Toyota", "2019", "2024-03-01"), ("VIN2", "Honda", None, None)],
+        )
+
+
+class ParallelIngestionTests(TestCase):
+    def csv_path(self, rows):
+        file = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        self.addCleanup(os.remove, file.name)
+        with file:
+            file.write(csv_bytes(rows))
+        return file.name
+
+    def serial_result(self, path):
+        with open(path, "rb") as file:
+            result = process_csv(file, batch_size=4)
+        rows = stored_rows()
+        CustomDutyFile.objects.all().delete()
+        return row_counts(result), rows
+
+    def test_parallel_ranges_match_a_serial_run(self):
+        rows = duty_rows(30)
+        rows[7]["importer_address"] = 'Plot 3, "Harbour" Road'
+        path = self.csv_path(rows)
+        stats, expected = self.serial_result(path)
+
+        # Read from a thread, as uploads are, with ranges of a few lines
+        validations = []
+        reader = threading.Thread(
+            target=lambda: validations.extend(
+                parallel_csv_validations(path, batch_size=4, workers=2, range_size=300)
+            )
+        )
+        reader.start()
+        reader.join()
+        self.assertEqual([len(validation.frame) for validation in validations], [4] * 7 + [2])
+
+        result = ingest_validations(iter(validations), "CSV")
+        self.assertEqual(row_counts(result), stats)
+        self.assertEqual(stored_rows(), expected)
+
+    def test_quoted_line_break_falls_back_to_serial(self):
+        rows = duty_rows(10)
+        rows[2]["importer_address"] = "Plot 3\nHarbour Road"
+        path = self.csv_path(rows)
+        self.assertIsNone(parallel_csv_validations(path, workers=2, range_size=100))
+
+        stats, expected = self.serial_result(path)
+        with open(path, "rb") as file:
+            result = process_csv(file, batch_size=4, workers=2)
+        self.assertEqual(row_counts(result), stats)
+        self.assertEqual(stored_rows(), expected)
+
+
+class QuarantineTests(AuthenticatedClientMixin, UploadStorageMixin, TestCase):
+    def test_bisection_isolates_rejected_rows(self):
+        written = []
+
+        def write(rows, using=None):
+            if any(row["vin"].startswith("BAD") for row in rows):
+                raise IntegrityError(f"rejected {len(rows)} rows")
+            written.extend(row["vin"] for row in rows)
+
+        rows = [{"vin": vin} for vin in ["A", "BAD1", "B", "C", "D", "BAD2", "E"]]
+        failed = write_isolating_failures(rows, write)
+        self.assertEqual(
+            failed, [(1, "rejected 1 rows"), (5, "rejected 1 rows")]
+        )
+        self.assertEqual(sorted(written), ["A", "B", "C", "D", "E"])
+
+    def test_rows_the_database_rejects_are_quarantined(self):
+        ingest_rows([duty_row("VIN2")], "Test")
+        upload = create_upload()
+        rows = [duty_row(f"VIN{number}") for number in range(1, 6)]
+        rows[3]["model"] = "M" * 51
+        # Let the stored VIN through validation so only the database rejects it
+        with mock.patch("vins_search.validators.existing_vins", return_value=set()):
+            result = ingest_rows(
+                rows, "Test", upload=upload, on_invalid=quarantine_writer(upload)
+            )
+
+        self.assertEqual(result["stats"]["inserted"], 3)
+        self.assertEqual(result["stats"]["quarantined"], 2)
+        quarantined = list(upload.quarantined_rows.order_by("row_number"))
+        self.assertEqual([row.row_number for row in quarantined], [2, 4])
+        self.assertEqual(quarantined[0].data["vin"], "VIN2")
+        self.assertIn("non_field_errors", quarantined[0].errors)
+        self.assertEqual(
+            quarantined[1].errors,
+            {"model": ["Ensure this field has no more than 50 characters."]},
+        )
+        self.assertEqual(
+            set(upload.custom_duties.values_list("vin", flat=True)),
+            {"VIN1", "VIN3", "VIN5"},
+        )
+
+    def test_corrected_rows_are_resubmitted(self):
+        rows = duty_rows(6)
+        rows[1]["model"] = "M" * 51
+        rows[4]["vin"] = "V" * 51
+        response = self.upload(csv_bytes(rows), tolerant="true")
+        job = run_job(claim_next_job())
+        self.assertEqual((job.status, job.rows_inserted, job.rows_quarantined), ("completed", 4, 2))
+
+        url = reverse("upload-quarantine", args=[response.json()["job_id"]])
+        download = b"".join(self.client.get(url).streaming_content).decode()
+        lines = list(csv.DictReader(io.StringIO(download)))
+        self.assertEqual([line["row_number"] for line in lines], ["2", "5"])
+        self.assertIn("model", json.loads(lines[0]["errors"]))
+
+        # Only the first row is corrected; the other stays quarantined
+        lines[0]["model"] = "Corolla"
+        corrected = io.StringIO()
+        writer = csv.DictWriter(corrected, lines[0].keys())
+        writer.writeheader()
+        writer.writerows(lines)
+        response = self.client.post(
+            url, {"file": SimpleUploadedFile("fixed.csv", corrected.getvalue().encode())}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["stats"]["inserted"], 1)
+        self.assertEqual(response.json()["rows_quarantined"], 1)
+        self.assertTrue(CustomDutyFile.objects.filter(vin=rows[1]["vin"]).exists())
+        self.assertEqual(
+            list(job.quarantined_rows.values_list("row_number", flat=True)), [5]
+        )
+
+
+class RollbackTests(AuthenticatedClientMixin, UploadStorageMixin, TestCase):
+    def test_merge_upload(self):
+        first = create_upload()
+        ingest_rows(
+            [duty_row("VIN1"), duty_row("VIN2"), duty_row("VIN3")],
+            "Test",
+            upload=first,
+        )
+        before = stored_rows()
+
+        second = create_upload(mode="merge")
+        ingest_rows(
+            [
+                duty_row("VIN1"),
+                duty_row("VIN2", model="Camry", payment_status="UNPAID"),
+                duty_row("VIN4"),
+            ],
+            "Test",
+            mode="merge",
+            upload=second,
+        )
+        self.assertEqual(second.revisions.count(), 1)
+
+        counts = rollback_upload(second, chunk_size=1)
+        self.assertEqual(counts, {"restored": 1, "deleted": 1})
+        self.assertEqual(stored_rows(), before)
+        self.assertFalse(CustomDutyFile.objects.get(vin="VIN2").is_unpaid)
+        self.assertEqual(second.revisions.count(), 0)
+
+    def test_rows_rewritten_by_a_later_upload_are_kept(self):
+        first = create_upload(mode="merge")
+        ingest_rows([duty_row("VIN1")], "Test", mode="merge", upload=first)
+        second = create_upload(mode="merge")
+        ingest_rows(
+            [duty_row("VIN1", model="Camry")], "Test", mode="merge", upload=second
+        )
+
+        self.assertEqual(rollback_upload(first), {"restored": 0, "deleted": 0})
+        self.assertEqual(CustomDutyFile.objects.get(vin="VIN1").model, "Camry")
+
+    def test_rollback_is_queued_for_a_worker(self):
+        ingest_rows(duty_rows(3), "Test", upload=create_upload())
+        before = stored_rows()
+        rows = duty_rows(4)
+        rows[0]["model"] = "Camry"
+        content = csv_bytes(rows)
+        job_id = self.upload(content, mode="merge").json()["job_id"]
+        run_job(claim_next_job())
+
+        url = reverse("upload-rollback", args=[job_id])
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], "rollback_pending")
+        job = run_job(claim_next_job())
+        self.assertEqual(job.status, "rolled_back")
+        self.assertEqual(stored_rows(), before)
+
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()["message"], "An upload that is rolled_back cannot be rolled back."
+        )
+        # Its rows are gone, so the same file may be sent again
+        self.assertEqual(self.upload(content, name="again.csv").status_code, 202)
+
+
+class ReplaceTests(UploadStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        ingest_rows([duty_row(f"VIN{number}") for number in range(10)], "Test")
+
+    def assertUnchanged(self):
+        self.assertEqual(
+            list(CustomDutyFile.objects.order_by("vin").values_list("vin", "model")),
+            [(f"VIN{number}", "Corolla") for number in range(10)],
+        )
+
+    def test_replaces_dataset(self):
+        rows = [duty_row(f"VIN{number}", model="Camry") for number in range(5, 15)]
+        result = ingest_rows(rows, "Test", mode="replace")
+        self.assertEqual(result["replaced_rows"], 10)
+        self.assertEqual(
+            list(CustomDutyFile.objects.order_by("vin").values_list("vin", "model")),
+            sorted((row["vin"], "Camry") for row in rows),
+        )
+
+    def test_rejects_incomplete_file(self):
+        result = ingest_rows([duty_row("VIN1"), duty_row("VIN2")], "Test", mode="replace")
+        self.assertIn("the file looks incomplete", result["details"])
+        self.assertUnchanged()
+
+    def test_rejects_vin_repeated_across_batches(self):
+        rows = [duty_row(f"VIN{number}") for number in range(10)] + [duty_row("VIN3")]
+        result = ingest_rows(rows, "Test", batch_size=4, mode="replace")
+        self.assertEqual(result["details"], "VIN VIN3 appears more than once in the file.")
+        self.assertUnchanged()
+
+    def test_rejects_invalid_row(self):
+        rows = [duty_row(f"VIN{number}") for number in range(10)]
+        rows[7]["model"] = "M" * 51
+        result = ingest_rows(rows, "Test", mode="replace")
+        self.assertEqual(result["row"], 8)
+        self.assertUnchanged()
+
+    def test_uploaded_refresh_is_swapped_in(self):
+        rows = [duty_row(f"VIN{number}", model="Camry") for number in range(3, 13)]
+        self.upload(csv_bytes(rows), mode="replace")
+        job = run_job(claim_next_job())
+        self.assertEqual(job.status, "completed")
+        self.assertEqual(job.result["replaced_rows"], 10)
+        self.assertEqual(
+            set(CustomDutyFile.objects.values_list("upload", flat=True)), {job.pk}
+        )
+        self.assertEqual(
+            list(CustomDutyFile.objects.order_by("vin").values_list("vin", "model")),
+            sorted((row["vin"], "Camry") for row in rows),
+        )
+
+
+class TypedFieldTests(TestCase):
+    rows = [
+        duty_row("VIN1", vehicle_year="2015", sgd_date="2024-03-01", payment_status="UNPAID"),
+        duty_row("VIN2", vehicle_year="2018.0", sgd_date="2024-03-01T10:30:00", payment_status="paid"),
+        duty_row("VIN3", vehicle_year="1850", sgd_date="01/03/2024", payment_status="Unpaid"),
+        duty_row("VIN4", vehicle_year="n/a", sgd_date="1-Mar-24", payment_status=None),
+        duty_row("VIN5", vehicle_year=None, sgd_date="yesterday"),
+    ]
+    expected = [
+        ("VIN1", 2015, date(2024, 3, 1), True),
+        ("VIN2", 2018, date(2024, 3, 1), False),
+        ("VIN3", None, date(2024, 3, 1), True),
+        ("VIN4", None, date(2024, 3, 1), None),
+        ("VIN5", None, None, False),
+    ]
+
+    def typed_values(self):
+        return list(
+            CustomDutyFile.objects.order_by("vin").values_list(
+                "vin", "vehicle_year_value", "sgd_date_value", "is_unpaid"
+            )
+        )
+
+    def test_parsed_on_ingestion(self):
+        ingest_rows(self.rows, "Test")
+        self.assertEqual(self.typed_values(), self.expected)
+        self.assertEqual(
+            list(
+                CustomDutyFile.objects.filter(
+                    is_unpaid=True, vehicle_year_value__range=(2015, 2018)
+                ).values_list("vin", flat=True)
+            ),
+            ["VIN1"],
+        )
+
+    def test_backfill(self):
+        ingest_rows(self.rows, "Test")
+        CustomDutyFile.objects.update(
+            vehicle_year_value=None, sgd_date_value=None, is_unpaid=None
+        )
+        call_command("backfill_typed_fields", chunk_size=2, stdout=io.StringIO())
+        self.assertEqual(self.typed_values(), self.expected)
+
+
+class DictionaryEncodingTests(TestCase):
+    def setUp(self):
+        # Rows stored before the encoded columns existed
+        CustomDutyFile.objects.bulk_create(
+            [
+                CustomDutyFile(vin="VIN1", brand="Toyota", payment_status="PAID"),
+                CustomDutyFile(vin="VIN2", brand="Toyota", payment_status="UNPAID"),
+                CustomDutyFile(vin="VIN3", brand="Honda"),
+            ]
+        )
+
+    def test_rows_not_encoded_yet_are_read_from_text(self):
+        self.assertEqual(
+            [(row["vin"], row["brand"], row["payment_status"]) for row in stored_rows()],
+            [("VIN1", "Toyota", "PAID"), ("VIN2", "Toyota", "UNPAID"), ("VIN3", "Honda", None)],
+        )
+        vin = CustomDutyFile.objects.get(vin="VIN2")
+        self.assertEqual(VinSerializer(vin).data["brand"], "Toyota")
+
+        user = CustomUser.objects.create(email="search@example.com", slug="search")
+        with mock.patch("vins_search.models.qrcode.make", wraps=qrcode.make) as make:
+            VinSearchHistory.objects.create(user=user, vin=vin)
+        self.assertIn("payment_status: UNPAID,", make.call_args.args[0])
+
+    def test_encode_command(self):
+        call_command("encode_dictionary_fields", chunk_size=2, stdout=io.StringIO())
+        self.assertEqual(
+            sorted(Brand.objects.values_list("value", flat=True)), ["Honda", "Toyota"]
+        )
+        encoded = CustomDutyFile.objects.order_by("vin")
+        self.assertEqual(
+            [row.brand_ref.value for row in encoded], ["Toyota", "Toyota", "Honda"]
+        )
+        self.assertIsNone(encoded.get(vin="VIN3").payment_status_ref)
+        self.assertEqual(
+            [(row["vin"], row["brand"]) for row in stored_rows()],
+            [("VIN1", "Toyota"), ("VIN2", "Toyota"), ("VIN3", "Honda")],
+        )
+
+    def test_merge_clears_the_text_it_replaces(self):
+        ingest_rows([duty_row("VIN1", brand=None)], "Test", mode="merge")
+        vin = CustomDutyFile.objects.get(vin="VIN1")
+        self.assertIsNone(vin.brand)
+        self.assertIsNone(VinSerializer(vin).data["brand"])
+
+
+class InboxTests(UploadStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.inbox = Inbox()
+
+    def drop(self, content, name="duties.csv", **options):
+        with open(os.path.join(self.inbox.root, name), "wb") as file:
+            file.write(content)
+        [name] = self.inbox.new_files()
+        return self.inbox.ingest(self.inbox.claim(name), **options)
+
+    def test_file_is_ingested_and_filed_away(self):
+        manifest = self.drop(csv_bytes(duty_rows(4)))
+        self.assertEqual(manifest["status"], "completed")
+        self.assertEqual(manifest["stored_as"], "inbox/done/duties.csv")
+        job = CustomDutyFileUploads.objects.get()
+        self.assertEqual((job.source, job.file.name), ("inbox", "inbox/done/duties.csv"))
+        self.assertEqual(CustomDutyFile.objects.count(), 4)
+        with open(self.inbox.storage.path("inbox/done/duties.csv.manifest.json")) as file:
+            self.assertEqual(json.load(file)["job_id"], str(job.job_id))
+
+        manifest = self.drop(csv_bytes(duty_rows(4)), name="again.csv")
+        self.assertEqual(manifest["stored_as"], "inbox/failed/again.csv")
+        self.assertEqual(manifest["result"]["error"], "This file already exists.")
+        self.assertEqual(manifest["result"]["job_id"], str(job.job_id))
+
+    def test_failed_upload_is_retried_when_dropped_again(self):
+        content = csv_bytes(duty_rows(4))
+
+        def unavailable(file, **options):
+            return {"error": "Database unavailable."}
+
+        with mock.patch("vins_search.jobs.get_processor", return_value=unavailable):
+            self.assertEqual(self.drop(content)["status"], "failed")
+        job = CustomDutyFileUploads.objects.get()
+
+        # Rows written in insert mode cannot be sent again in merge mode
+        CustomDutyFileUploads.objects.filter(pk=job.pk).update(rows_processed=2)
+        manifest = self.drop(content, name="merged.csv", mode="merge")
+        self.assertIn("roll the upload back", manifest["result"]["error"])
+        CustomDutyFileUploads.objects.filter(pk=job.pk).update(rows_processed=0)
+
+        manifest = self.drop(content, name="again.csv")
+        self.assertEqual(manifest["status"], "completed")
+        self.assertEqual(manifest["job_id"], job.job_id)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.source, job.attempts), ("completed", "inbox", 2))
+        self.assertEqual(job.file.name, "inbox/done/again.csv")
+        self.assertEqual(CustomDutyFile.objects.count(), 4)
+
+
+class CompressedUploadTests(UploadStorageMixin, TestCase):
+    def ingest(self, content, name):
+        self.assertEqual(self.upload(content, name=name, tolerant="true").status_code, 202)
+        return run_job(claim_next_job())
+
+    def test_gzip_csv(self):
+        job = self.ingest(gzip.compress(csv_bytes(duty_rows(5))), "duties.csv.gz")
+        self.assertEqual((job.file_type, job.status, job.rows_inserted), ("csv.gz", "completed", 5))
+        self.assertEqual(self.stored_files(), ["duties.csv.gz"])
+
+    def test_bzip2_json(self):
+        job = self.ingest(bz2.compress(json.dumps(duty_rows(5)).encode()), "duties.json.bz2")
+        self.assertEqual((job.file_type, job.status, job.rows_inserted), ("json.bz2", "completed", 5))
+
+    def test_zip_members_are_numbered_through_the_archive(self):
+        second = duty_rows(4, start=3)
+        second[1]["model"] = "M" * 51
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as members:
+            members.writestr("a/first.csv", csv_bytes(duty_rows(3)))
+            members.writestr("b/second.json", json.dumps(second))
+            members.writestr("__MACOSX/a/._first.csv", b"")
+            members.writestr("notes.txt", b"Not a data file")
+
+        job = self.ingest(archive.getvalue(), "duties.zip")
+        self.assertEqual(job.file_type, "zip")
+        self.assertEqual((job.status, job.rows_inserted, job.rows_quarantined), ("completed", 6, 1))
+        self.assertEqual(
+            list(job.quarantined_rows.values_list("row_number", flat=True)), [5]
+        )
+        self.assertEqual(CustomDutyFile.objects.count(), 6)
+
+
+@skipIf(pa is None, "Parquet files need pyarrow.")
+class ParquetTests(AuthenticatedClientMixin, UploadStorageMixin, TestCase):
+    def test_typed_columns_are_stored_as_text(self):
+        table = pa.table(
+            {
+                "vin": ["VIN1", "VIN2"],
+                "brand": ["Toyota", None],
+                "vehicle_year": pa.array([2019, None], pa.int64()),
+                "sgd_date": pa.array([date(2024, 3, 1), None], pa.date32()),
+                "ignored": [1.5, 2.5],
+            }
+        )
+        content = io.BytesIO()
+        pa.parquet.write_table(table, content, row_group_size=1)
+        self.upload(content.getvalue(), name="duties.parquet")
+
+        job = run_job(claim_next_job())
+        self.assertEqual((job.file_type, job.status, job.rows_inserted), ("parquet", "completed", 2))
+        self.assertEqual(
+            [(row["vin"], row["brand"], row["vehicle_year"], row["sgd_date"]) for row in stored_rows()],
+            [("VIN1", "Toyota", "2019", "2024-03-01"), ("VIN2", None, None, None)],
+        )
+
+    def test_export_can_be_uploaded_again(self):
+        rows = duty_rows(5)
+        ingest_rows(rows, "Test")
+
+        response = self.client.get(reverse("data-export-parquet"))
+        self.assertEqual(response.status_code, 200)
+        content = b"".join(response.streaming_content)
+        self.assertEqual(pa.parquet.read_table(io.BytesIO(content)).to_pylist(), rows)
+
+        CustomDutyFile.objects.all().delete()
+        self.upload(content, name="export.parquet")
+        job = run_job(claim_next_job())
+        self.assertEqual(job.rows_inserted, 5)
+        self.assertEqual(stored_rows(), [{**row, "upload": job.pk} for row in rows])
+
+
+class ProfileTests(UploadStorageMixin, TestCase):
+    def test_distinct_estimate(self):
+        # These VINs are estimated at 90952 before the bound applies
+        sketch = HyperLogLog()
+        sketch.add([row["vin"] for row in duty_rows(90000)])
+        self.assertEqual(sketch.count(), 90000)
+
+        half = HyperLogLog()
+        half.add([f"V{number}" for number in range(50000)] * 2)
+        other = HyperLogLog()
+        other.add([f"V{number}" for number in range(25000, 75000)])
+        half.merge(other)
+        self.assertAlmostEqual(half.count(), 75000, delta=75000 * 0.03)
+
+        few = HyperLogLog()
+        few.add(["Toyota", "Honda", "Toyota", "Kia"])
+        self.assertEqual(few.count(), 3)
+
+    def test_upload_profile(self):
+        rows = duty_rows(6)
+        for row, brand in zip(rows, ["Toyota", "Honda", None, "Toyota", "Kia", ""]):
+            row["brand"] = brand
+        rows[5]["payment_status"] = "UNPAID"
+        self.upload(csv_bytes(rows))
+
+        profile = run_job(claim_next_job()).profile
+        self.assertEqual(profile["rows"], 6)
+        self.assertEqual(profile["vin_lengths"], {"8": 6})
+        self.assertEqual(profile["columns"]["vin"]["distinct"], 6)
+        self.assertEqual(
+            profile["columns"]["brand"],
+            {"nulls": 2, "null_rate": 0.3333, "distinct": 3},
+        )
+        self.assertEqual(
+            profile["columns"]["payment_status"]["values"], {"PAID": 5, "UNPAID": 1}
+        )
+
+
+class ImportCommandTests(UploadStorageMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = csv_bytes(duty_rows(10))
+        file = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        self.addCleanup(os.remove, file.name)
+        with file:
+            file.write(self.content)
+        self.path = file.name
+
+    def run_import(self, processor=None):
+        output = io.StringIO()
+        with mock.patch(
+            "vins_search.management.commands.import_duty_data.get_processor",
+            processor or small_batch_processor(),
+        ):
+            call_command(
+                "import_duty_data", self.path, batch_size=3, stale_after=0, stdout=output
+            )
+        return output.getvalue()
+
+    def test_interrupted_import_resumes(self):
+        with self.assertRaises(Crash):
+            self.run_import(small_batch_processor(3))
+        job = CustomDutyFileUploads.objects.get()
+        self.assertEqual((job.source, job.status, job.rows_processed), ("import", "processing", 6))
+
+        output = self.run_import()
+        self.assertIn("resuming after row 6", output)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.rows_inserted), ("completed", 2, 10))
+        self.assertEqual(job.result["resumed_from_row"], 6)
+        self.assertEqual(CustomDutyFile.objects.count(), 10)
+
+        self.assertIn("already imported", self.run_import())
+
+    def test_failed_upload_is_taken_over(self):
+        self.upload(self.content)
+        with mock.patch("vins_search.jobs.get_processor", small_batch_processor(3)):
+            with self.assertRaises(Crash):
+                run_job(claim_next_job())
+        CustomDutyFileUploads.objects.update(status="failed")
+
+        self.run_import()
+        job = CustomDutyFileUploads.objects.get()
+        self.assertEqual((job.source, job.status, job.rows_inserted), ("import", "completed", 10))
+        self.assertEqual(job.result["resumed_from_row"], 6)
+
+
+class UploadHashTests(UploadStorageMixin, TestCase):
+    def assertStoredWithHash(self, content):
+        response = self.upload(content)
+        self.assertEqual(response.status_code, 202)
+        job = CustomDutyFileUploads.objects.get(job_id=response.json()["job_id"])
+        self.assertEqual(job.content_hash, hashlib.sha256(content).hexdigest())
+        self.assertEqual(job.file_size, len(content))
+        with job.file.open("rb") as file:
+            self.assertEqual(file.read(), content)
+
+    def test_upload_kept_in_memory(self):
+        self.assertStoredWithHash(csv_bytes(duty_rows(5)))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_upload_streamed_to_disk_is_hashed_as_received(self):
+        content = csv_bytes(duty_rows(2000))
+        with mock.patch.object(
+            HashingUploadHandler,
+            "receive_data_chunk",
+            autospec=True,
+            side_effect=HashingUploadHandler.receive_data_chunk,
+        ) as receive:
+            self.assertStoredWithHash(content)
+        self.assertGreater(receive.call_count, 1)
+        # The temporary file was renamed into place, not copied
+        incoming = os.path.join(settings.MEDIA_ROOT, ".incoming")
+        self.assertEqual(os.listdir(incoming), [])
+        self.assertEqual(self.stored_files(), ["duties.csv"])
+
+
+def echo_vin_status(vin, timeout=None):
+    return {"vin": vin, "year": "2019"}
+
+
+class MultiVinSearchTests(AuthenticatedClientMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # VINs are stored as uploaded, whatever their case
+        ingest_rows([duty_row("VIN1"), duty_row("vin2"), duty_row("VIN3")], "Test")
+
+    def search(self, *vins):
+        return self.client.get("/vin/single-multi-search/", {"vins": ",".join(vins)})
+
+    def test_results_follow_the_input_order(self):
+        with mock.patch("vins_search.utils.get_vin_status", side_effect=echo_vin_status) as lookup:
+            response = self.search(" vin2", "MISSING", "vin1 ", "VIN2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(result["vin"], result.get("status")) for result in response.json()["data"]],
+            [("vin2", None), ("MISSING", "Not found in database"), ("VIN1", None)],
+        )
+        # VINs missing from the database are never sent to the API
+        self.assertEqual(sorted(call.args[0] for call in lookup.call_args_list), ["VIN1", "VIN2"])
+
+    def test_stored_vins_are_read_in_one_query(self):
+        with mock.patch("vins_search.utils.get_vin_status", side_effect=echo_vin_status):
+            with CaptureQueriesContext(connection) as queries:
+                results = multi_vin_results(["VIN1", "VIN2", "VIN3", "VIN4"])
+        table = CustomDutyFile._meta.db_table
+        self.assertEqual(
+            len([query for query in queries if f'FROM "{table}"' in query["sql"]]), 1
+        )
+        self.assertEqual([result.get("brand") for result in results], ["Toyota"] * 3 + [None])
+
+    def test_upload(self):
+        workbook = openpyxl.Workbook()
+        workbook.active.append(["vin"])
+        for vin in ["vin3", "VIN3", None, "VIN1"]:
+            workbook.active.append([vin])
+        content = io.BytesIO()
+        workbook.save(content)
+        with mock.patch("vins_search.utils.get_vin_status", side_effect=echo_vin_status):
+            response = self.client.post(
+                "/vin/multi-upload-search/",
+                {"file": SimpleUploadedFile("vins.xlsx", content.getvalue())},
+            )
+        self.assertEqual([result["vin"] for result in response.json()["data"]], ["VIN3", "VIN1"])
+
+
+    def test_lookups_run_concurrently(self):
+        def slow(vin, timeout=None):
+            time.sleep(0.2)
+            return echo_vin_status(vin)
+
+        started = time.perf_counter()
+        with mock.patch("vins_search.utils.get_vin_status", side_effect=slow):
+            statuses = get_vin_statuses([f"VIN{number}" for number in range(8)], workers=8)
+        self.assertLess(time.perf_counter() - started, 0.2 * 4)
+        self.assertEqual(len(statuses), 8)
+
+    def test_deadline_returns_partial_results(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def stuck_on_vin3(vin, timeout=None):
+            if vin == "VIN3":
+                released.wait(5)
+            return echo_vin_status(vin)
+
+        with mock.patch("vins_search.utils.get_vin_status", side_effect=stuck_on_vin3):
+            with mock.patch(
+                "vins_search.views.get_vin_statuses", partial(get_vin_statuses, deadline=0.2)
+            ):
+                started = time.perf_counter()
+                response = self.search("VIN3", "VIN1", "VIN2")
+        self.assertLess(time.perf_counter() - started, 2)
+        self.assertEqual(
+            response.json()["data"][0],
+            {"vin": "VIN3", "error": "External API did not respond in time"},
+        )
+        self.assertEqual(
+            [result["vin"] for result in response.json()["data"][1:]], ["VIN1", "vin2"]
+        )
@@ -1,9 +1,16 @@
 from django.urls import path
 
 from vins_search.views import (
+    ChunkedUploadAPIView,
+    ChunkedUploadCompleteAPIView,
+    ChunkedUploadInitAPIView,
+    CustomDutyExportAPIView,
     SingleMultiVinSearchAPIView,
     UploadFileAPIView,
+    UploadJobStatusAPIView,
     UploadMultiVinsAPIView,
+    UploadQuarantineAPIView,
+    UploadRollbackAPIView,
     VINSearchHistoryDetailAPIView,
     VINSearchHistoryListAPIView,
 )
@@ -17,6 +24,41 @@ urlpatterns = [
     ),
     path("multi-upload-search/", UploadMultiVinsAPIView.as_view(), name="multi_search"),
     path("data-upload/", UploadFileAPIView.as_view(), name="upload-vin"),
+    path(
+        "data-upload/chunked/",
+        ChunkedUploadInitAPIView.as_view(),
+        name="chunked-upload-init",
+    ),
+    path(
+        "data-upload/chunked/<uuid:upload_id>/",
+        ChunkedUploadAPIView.as_view(),
+        name="chunked-upload",
+    ),
+    path(
+        "data-upload/chunked/<uuid:upload_id>/complete/",
+        ChunkedUploadCompleteAPIView.as_view(),
+        name="chunked-upload-complete",
+    ),
+    path(
+        "data-upload/<uuid:job_id>/",
+        UploadJobStatusAPIView.as_view(),
+        name="upload-status",
+    ),
+    path(
+        "data-upload/<uuid:job_id>/quarantine/",
+        UploadQuarantineAPIView.as_view(),
+        name="upload-quarantine",
+    ),
+    path(
+        "data-upload/<uuid:job_id>/rollback/",
+        UploadRollbackAPIView.as_view(),
+        name="upload-rollback",
+    ),
+    path(
+        "data-export/parquet/",
+        CustomDutyExportAPIView.as_view(),
+        name="data-export-parquet",
+    ),
     path(
         "certificate/<str:vin>/",
         VINSearchHistoryDetailAPIView.as_view(),
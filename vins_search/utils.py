@@ -1,37 +1,50 @@
 import requests
 import csv
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
 import pandas as pd
+from django.conf import settings
+from django.db import connections
+from .compression import open_compressed, seekable_copy, split_compression
 from .models import CustomDutyFile
-from .serializers import CustomDutyUploadSerializer
-import hashlib
+from .ingestion import (
+    DEFAULT_BATCH_SIZE,
+    ingest_frames,
+    ingest_rows,
+    ingest_validations,
+    iter_csv_frames,
+    iter_excel_rows,
+    iter_json_records,
+    iter_parquet_frames,
+    iter_xml_records,
+)
+from .parallel import (
+    DEFAULT_WORKERS,
+    file_path,
+    parallel_csv_validations,
+    parallel_parquet_validations,
+    parallel_row_validations,
+)
 from typing import Dict, Any
-import xml.etree.ElementTree as ET
 import json
 
 
 x_secret_key = "7GqsmwdjFVfWERrjn6Xbnw==HUqPRVB0YH81dEIa"
 
 # Define the required column indexes and their corresponding field names
-def process_csv(file):
+def process_csv(file, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, **options):
     try:
-        file.seek(0)
-        file_data = file.read().decode("utf-8")
-        csv_reader = csv.DictReader(file_data.splitlines())
-        custom_duties = []
-
-        for row in csv_reader:
-            row = {k: v.strip() if v else "" for k, v in row.items()}
-            serializer = CustomDutyUploadSerializer(data=row)
-            if serializer.is_valid():
-                custom_duty = CustomDutyFile(**serializer.validated_data)
-                custom_duties.append(custom_duty)
-            else:
-                print(serializer.errors)
-                return {"error": "Invalid data in CSV", "details": serializer.errors}
-
-        CustomDutyFile.objects.bulk_create(custom_duties)
-
-        return {"message": "CSV file processed successfully."}
+        path = file_path(file)
+        if workers > 1 and path:
+            # Byte ranges of the file are parsed and validated in parallel,
+            # unless a quoted line break makes the ranges unsafe to cut
+            validations = parallel_csv_validations(path, batch_size, workers)
+            if validations is not None:
+                return ingest_validations(validations, "CSV", **options)
+
+        return ingest_frames(iter_csv_frames(file, batch_size), "CSV", **options)
     except Exception as e:
         return {
             "error": "An error occurred while processing the CSV file.",
@@ -39,32 +52,26 @@ def process_csv(file):
         }
 
 
-def process_excel(file):
+def process_excel(file, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, **options):
     try:
-        # Check the file extension to choose the correct engine
-        file_extension = file.name.split(".")[-1]
-
-        # Use appropriate engine based on the file extension
-        if file_extension == "xls":
+        if file.name.endswith(".xls"):
+            # Legacy .xls sheets (at most 65,536 rows) are not streamable
             df = pd.read_excel(file, engine="xlrd")
-        else:  # for .xlsx
-            df = pd.read_excel(file, engine="openpyxl")
+            frames = (
+                df.iloc[start : start + batch_size]
+                for start in range(0, len(df), batch_size)
+            )
+            return ingest_frames(frames, "Excel", **options)
 
-        # Convert the DataFrame to a list of dictionaries
-        custom_data = df.to_dict(orient="records")
-        custom_duties = []
+        # .xlsx sheets are streamed row by row
+        if workers > 1:
+            # Reading the sheet stays serial; row ranges are validated in parallel
+            validations = parallel_row_validations(
+                iter_excel_rows(file), batch_size, workers
+            )
+            return ingest_validations(validations, "Excel", **options)
 
-        for row in custom_data:
-            row = {k: v.strip() if isinstance(v, str) else v for k, v in row.items()}
-            serializer = CustomDutyUploadSerializer(data=row)
-            if serializer.is_valid():
-                custom_duty = CustomDutyFile(**serializer.validated_data)
-                custom_duties.append(custom_duty)
-            else:
-                return {"error": "Invalid data in Excel", "details": serializer.errors}
-
-        CustomDutyFile.objects.bulk_create(custom_duties)
-        return {"message": "Excel file processed successfully."}
+        return ingest_rows(iter_excel_rows(file), "Excel", batch_size, **options)
 
     except Exception as e:
         return {
@@ -73,46 +80,14 @@ def process_excel(file):
         }
 
 
-# Process duplicates
-def is_duplicate(file):
-    """
-    Checks for duplicate files by comparing file names or content.
-    """
-    # check by file name
-    existing_files = CustomDutyFile.objects.filter(name=file.name)
-
-    # check by file content(using hash)
-    file_hash = hashlib.md5(file.read()).hexdigest()
-    for existing_file in existing_files:
-        existing_file_hash = hashlib.md5(existing_file.file.read()).hexdigest()
-        if file_hash == existing_file_hash:
-            return True
-    return False
-
-
 # Process JSON files
-def process_json(file) -> Dict[str, Any]:
-    
+def process_json(file, batch_size=DEFAULT_BATCH_SIZE, **options) -> Dict[str, Any]:
     try:
         file.seek(0)
-        
-        file_content = file.read()
-
-        print(f"File content: {file_content}")
-
-        # import pdb; pdb.set_trace()
-        if not file_content:
+        if not file.read(1):
             return {"error": "The JSON file is empty."}
 
-        # Parse the JSON content
-        data = json.loads(file_content)
-
-        # Implement the logic to process the JSON data
-        # Example: Just return the data length or some processing result
-        return {
-            "message": "JSON file processed successfully",
-            "data_length": len(data)
-        }
+        return ingest_rows(iter_json_records(file), "JSON", batch_size, **options)
 
     except json.JSONDecodeError as json_err:
         return {"error": f"Failed to process JSON file: {str(json_err)}"}
@@ -121,29 +96,288 @@ def process_json(file) -> Dict[str, Any]:
 
 
 # process XML file
-def process_xml(file):
+def process_xml(file, batch_size=DEFAULT_BATCH_SIZE, mapping=None, **options):
     """
     Process XML files and return a response dictionary.
     """
     try:
-
-        tree = ET.parse(file)
-        root = tree.getroot()
-        # Implement the logic to process the XML data
-        return {"message": "XML file processed successfully"}
+        records = iter_xml_records(file, mapping)
+        return ingest_rows(records, "XML", batch_size, **options)
     except Exception as e:
         return {"error": f"Failed to process XML file: {str(e)}"}
 
 
+def process_parquet(
+    file, batch_size=DEFAULT_BATCH_SIZE, workers=DEFAULT_WORKERS, **options
+):
+    """
+    Process Parquet files row group by row group, reading only the columns
+    CustomDutyFile stores.
+    """
+    try:
+        path = file_path(file)
+        if workers > 1 and path:
+            # Row groups are read and validated in parallel
+            validations = parallel_parquet_validations(path, batch_size, workers)
+            return ingest_validations(validations, "Parquet", **options)
+
+        return ingest_frames(iter_parquet_frames(file, batch_size), "Parquet", **options)
+    except Exception as e:
+        return {
+            "error": "An error occurred while processing the Parquet file.",
+            "details": str(e),
+        }
+
+
+# Readers that need random access to the file, not a stream
+RANDOM_ACCESS_PROCESSORS = (process_excel, process_parquet)
+
+# Members of a ZIP upload ingested at the same time
+ZIP_WORKERS = getattr(settings, "CUSTOM_DUTY_ZIP_WORKERS", 4)
+
+
+def process_compressed(file, processor, compression, **options):
+    """
+    Run `processor` on a .gz or .bz2 upload, decompressing it as it is read.
+    """
+    name, _ = split_compression(getattr(file, "name", None) or "")
+    with open_compressed(file, compression) as stream:
+        if processor in RANDOM_ACCESS_PROCESSORS:
+            with seekable_copy(stream, name) as copy:
+                return processor(copy, **options)
+        return processor(stream, **options)
+
+
+def _member_total(name):
+    return property(
+        lambda self: sum(getattr(stats, name) for stats, _ in self.members.values())
+    )
+
+
+class ArchiveProgress:
+    """
+    Combined counters of the members of an archive being ingested, passed
+    to `on_batch` in place of a single IngestionStats.
+
+    `bytes_read` estimates how much of the compressed archive has been
+    consumed from how far each member has been decompressed.
+    """
+
+    rows = _member_total("rows")
+    inserted = _member_total("inserted")
+    updated = _member_total("updated")
+    unchanged = _member_total("unchanged")
+    quarantined = _member_total("quarantined")
+
+    def __init__(self, on_batch=None):
+        self.on_batch = on_batch
+        self.members = {}
+        self.lock = threading.Lock()
+
+    @property
+    def bytes_read(self):
+        return sum(read for _, read in self.members.values())
+
+    def tracker(self, info, member):
+        """
+        Return the `on_batch` callback for one member being read from `member`.
+        """
+
+        def track(stats):
+            done = min(1, member.tell() / info.file_size) if info.file_size else 1
+            with self.lock:
+                self.members[info.filename] = (stats, int(info.compress_size * done))
+                if self.on_batch:
+                    self.on_batch(self)
+
+        return track
+
+
+def process_member(archive, info, progress, offset=0, **options):
+    """
+    Ingest one file of a ZIP upload with the processor for its type.
+
+    Rows handed to `on_invalid` are numbered from `offset`, so row numbers
+    stay unique across the members of the archive.
+    """
+    file_type = get_file_type(info.filename)
+    processor = FILE_PROCESSORS[file_type]
+    on_invalid = options.get("on_invalid")
+    if on_invalid is not None and offset:
+
+        def renumber(rows):
+            for row in rows:
+                row["row_number"] += offset
+            on_invalid(rows)
+
+        options["on_invalid"] = renumber
+
+    with archive.open(info) as member:
+        options["on_batch"] = progress.tracker(info, member)
+        if processor in RANDOM_ACCESS_PROCESSORS:
+            with seekable_copy(member, info.filename) as copy:
+                return processor(copy, **options)
+        return processor(member, **options)
+
+
+def process_zip(file, workers=ZIP_WORKERS, on_batch=None, **options):
+    """
+    Ingest every CSV, Excel, JSON, XML and Parquet file of a ZIP upload.
+
+    Members are decompressed as they are read and ingested concurrently,
+    each with its own batches and database connection. In tolerant mode
+    they are taken one after the other instead, so quarantined rows can be
+    numbered through the whole archive. A full refresh must be a single
+    file.
+    """
+    try:
+        archive = zipfile.ZipFile(file)
+    except zipfile.BadZipFile as e:
+        return {"error": f"Failed to read ZIP file: {str(e)}"}
+
+    with archive:
+        members = [
+            info
+            for info in archive.infolist()
+            if not info.is_dir()
+            and not info.filename.rsplit("/", 1)[-1].startswith(".")
+            and not info.filename.startswith("__MACOSX/")
+            and get_file_type(info.filename) in FILE_PROCESSORS
+            and get_file_type(info.filename) != "zip"
+        ]
+        if not members:
+            return {"error": "The ZIP file contains no CSV, Excel, JSON, XML or Parquet file."}
+        if options.get("mode") == "replace" and len(members) > 1:
+            return {
+                "error": "A full refresh must be a single file, not a ZIP of several."
+            }
+
+        progress = ArchiveProgress(on_batch)
+        results = {}
+        if options.get("on_invalid") is not None:
+            offset = 0
+            for info in members:
+                results[info.filename] = process_member(
+                    archive, info, progress, offset, **options
+                )
+                offset += results[info.filename].get("stats", {}).get("rows", 0)
+        else:
+
+            def run(info):
+                # Pool threads open their own connections; close them when done
+                try:
+                    return process_member(archive, info, progress, **options)
+                finally:
+                    connections.close_all()
+
+            workers = max(1, min(workers, len(members)))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {info.filename: pool.submit(run, info) for info in members}
+            results = {name: future.result() for name, future in futures.items()}
+
+    stats = {
+        key: sum(result.get("stats", {}).get(key, 0) for result in results.values())
+        for key in ("rows", "inserted", "updated", "unchanged", "quarantined", "batches")
+    }
+    failed = [name for name, result in results.items() if "error" in result]
+    if failed:
+        return {
+            "error": f"{len(failed)} of {len(results)} files in the ZIP file could not "
+            f"be ingested: {', '.join(failed)}",
+            "stats": stats,
+            "members": results,
+        }
+    return {
+        "message": "ZIP file processed successfully.",
+        "stats": stats,
+        "members": results,
+    }
+
+
+def get_file_type(file_name):
+    """
+    Map an upload's name to the file_type stored on CustomDutyFileUploads:
+    its format, with ".gz" or ".bz2" appended when it is compressed, or
+    "zip" for a ZIP archive of such files.
+    """
+    file_name, compression = split_compression(file_name)
+    if compression == "zip":
+        return "zip"
+    if file_name.endswith(".csv"):
+        file_type = "csv"
+    elif file_name.endswith((".xls", ".xlsx")):
+        file_type = "excel"
+    elif file_name.endswith(".json"):
+        file_type = "json"
+    elif file_name.endswith(".xml"):
+        file_type = "xml"
+    elif file_name.endswith(".parquet"):
+        file_type = "parquet"
+    else:
+        return None
+    return f"{file_type}.{compression}" if compression else file_type
+
+
+# Processors for each stored file_type of CustomDutyFileUploads
+FILE_PROCESSORS = {
+    "csv": process_csv,
+    "excel": process_excel,
+    "json": process_json,
+    "xml": process_xml,
+    "parquet": process_parquet,
+    "zip": process_zip,
+}
+
+# File types whose processors take `workers`: processes parsing the file,
+# or for ZIP archives the members ingested at the same time
+PARALLEL_FILE_TYPES = ("csv", "excel", "parquet", "zip")
+
+
+def get_processor(file_type):
+    """
+    Return the function that ingests stored files of `file_type`, or None.
+    """
+    file_type, _, compression = file_type.partition(".")
+    processor = FILE_PROCESSORS.get(file_type)
+    if processor is None or not compression:
+        return processor
+    return partial(process_compressed, processor=processor, compression=compression)
+
+
+def normalize_vins(values, limit=None):
+    """
+    Return `values` as stripped, upper-case VINs without blanks or repeats,
+    in the order first seen, reading no more than `limit` distinct VINs.
+    """
+    vins = {}
+    for value in values:
+        vin = str(value).strip().upper() if value is not None else ""
+        if vin:
+            vins.setdefault(vin, None)
+            if limit is not None and len(vins) >= limit:
+                break
+    return list(vins)
+
+
+# Seconds to connect to, and then to wait on, the VIN lookup API per call
+VIN_LOOKUP_TIMEOUT = getattr(settings, "VIN_LOOKUP_TIMEOUT", 5)
+
+# Seconds a multi-VIN search waits for all its lookups
+VIN_LOOKUP_DEADLINE = getattr(settings, "VIN_LOOKUP_DEADLINE", 10)
+
+# VIN lookups sent to the API at the same time
+VIN_LOOKUP_WORKERS = getattr(settings, "VIN_LOOKUP_WORKERS", 8)
+
+
 # VIN Lookup API implementation
-def get_vin_status(vin):
+def get_vin_status(vin, timeout=VIN_LOOKUP_TIMEOUT):
     url = "https://api.api-ninjas.com/v1/vinlookup"
 
     headers = {
         "X-Api-Key": x_secret_key,
     }
     try:
-        response = requests.get(f"{url}?vin={vin}", headers=headers)
+        response = requests.get(f"{url}?vin={vin}", headers=headers, timeout=timeout)
         response.raise_for_status()
         return response.json()
     
@@ -158,3 +392,22 @@ def get_vin_status(vin):
     
     except requests.exceptions.RequestException as req_err:
         return {"error": f"Request error occurred: {req_err}"}
+
+
+def get_vin_statuses(
+    vins, workers=VIN_LOOKUP_WORKERS, deadline=VIN_LOOKUP_DEADLINE
+):
+    """
+    Look up several VINs with the API at once.
+
+    Returns the responses received within `deadline` seconds, by VIN; VINs
+    still waiting then are left out rather than holding up the rest.
+    """
+    if not vins:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=min(workers, len(vins)))
+    futures = {executor.submit(get_vin_status, vin): vin for vin in vins}
+    done, _ = wait(futures, timeout=deadline)
+    # Lookups still running give up on their own after VIN_LOOKUP_TIMEOUT
+    executor.shutdown(wait=False, cancel_futures=True)
+    return {futures[future]: future.result() for future in done}
@@ -0,0 +1,358 @@
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .dictionary import ENCODED_FIELDS, ENCODED_NAMES, TEXT_FIELDS
+from .models import CustomDutyFile
+
+
+# Formats tried, in order, for sgd_date values that are not ISO 8601
+SGD_DATE_FORMATS = getattr(
+    settings,
+    "CUSTOM_DUTY_SGD_DATE_FORMATS",
+    ["%d/%m/%Y", "%d-%m-%Y", "%d-%b-%y", "%d-%b-%Y"],
+)
+
+# Plausible range for vehicle_year; anything else is kept as text only
+VEHICLE_YEAR_RANGE = (1900, 2100)
+
+# payment_status values, compared case-insensitively, that mark a duty unpaid
+UNPAID_STATUSES = getattr(settings, "CUSTOM_DUTY_UNPAID_STATUSES", ["UNPAID"])
+
+
+def parse_years(values):
+    """
+    Parse vehicle_year strings into ints, with None where they are not a
+    plausible whole year.
+    """
+    numbers = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce")
+    low, high = VEHICLE_YEAR_RANGE
+    valid = (numbers % 1 == 0) & numbers.between(low, high)
+    years = np.full(len(numbers), None, dtype=object)
+    years[valid.to_numpy()] = [int(year) for year in numbers[valid]]
+    return years
+
+
+def parse_dates(values):
+    """
+    Parse sgd_date strings into dates, trying an ISO 8601 date prefix (so
+    timestamps keep the day they were written with) and then each of
+    SGD_DATE_FORMATS on what is still unparsed, with None where none fit.
+    """
+    strings = pd.Series(values, dtype=object)
+    parsed = pd.to_datetime(
+        strings.str.slice(0, 10), format="%Y-%m-%d", errors="coerce"
+    )
+    for date_format in SGD_DATE_FORMATS:
+        missing = parsed.isna() & strings.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(
+            strings[missing], format=date_format, errors="coerce"
+        )
+    dates = np.full(len(parsed), None, dtype=object)
+    found = parsed.notna().to_numpy()
+    dates[found] = list(parsed[found].dt.date)
+    return dates
+
+
+def parse_unpaid(values):
+    """
+    Flag payment_status strings that are one of UNPAID_STATUSES, with None
+    where there is no status.
+    """
+    strings = pd.Series(values, dtype=object)
+    unpaid = strings.str.upper().isin([status.upper() for status in UNPAID_STATUSES])
+    flags = unpaid.to_numpy(dtype=object)
+    flags[strings.isna().to_numpy()] = None
+    return flags
+
+
+# Typed copies of text columns, derived from them on ingestion
+TYPED_FIELD_SOURCES = {
+    "vehicle_year_value": ("vehicle_year", parse_years),
+    "sgd_date_value": ("sgd_date", parse_dates),
+    "is_unpaid": ("payment_status", parse_unpaid),
+}
+TYPED_FIELDS = [CustomDutyFile._meta.get_field(name) for name in TYPED_FIELD_SOURCES]
+
+# Fields that uploads may populate, in model order
+UPLOAD_FIELDS = [
+    field
+    for field in CustomDutyFile._meta.concrete_fields
+    if not field.primary_key
+    and (not field.is_relation or field in ENCODED_FIELDS)
+    and field.name not in TYPED_FIELD_SOURCES
+    and field not in TEXT_FIELDS
+]
+UPLOAD_FIELD_NAMES = [ENCODED_NAMES.get(field, field.name) for field in UPLOAD_FIELDS]
+
+# Python types CharField.to_internal_value accepts
+CHAR_INPUT_TYPES = (str, int, float, np.integer, np.floating)
+
+# Upper bound on parameters per `vin__in` lookup (SQLite allows 32766)
+VIN_LOOKUP_CHUNK_SIZE = 10_000
+
+
+class FrameValidation:
+    """
+    Result of validating a DataFrame of upload rows.
+
+    `invalid` is a boolean mask aligned with the rows of `frame`, and
+    `errors` maps the position of every invalid row to serializer-style
+    `{field: [messages]}` details.
+    """
+
+    def __init__(self, frame, invalid, errors):
+        self.frame = frame
+        self.invalid = invalid
+        self.errors = errors
+
+    @property
+    def valid_count(self):
+        return int((~self.invalid).sum())
+
+    def first_error(self):
+        if not self.errors:
+            return None
+        position = min(self.errors)
+        return position, self.errors[position]
+
+    def valid_records(self):
+        """
+        Valid rows as dicts ready for the batch writers, with nulls as None.
+        """
+        return self.frame[~self.invalid].to_dict(orient="records")
+
+    def add_errors(self, mask, field, message):
+        for position in np.flatnonzero(mask):
+            self.errors.setdefault(int(position), {}).setdefault(field, []).append(
+                message
+            )
+        self.invalid = self.invalid | mask
+
+    def slice(self, start, stop):
+        """
+        Rows `start:stop` as a new FrameValidation, with positions rebased.
+        """
+        return FrameValidation(
+            self.frame.iloc[start:stop].reset_index(drop=True),
+            self.invalid[start:stop],
+            {
+                position - start: details
+                for position, details in self.errors.items()
+                if start <= position < stop
+            },
+        )
+
+    @classmethod
+    def concat(cls, validations):
+        """
+        Join consecutive validations into one, keeping row positions in order.
+        """
+        if len(validations) == 1:
+            return validations[0]
+        errors = {}
+        offset = 0
+        for validation in validations:
+            for position, details in validation.errors.items():
+                errors[position + offset] = details
+            offset += len(validation.frame)
+        return cls(
+            pd.concat([validation.frame for validation in validations], ignore_index=True),
+            np.concatenate([validation.invalid for validation in validations]),
+            errors,
+        )
+
+
+def _clean_column(column):
+    """
+    Coerce a column to stripped strings, keeping nulls as None, the way the
+    serializer's CharField would. Returns the values as an object array, a
+    mask of nulls and a mask of entries that are not valid strings
+    (CharField only accepts strings and numbers, not booleans).
+    """
+    values = column.to_numpy(dtype=object)
+    nulls = pd.isna(values)
+    present = ~nulls
+    cleaned = np.full(len(values), None, dtype=object)
+
+    if pd.api.types.infer_dtype(values, skipna=True) == "string":
+        not_string = np.zeros(len(values), dtype=bool)
+        cleaned[present] = [value.strip() for value in values[present]]
+    else:
+        not_string = np.fromiter(
+            (
+                isinstance(value, bool) or not isinstance(value, CHAR_INPUT_TYPES)
+                for value in values
+            ),
+            dtype=bool,
+            count=len(values),
+        )
+        not_string &= present
+        cleaned[present] = [str(value).strip() for value in values[present]]
+
+    return cleaned, nulls, not_string
+
+
+class SeenVins:
+    """
+    The VINs claimed so far by the rows of a file, so a VIN repeated in a
+    later batch can be found without keeping every VIN.
+
+    VINs are kept as 64-bit hashes, 8 bytes each, in sorted arrays that
+    are merged with the previous one whenever they grow as large, so a
+    lookup is a binary search in a few arrays. Only a hash collision could
+    make two different VINs look alike.
+    """
+
+    def __init__(self):
+        self.levels = []
+
+    @staticmethod
+    def _hashes(vins):
+        return pd.util.hash_array(np.asarray(vins, dtype=object))
+
+    def add(self, vins):
+        level = np.unique(self._hashes(vins))
+        if not len(level):
+            return
+        while self.levels and len(self.levels[-1]) <= len(level):
+            level = np.union1d(self.levels.pop(), level)
+        self.levels.append(level)
+
+    def contains(self, vins):
+        hashes = self._hashes(vins)
+        found = np.zeros(len(hashes), dtype=bool)
+        for level in self.levels:
+            positions = np.minimum(np.searchsorted(level, hashes), len(level) - 1)
+            found |= level[positions] == hashes
+        return found
+
+
+def existing_vins(vins, using=DEFAULT_DB_ALIAS):
+    """
+    Return the subset of `vins` already stored, using chunked set lookups.
+    """
+    vins = list(vins)
+    found = set()
+    for start in range(0, len(vins), VIN_LOOKUP_CHUNK_SIZE):
+        chunk = vins[start : start + VIN_LOOKUP_CHUNK_SIZE]
+        found.update(
+            CustomDutyFile.objects.using(using)
+            .filter(vin__in=chunk)
+            .values_list("vin", flat=True)
+        )
+    return found
+
+
+def validate_fields(frame):
+    """
+    Apply the per-field CustomDutyFile rules to a whole DataFrame at once.
+
+    This mirrors CustomDutyUploadSerializer: unknown columns are ignored,
+    missing ones are null, values are stripped and checked against each
+    field's max_length, null and blank options, and the typed copies of
+    vehicle_year, sgd_date and payment_status are derived alongside. It
+    needs no database access, so it can run in worker processes; VIN
+    uniqueness is left to `check_vins`.
+    """
+    frame = frame.reindex(columns=UPLOAD_FIELD_NAMES).reset_index(drop=True)
+    row_count = len(frame)
+    cleaned = {}
+    failures = []
+
+    for field, name in zip(UPLOAD_FIELDS, UPLOAD_FIELD_NAMES):
+        # Encoded columns are limited by the text column of their lookup table
+        max_length = (
+            field.related_model._meta.get_field("value").max_length
+            if field in ENCODED_FIELDS
+            else field.max_length
+        )
+        values, nulls, not_string = _clean_column(frame[name])
+        cleaned[name] = values
+        lengths = np.fromiter(
+            (0 if value is None else len(value) for value in values),
+            dtype=np.int64,
+            count=row_count,
+        )
+
+        failures.append((name, not_string, "Not a valid string."))
+        if max_length:
+            failures.append(
+                (
+                    name,
+                    lengths > max_length,
+                    f"Ensure this field has no more than {max_length} characters.",
+                )
+            )
+        if not field.null:
+            failures.append((name, nulls, "This field may not be null."))
+        if not field.blank:
+            failures.append(
+                (name, ~nulls & (lengths == 0), "This field may not be blank.")
+            )
+
+    for name, (source, parse) in TYPED_FIELD_SOURCES.items():
+        cleaned[name] = parse(cleaned[source])
+
+    validation = FrameValidation(
+        pd.DataFrame(cleaned), np.zeros(row_count, dtype=bool), {}
+    )
+    for name, mask, message in failures:
+        if mask.any():
+            validation.add_errors(mask, name, message)
+    return validation
+
+
+def check_vins(
+    validation,
+    using=DEFAULT_DB_ALIAS,
+    check_existing=True,
+    seen=None,
+    require_vin=False,
+):
+    """
+    Reject rows whose VIN repeats an earlier row of the same frame or, when
+    `check_existing` is set, one already in the database.
+
+    Later duplicates are the ones rejected, as they would be when inserting
+    row by row, and rows that already fail another rule do not claim a VIN.
+    `seen`, a SeenVins, extends the check to the earlier frames of a file
+    and is given the VINs this frame claims. With `require_vin`, as when
+    rows are merged on their VIN, rows with a null or blank one are
+    rejected too.
+    """
+    vins = pd.Series(validation.frame["vin"].to_numpy(dtype=object))
+    if require_vin:
+        missing = (vins.isna() | (vins == "")).to_numpy() & ~validation.invalid
+        if missing.any():
+            validation.add_errors(
+                missing, "vin", "This field is required to merge rows."
+            )
+
+    # Only rows that would otherwise be inserted can collide on VIN
+    candidates = vins.notna().to_numpy() & ~validation.invalid
+    duplicate = np.zeros(len(vins), dtype=bool)
+    duplicate[candidates] = vins[candidates].duplicated(keep="first").to_numpy()
+    if seen is not None and candidates.any():
+        duplicate[candidates] |= seen.contains(vins[candidates].to_numpy())
+    if check_existing and candidates.any():
+        stored = existing_vins(vins[candidates].unique(), using=using)
+        if stored:
+            duplicate |= vins.isin(stored).to_numpy() & candidates
+    if duplicate.any():
+        validation.add_errors(duplicate, "vin", "vin with this vin already exists.")
+    if seen is not None:
+        claimed = candidates & ~duplicate
+        if claimed.any():
+            seen.add(vins[claimed].to_numpy())
+    return validation
+
+
+def validate_frame(frame, using=DEFAULT_DB_ALIAS, check_existing=True):
+    """
+    Apply all CustomDutyFile rules, field and VIN uniqueness, to a DataFrame.
+    """
+    return check_vins(validate_fields(frame), using=using, check_existing=check_existing)
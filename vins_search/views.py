@@ -1,35 +1,139 @@
+import os
 from rest_framework.views import APIView
 from rest_framework import status
-import pandas as pd
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.response import Response
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from vins_search.serializers import VinSearchHistorySerializer, VinSerializer
-from vins_search.utils import (
-    get_vin_status,
-    process_csv,
-    process_excel,
-    process_json,
-    process_xml,
+from django.urls import reverse
+from vins_search.serializers import (
+    ChunkedUploadInitSerializer,
+    ChunkedUploadSerializer,
+    UploadJobStatusSerializer,
+    VinSearchHistorySerializer,
+    VinSerializer,
 )
+from vins_search.export import iter_parquet_export
+from vins_search.ingestion import (
+    MODES as INGESTION_MODES,
+    import_pyarrow,
+    iter_excel_rows,
+)
+from vins_search.jobs import request_rollback, requeue_failed_job
+from vins_search.quarantine import iter_quarantine_csv, resubmit_quarantined
+from vins_search.storage import (
+    append_chunk,
+    file_sha256,
+    get_upload_storage,
+    move_into_storage,
+    save_upload,
+    upload_handlers,
+)
+from vins_search.utils import get_file_type, get_vin_statuses, normalize_vins
 from django.conf import settings
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
 from rest_framework.generics import GenericAPIView
 from rest_framework.exceptions import APIException
 from django.db.models import DateField
+from django.db.models.functions import Upper
 from rest_framework import generics
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 
 # from accounts.permissions import HasPermission
 # from data_uploads.pagination import AllUploadsPagination
-from .models import CustomDutyFile, CustomDutyFileUploads, VinSearchHistory
+from .models import (
+    ChunkedUpload,
+    CustomDutyFile,
+    CustomDutyFileUploads,
+    VinSearchHistory,
+)
 from rest_framework.response import Response
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
 
+DUPLICATE_FILE_MESSAGE = "This file already exists."
+RETRIED_FILE_MESSAGE = "This file failed before; its upload was queued again."
+
+
+def upload_job_response(
+    request, upload, message, status_code=status.HTTP_400_BAD_REQUEST, **extra
+):
+    """
+    Describe a queued ingestion job and where to poll for its status.
+    """
+    return Response(
+        {
+            "message": message,
+            **extra,
+            "job_id": upload.job_id,
+            "status": upload.status,
+            "status_url": request.build_absolute_uri(
+                reverse("upload-status", args=[upload.job_id])
+            ),
+        },
+        status=status_code,
+    )
+
+
+def multi_vin_results(vins):
+    """
+    Check VINs, already normalized, against the database in one query and
+    then against the external API, returning results in the order given.
+    VINs that are not stored are reported without calling the API, and
+    the stored ones are looked up concurrently.
+
+    Stored VINs are matched whatever their case, through the upper-case
+    VIN index, as they are not normalized on ingestion.
+    """
+    stored = {}
+    matches = CustomDutyFile.objects.annotate(vin_upper=Upper("vin")).filter(
+        vin_upper__in=vins
+    )
+    for db_vin in matches:
+        # A VIN stored exactly as normalized wins over other spellings
+        if db_vin.vin == db_vin.vin_upper or db_vin.vin_upper not in stored:
+            stored[db_vin.vin_upper] = db_vin
+    statuses = get_vin_statuses([vin for vin in vins if vin in stored])
+    results = []
+    for vin in vins:
+        db_vin = stored.get(vin)
+        if db_vin is None:
+            results.append({"vin": vin, "status": "Not found in database"})
+            continue
+
+        if vin not in statuses:
+            results.append(
+                {"vin": vin, "error": "External API did not respond in time"}
+            )
+            continue
+        api_data = statuses[vin]
+        if not api_data or "error" in api_data:
+            results.append({"vin": vin, "error": "Error fetching from external API"})
+        elif str(api_data.get("vin", "")).upper() == vin:
+            results.append(VinSerializer(db_vin).data)
+    return results
+
+
+def retry_failed_upload(request, upload, mode, tolerant, filename, fs):
+    """
+    Queue a failed upload again because its file was sent again, keeping
+    the newly stored copy `filename` only if the upload has no file.
+    """
+    try:
+        retried = requeue_failed_job(upload, mode, tolerant, filename)
+    except ValueError as e:
+        fs.delete(filename)
+        return upload_job_response(request, upload, str(e))
+    if retried.file.name != filename:
+        fs.delete(filename)
+    return upload_job_response(
+        request, retried, RETRIED_FILE_MESSAGE, status.HTTP_202_ACCEPTED
+    )
+
+
 class UploadFileAPIView(APIView):
     # permission_classes = [IsAuthenticated, HasPermission]
     # authentication_classes = [JWTAuthentication]
@@ -39,27 +143,52 @@ class UploadFileAPIView(APIView):
     @swagger_auto_schema(
         operation_summary="Upload a file and process custom duty payment.",
         operation_description="""
-            This endpoint allows you to upload a file (CSV, Excel, JSON, or XML) 
+            This endpoint allows you to upload a file (CSV, Excel, JSON, XML or Parquet) 
             and updates the custom duty payment based on the content of the file.
-            Supported formats: CSV, Excel (.xls/.xlsx), JSON, XML. The file size limit is 5MB.
+            Supported formats: CSV, Excel (.xls/.xlsx), JSON, XML, Parquet. The file size limit is 5MB.
+            Files may be compressed with gzip (.gz) or bzip2 (.bz2), or sent as a
+            .zip holding one or more of them; they are stored compressed and
+            decompressed while being ingested.
+            The file is processed in the background; poll the returned status_url
+            for progress and the final row counts. Larger files can be sent with
+            the resumable data-upload/chunked/ endpoints.
+            A file already uploaded is refused, unless its upload failed: that
+            upload is then queued again and picks up where it stopped.
         """,
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
             properties={
                 "file": openapi.Schema(
                     type=openapi.TYPE_FILE,
-                    description="File to upload (CSV, Excel, JSON, or XML). Max size: 5MB",
-                )
+                    description="File to upload (CSV, Excel, JSON, XML or Parquet, optionally "
+                    ".gz, .bz2 or .zip compressed). Max size: 5MB",
+                ),
+                "mode": openapi.Schema(
+                    type=openapi.TYPE_STRING,
+                    enum=list(INGESTION_MODES),
+                    default="insert",
+                    description="'insert' rejects VINs that already exist, "
+                    "'merge' updates them in place and only writes changed rows, "
+                    "'replace' swaps the whole dataset for the file's rows at once.",
+                ),
+                "tolerant": openapi.Schema(
+                    type=openapi.TYPE_BOOLEAN,
+                    default=False,
+                    description="Store the valid rows and quarantine invalid ones "
+                    "instead of stopping at the first invalid row.",
+                ),
             },
         ),
         responses={
-            200: openapi.Response(
-                description="File processed and saved successfully.",
+            202: openapi.Response(
+                description="File saved and queued for background processing.",
                 examples={
                     "application/json": {
-                        "message": "File processed and saved successfully.",
+                        "message": "File accepted for processing.",
                         "file_url": "http://example.com/uploads/yourfile.csv",
-                        "result": {"processed_data": "Details about processed data"},
+                        "job_id": "0b7f6a1e-3c1f-4f4e-9a53-6f0e7a1d2c11",
+                        "status": "pending",
+                        "status_url": "http://example.com/vin/data-upload/0b7f6a1e-3c1f-4f4e-9a53-6f0e7a1d2c11/",
                     }
                 },
             ),
@@ -71,7 +200,8 @@ class UploadFileAPIView(APIView):
                     },
                     "application/json": {"error": "No file uploaded"},
                     "application/json": {
-                        "error": "Invalid file format. Please upload a CSV, Excel, JSON, or XML file."
+                        "error": "Invalid file format. Please upload a CSV, Excel, JSON, XML or Parquet file, "
+                        "optionally compressed as .gz, .bz2 or .zip."
                     },
                 },
             ),
@@ -80,6 +210,9 @@ class UploadFileAPIView(APIView):
     # Define the maximum allowed file size (in bytes)
 
     def post(self, request, *args, **kwargs):
+        # Large uploads are hashed while they are written into upload storage
+        request.upload_handlers = upload_handlers(request)
+
         # Check if file is in request
         file = request.FILES.get("file")
         # user = request.user
@@ -104,32 +237,47 @@ class UploadFileAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Check for duplicate file based on the file name and user
-        try:
-            file_name = CustomDutyFileUploads.objects.filter(file_name=file.name)
-            if file_name.exists():
-                return Response(
-                    {"message": "This file already exists."},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-        except Exception as e:
+        mode = request.data.get("mode", "insert")
+        if mode not in INGESTION_MODES:
             return Response(
-                {"error": f"Error checking for duplicate file: {str(e)}"},
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                {"error": f"Invalid mode. Choose one of: {', '.join(INGESTION_MODES)}."},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Create a FileSystemStorage instance
-        storage_location = getattr(settings, "MEDIA_ROOT", "uploads/")
-        fs = FileSystemStorage(location=storage_location)
-        # Save the file to the uploads directory
+        tolerant = str(request.data.get("tolerant", "")).lower() in ("1", "true", "yes")
+
+        # Work out which processor the ingestion job should use
+        file_type = get_file_type(file.name)
+        if file_type is None:
+            return Response(
+                {
+                    "message": "Invalid file format. Please upload a CSV, Excel, JSON, XML or Parquet file, "
+                        "optionally compressed as .gz, .bz2 or .zip."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Save the file to the uploads directory, hashing it on the way
+        fs = get_upload_storage()
         try:
-            filename = fs.save(file.name, file)
+            filename, content_hash = save_upload(file, fs)
         except Exception as e:
             return Response(
                 {"error": f"Error saving file: {str(e)}"},
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
+        # Identical content is never ingested twice, whatever its name, but
+        # sending the file of a failed upload again retries that upload
+        duplicate = CustomDutyFileUploads.objects.filter(
+            content_hash=content_hash
+        ).first()
+        if duplicate is not None and duplicate.status == "failed":
+            return retry_failed_upload(request, duplicate, mode, tolerant, filename, fs)
+        if duplicate is not None:
+            fs.delete(filename)
+            return upload_job_response(request, duplicate, DUPLICATE_FILE_MESSAGE)
+
         # Generate the file's URL to be accessed from the frontend
         try:
             file_url = request.build_absolute_uri(settings.MEDIA_URL + filename)
@@ -140,37 +288,23 @@ class UploadFileAPIView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
-        # Process the file based on its extension
-        if file.name.endswith(".csv"):
-            result = process_csv(file)
-            file_type = "csv"
-        elif file.name.endswith(".xls", ".xlsx"):
-            result = process_excel(file)
-            file_type = "excel"
-        elif file.name.endswith(".json"):
-            file_type = "json"
-            result = process_json(file)
-        elif file.name.endswith(".xml"):
-            result = process_xml(file)
-            file_type = "xml"
-        else:
-            return Response(
-                {
-                    "message": "Invalid file format. Please upload a CSV, Excel, JSON, or XML file."
-                },
-                status=status.HTTP_400_BAD_REQUEST,
-            )
-        if "error" in result:
-            return Response(result, status=status.HTTP_400_BAD_REQUEST)
-
+        # Queue the file for the process_uploads workers
         try:
             vin_file = CustomDutyFileUploads.objects.create(
                 uploaded_by=f"Dennis Akagha",
                 file_name=file.name,
                 file=filename,
                 file_type=file_type,
-                processed_status=True,
+                file_size=file.size,
+                content_hash=content_hash,
+                mode=mode,
+                tolerant=tolerant,
             )
+        except IntegrityError:
+            # The same content was queued by a concurrent request
+            fs.delete(filename)
+            duplicate = CustomDutyFileUploads.objects.get(content_hash=content_hash)
+            return upload_job_response(request, duplicate, DUPLICATE_FILE_MESSAGE)
         except Exception as e:
             return Response(
                 {"error": f"Error saving file details to database: {str(e)}"},
@@ -195,13 +329,13 @@ class UploadFileAPIView(APIView):
         #     #     status=status.HTTP_500_INTERNAL_SERVER_ERROR,
         #     # )
 
-        # Return the result with the file URL
-        return Response(
-            {
-                "file_url": file_url,
-                "result": result,
-            },
-            status=status.HTTP_200_OK,
+        # Return the job so the client can poll its status
+        return upload_job_response(
+            request,
+            vin_file,
+            "File accepted for processing.",
+            status.HTTP_202_ACCEPTED,
+            file_url=file_url,
         )
 
     def get_client_ip(self, request):
@@ -213,6 +347,508 @@ class UploadFileAPIView(APIView):
         return ip
 
 
+class UploadJobStatusAPIView(APIView):
+    @swagger_auto_schema(
+        operation_summary="Get the status of a data upload job.",
+        operation_description="""
+            Returns the processing status of a file queued through the data-upload
+            endpoint, with its progress, row counts and any ingestion errors.
+            The profile summarizes the rows read so far: null counts per column,
+            estimated distinct counts, the payment_status mix and VIN lengths.
+        """,
+        responses={
+            200: openapi.Response(
+                description="Upload job status.",
+                examples={
+                    "application/json": {
+                        "message": "Ok",
+                        "data": {
+                            "job_id": "0b7f6a1e-3c1f-4f4e-9a53-6f0e7a1d2c11",
+                            "file_name": "duties.csv",
+                            "file_type": "csv",
+                            "mode": "insert",
+                            "status": "processing",
+                            "progress": 42,
+                            "rows_processed": 20000,
+                            "rows_inserted": 20000,
+                            "rows_updated": 0,
+                            "rows_unchanged": 0,
+                            "rows_quarantined": 0,
+                            "result": None,
+                            "profile": {
+                                "rows": 20000,
+                                "columns": {
+                                    "vin": {"nulls": 0, "null_rate": 0, "distinct": 19987},
+                                    "brand": {"nulls": 12, "null_rate": 0.0006, "distinct": 41},
+                                    "payment_status": {
+                                        "nulls": 0,
+                                        "null_rate": 0,
+                                        "values": {"PAID": 15210, "UNPAID": 4790},
+                                    },
+                                },
+                                "vin_lengths": {"17": 19998, "16": 2},
+                            },
+                        },
+                    }
+                },
+            ),
+            404: openapi.Response(description="Upload job not found."),
+        },
+    )
+    def get(self, request, job_id):
+        upload = get_object_or_404(CustomDutyFileUploads, job_id=job_id)
+        serializer = UploadJobStatusSerializer(upload)
+        return Response({"message": "Ok", "data": serializer.data}, status=status.HTTP_200_OK)
+
+
+class UploadQuarantineAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+    parser_classes = [MultiPartParser, FormParser]
+
+    @swagger_auto_schema(
+        operation_summary="Download the quarantined rows of a data upload.",
+        operation_description="""
+            Returns, as CSV, the rows of a tolerant upload that were not stored,
+            with their original row number and the reasons they were rejected.
+            Correct the rows in this file and send it back with POST to
+            re-submit them.
+        """,
+        responses={
+            200: openapi.Response(description="CSV of quarantined rows."),
+            404: openapi.Response(description="Upload job not found."),
+        },
+    )
+    def get(self, request, job_id):
+        upload = get_object_or_404(CustomDutyFileUploads, job_id=job_id)
+        response = StreamingHttpResponse(
+            iter_quarantine_csv(upload), content_type="text/csv"
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="quarantine-{upload.job_id}.csv"'
+        )
+        return response
+
+    @swagger_auto_schema(
+        operation_summary="Re-submit corrected quarantined rows.",
+        operation_description="""
+            Accepts a CSV file in the download format. Each row must carry the
+            row_number of a quarantined row of this upload; the errors column
+            is ignored. Rows that are now valid are stored and leave the
+            quarantine, the others stay in it with updated reasons.
+        """,
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                "file": openapi.Schema(
+                    type=openapi.TYPE_FILE,
+                    description="CSV of corrected quarantined rows.",
+                ),
+            },
+        ),
+        responses={
+            200: openapi.Response(
+                description="Rows re-submitted.",
+                examples={
+                    "application/json": {
+                        "message": "CSV file processed successfully.",
+                        "stats": {
+                            "rows": 3,
+                            "inserted": 2,
+                            "updated": 0,
+                            "unchanged": 0,
+                            "quarantined": 1,
+                            "batches": 1,
+                            "elapsed_seconds": 0.012,
+                            "rows_per_second": 250,
+                        },
+                        "rows_quarantined": 1,
+                    }
+                },
+            ),
+            400: openapi.Response(description="Invalid file or upload still processing."),
+        },
+    )
+    def post(self, request, job_id):
+        upload = get_object_or_404(CustomDutyFileUploads, job_id=job_id)
+        if upload.status != "completed":
+            return Response(
+                {"error": "Rows can only be re-submitted once the upload has completed."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        file = request.FILES.get("file")
+        if not file:
+            return Response(
+                {"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            result = resubmit_quarantined(upload, file)
+        except Exception as e:
+            return Response(
+                {"error": "An error occurred while processing the CSV file.", "details": str(e)},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        return Response(
+            {**result, "rows_quarantined": upload.rows_quarantined},
+            status=status.HTTP_200_OK,
+        )
+
+
+class UploadRollbackAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    @swagger_auto_schema(
+        operation_summary="Roll back the rows written by a data upload.",
+        operation_description="""
+            Queues the rollback of a completed or failed upload. A background
+            worker restores the values the upload overwrote in merge mode and
+            deletes the rows it inserted, in small chunks so searches are not
+            blocked. Poll the returned status_url until the status is
+            rolled_back.
+        """,
+        responses={
+            202: openapi.Response(
+                description="Rollback queued.",
+                examples={
+                    "application/json": {
+                        "message": "Rollback queued.",
+                        "job_id": "0b7f6a1e-3c1f-4f4e-9a53-6f0e7a1d2c11",
+                        "status": "rollback_pending",
+                        "status_url": "http://example.com/vin/data-upload/0b7f6a1e-3c1f-4f4e-9a53-6f0e7a1d2c11/",
+                    }
+                },
+            ),
+            400: openapi.Response(description="The upload cannot be rolled back."),
+            404: openapi.Response(description="Upload job not found."),
+        },
+    )
+    def post(self, request, job_id):
+        upload = get_object_or_404(CustomDutyFileUploads, job_id=job_id)
+        try:
+            queued = request_rollback(upload.job_id)
+        except ValueError as e:
+            return upload_job_response(request, upload, str(e))
+        return upload_job_response(
+            request, queued, "Rollback queued.", status.HTTP_202_ACCEPTED
+        )
+
+
+class CustomDutyExportAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+
+    @swagger_auto_schema(
+        operation_summary="Download the custom duty records as Parquet.",
+        operation_description="""
+            Streams every custom duty record as a Parquet file with the same
+            columns as an upload, so partners can load it directly or send it
+            back. The file is written while the table is read, one row group
+            at a time.
+        """,
+        responses={
+            200: openapi.Response(description="Parquet file of all records."),
+            501: openapi.Response(description="Parquet support is not installed."),
+        },
+    )
+    def get(self, request):
+        try:
+            import_pyarrow()
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        response = StreamingHttpResponse(
+            iter_parquet_export(), content_type="application/vnd.apache.parquet"
+        )
+        response["Content-Disposition"] = 'attachment; filename="custom-duty.parquet"'
+        return response
+
+
+class ChunkedUploadInitAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+    # Upper bound for a file assembled from chunks (in bytes)
+    MAX_FILE_SIZE = getattr(settings, "CHUNKED_UPLOAD_MAX_SIZE", 2 * 1024 * 1024 * 1024)
+
+    @swagger_auto_schema(
+        operation_summary="Start a resumable chunked upload.",
+        operation_description="""
+            Registers a file that will be sent in pieces with PUT requests to the
+            returned chunk_url, then assembled and queued for ingestion by calling
+            complete_url. Use this for files larger than the 5MB data-upload limit.
+            If a file with the same SHA-256 checksum was already uploaded, the
+            existing job is returned and no bytes need to be sent.
+        """,
+        request_body=ChunkedUploadInitSerializer,
+        responses={
+            201: openapi.Response(
+                description="Chunked upload started.",
+                examples={
+                    "application/json": {
+                        "message": "Chunked upload started.",
+                        "data": {
+                            "upload_id": "5d1c3f0e-8a4b-4c55-b1f2-0c8e2b9d7a61",
+                            "file_name": "manifest.csv",
+                            "file_size": 314572800,
+                            "offset": 0,
+                            "status": "uploading",
+                        },
+                        "chunk_url": "http://example.com/vin/data-upload/chunked/5d1c3f0e-8a4b-4c55-b1f2-0c8e2b9d7a61/",
+                        "complete_url": "http://example.com/vin/data-upload/chunked/5d1c3f0e-8a4b-4c55-b1f2-0c8e2b9d7a61/complete/",
+                        "max_chunk_size": 10485760,
+                    }
+                },
+            ),
+            400: openapi.Response(description="Invalid upload details or duplicate file."),
+        },
+    )
+    def post(self, request):
+        serializer = ChunkedUploadInitSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        data = serializer.validated_data
+
+        if get_file_type(data["file_name"]) is None:
+            return Response(
+                {
+                    "message": "Invalid file format. Please upload a CSV, Excel, JSON, XML or Parquet file, "
+                        "optionally compressed as .gz, .bz2 or .zip."
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if data["file_size"] > self.MAX_FILE_SIZE:
+            return Response(
+                {"error": f"File size exceeds the maximum limit of {self.MAX_FILE_SIZE} bytes."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # Known content does not need to be sent at all, unless it failed
+        duplicate = (
+            CustomDutyFileUploads.objects.filter(content_hash=data["checksum"])
+            .exclude(status="failed")
+            .first()
+        )
+        if duplicate is not None:
+            return upload_job_response(request, duplicate, DUPLICATE_FILE_MESSAGE)
+
+        chunked = ChunkedUpload.objects.create(**data)
+        chunk_url = reverse("chunked-upload", args=[chunked.upload_id])
+        return Response(
+            {
+                "message": "Chunked upload started.",
+                "data": ChunkedUploadSerializer(chunked).data,
+                "chunk_url": request.build_absolute_uri(chunk_url),
+                "complete_url": request.build_absolute_uri(
+                    reverse("chunked-upload-complete", args=[chunked.upload_id])
+                ),
+                "max_chunk_size": ChunkedUploadAPIView.MAX_CHUNK_SIZE,
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+
+class ChunkedUploadAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+    # Largest body accepted for one PUT (in bytes)
+    MAX_CHUNK_SIZE = getattr(settings, "CHUNKED_UPLOAD_MAX_CHUNK_SIZE", 10 * 1024 * 1024)
+
+    @swagger_auto_schema(
+        operation_summary="Get the state of a chunked upload.",
+        operation_description="""
+            Returns how many bytes have been received. After an interruption,
+            resume by sending the rest of the file from this offset.
+        """,
+    )
+    def get(self, request, upload_id):
+        chunked = get_object_or_404(ChunkedUpload, upload_id=upload_id)
+        serializer = ChunkedUploadSerializer(chunked)
+        return Response({"message": "Ok", "data": serializer.data}, status=status.HTTP_200_OK)
+
+    @swagger_auto_schema(
+        operation_summary="Send the next chunk of a chunked upload.",
+        operation_description="""
+            The raw request body is written at the byte position given by the
+            `offset` query parameter, which must equal the number of bytes already
+            received. A mismatch returns 409 with the offset to resume from.
+        """,
+        manual_parameters=[
+            openapi.Parameter(
+                "offset",
+                openapi.IN_QUERY,
+                description="Byte position of this chunk in the file",
+                type=openapi.TYPE_INTEGER,
+                required=True,
+            )
+        ],
+        responses={
+            200: openapi.Response(
+                description="Chunk stored.",
+                examples={"application/json": {"offset": 10485760, "complete": False}},
+            ),
+            409: openapi.Response(
+                description="Offset does not match the bytes received so far.",
+                examples={"application/json": {"error": "Unexpected offset.", "offset": 10485760}},
+            ),
+        },
+    )
+    def put(self, request, upload_id):
+        try:
+            offset = int(request.query_params.get("offset", ""))
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return Response(
+                {"error": "A numeric offset query parameter is required."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if length > self.MAX_CHUNK_SIZE:
+            return Response(
+                {"error": f"Chunks may not exceed {self.MAX_CHUNK_SIZE} bytes."},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+
+        with transaction.atomic():
+            chunked = get_object_or_404(
+                ChunkedUpload.objects.select_for_update(), upload_id=upload_id
+            )
+            if chunked.status != "uploading":
+                return Response(
+                    {"error": "This upload has already been completed."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            if offset != chunked.offset:
+                return Response(
+                    {"error": "Unexpected offset.", "offset": chunked.offset},
+                    status=status.HTTP_409_CONFLICT,
+                )
+            if offset + length > chunked.file_size:
+                return Response(
+                    {"error": "Chunk extends past the declared file size."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            stream = request.stream
+            if stream is not None:
+                chunked.offset = append_chunk(chunked.temp_path, offset, stream, length)
+                chunked.save(update_fields=["offset", "updated_at"])
+
+        return Response(
+            {"offset": chunked.offset, "complete": chunked.offset == chunked.file_size},
+            status=status.HTTP_200_OK,
+        )
+
+
+class ChunkedUploadCompleteAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+    @swagger_auto_schema(
+        operation_summary="Finish a chunked upload and queue it for ingestion.",
+        operation_description="""
+            Verifies that every byte was received and that the assembled file
+            matches the SHA-256 checksum given when the upload was started, then
+            queues it like a regular data upload. On a checksum mismatch the
+            received bytes are discarded and the file must be sent again.
+        """,
+        responses={
+            202: openapi.Response(description="File assembled and queued for processing."),
+            400: openapi.Response(description="Upload incomplete, corrupted or duplicate."),
+            409: openapi.Response(description="A chunk arrived while the file was being verified."),
+        },
+    )
+    def post(self, request, upload_id):
+        # Hashed before taking the lock, so chunks of the same upload and
+        # the expiry job are not blocked while a large file is read
+        snapshot = get_object_or_404(ChunkedUpload, upload_id=upload_id)
+        checksum = None
+        if snapshot.status == "uploading" and snapshot.offset == snapshot.file_size:
+            try:
+                checksum = file_sha256(snapshot.temp_path)
+            except FileNotFoundError:
+                pass
+
+        with transaction.atomic():
+            chunked = get_object_or_404(
+                ChunkedUpload.objects.select_for_update(), upload_id=upload_id
+            )
+            if chunked.status == "completed" and chunked.job is not None:
+                return upload_job_response(
+                    request, chunked.job, "Upload already completed.", status.HTTP_200_OK
+                )
+
+            if chunked.offset != chunked.file_size:
+                return Response(
+                    {"error": "The upload is incomplete.", "offset": chunked.offset},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            if chunked.updated_at != snapshot.updated_at:
+                return Response(
+                    {
+                        "error": "The upload changed while it was being verified, please complete it again.",
+                        "offset": chunked.offset,
+                    },
+                    status=status.HTTP_409_CONFLICT,
+                )
+
+            if checksum != chunked.checksum:
+                if os.path.exists(chunked.temp_path):
+                    os.remove(chunked.temp_path)
+                chunked.offset = 0
+                chunked.save(update_fields=["offset", "updated_at"])
+                return Response(
+                    {"error": "Checksum mismatch, please upload the file again.", "offset": 0},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            duplicate = CustomDutyFileUploads.objects.filter(
+                content_hash=chunked.checksum
+            ).first()
+            if duplicate is not None and duplicate.status == "failed":
+                fs = get_upload_storage()
+                filename = move_into_storage(chunked.temp_path, chunked.file_name, fs)
+                response = retry_failed_upload(
+                    request, duplicate, chunked.mode, chunked.tolerant, filename, fs
+                )
+                chunked.status = "completed"
+                chunked.job = duplicate
+                chunked.save(update_fields=["status", "job", "updated_at"])
+                return response
+            if duplicate is not None:
+                os.remove(chunked.temp_path)
+                chunked.status = "completed"
+                chunked.job = duplicate
+                chunked.save(update_fields=["status", "job", "updated_at"])
+                return upload_job_response(request, duplicate, DUPLICATE_FILE_MESSAGE)
+
+            fs = get_upload_storage()
+            filename = move_into_storage(chunked.temp_path, chunked.file_name, fs)
+            vin_file = CustomDutyFileUploads.objects.create(
+                uploaded_by=f"Dennis Akagha",
+                file_name=chunked.file_name,
+                file=filename,
+                file_type=get_file_type(chunked.file_name),
+                file_size=chunked.file_size,
+                content_hash=chunked.checksum,
+                mode=chunked.mode,
+                tolerant=chunked.tolerant,
+            )
+            chunked.status = "completed"
+            chunked.job = vin_file
+            chunked.save(update_fields=["status", "job", "updated_at"])
+
+        return upload_job_response(
+            request,
+            vin_file,
+            "File accepted for processing.",
+            status.HTTP_202_ACCEPTED,
+            file_url=request.build_absolute_uri(settings.MEDIA_URL + filename),
+        )
+
+
 # class GetAllUploadsAPIView(generics.ListAPIView):
 #     # authentication_classes = [JWTAuthentication]
 #     # permission_classes = [IsAuthenticated]
@@ -328,7 +964,11 @@ class SingleMultiVinSearchAPIView(APIView):
         ]
     )
     def get(self, request):
-        vins = request.query_params.getlist("vins")
+        vins = normalize_vins(
+            vin
+            for value in request.query_params.getlist("vins")
+            for vin in value.split(",")
+        )
 
         if len(vins) > 5:
             return Response(
@@ -342,22 +982,7 @@ class SingleMultiVinSearchAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        results = []
-        for vin in vins:
-            api_data = get_vin_status(vin)
-
-            if not api_data or "error" in api_data:
-                results.append(
-                    {"vin": vin, "error": "Error fetching from external API"}
-                )
-
-            try:
-                db_vin = CustomDutyFile.objects.get(vin=vin)
-                serializer = VinSerializer(db_vin)
-                if db_vin.vin == api_data.get("vin"):
-                    results.append(serializer.data)
-            except CustomDutyFile.DoesNotExist:
-                results.append({"vin": vin, "status": "Not found in database"})
+        results = multi_vin_results(vins)
 
         if not results:
             return Response(
@@ -420,16 +1045,18 @@ class UploadMultiVinsAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        if file.name.endswith(".xlsx"):
-            df = pd.read_excel(file)
-
-        if "vin" not in df.columns:
+        if not file.name.endswith(".xlsx"):
             return Response(
-                {"error": "The file must contain a 'vin' column."},
+                {"error": "Invalid file format. Please upload an Excel (.xlsx) file."},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        vins = df["vin"].dropna().astype(str).tolist()
+        # Stream only the vin column, stopping as soon as the limit is exceeded
+        try:
+            rows = iter_excel_rows(file, columns=["vin"], required=["vin"])
+            vins = normalize_vins((row["vin"] for row in rows), limit=21)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         if not vins:
             return Response(
@@ -443,25 +1070,7 @@ class UploadMultiVinsAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        results = []
-
-        for vin in vins:
-            # Validate with External API
-            api_data = get_vin_status(vin)
-
-            if not api_data or "error" in api_data:
-                results.append(
-                    {"vin": vin, "error": "Error fetching from external API"}
-                )
-
-            # Check in Database
-            try:
-                db_vin = CustomDutyFile.objects.get(vin=vin)
-                serializer = VinSerializer(db_vin)
-                if db_vin.vin == api_data.get("vin"):
-                    results.append(serializer.data)
-            except CustomDutyFile.DoesNotExist:
-                results.append({"vin": vin, "status": "Not found in database"})
+        results = multi_vin_results(vins)
 
         if not results:
             return Response(